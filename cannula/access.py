@@ -0,0 +1,208 @@
+"""
+Access Table
+============
+
+Every push checks ``has_perm read --repo=...`` before git-receive-pack
+runs. Booting django and asking the database for a yes or no is most of
+the cost of that check, so cannula keeps a plain text copy of who can
+access what::
+
+    CANNULA_BASE/access
+        #cannula-access 1
+        abby	mygroup	radm
+        abby	mygroup/myproject.git	radm
+        bob	mygroup	r
+        bob	mygroup/myproject.git	r
+
+One line per user and group or repo with the granted permissions (read,
+add, modify, delete). Only users with an ssh key are listed. The lines
+are sorted so `lookup` can do a binary search on the mmapped file, this
+module does not import django for that, ``cannula-client`` answers
+``has_perm`` from it without starting anything.
+
+The table is rebuilt when ``cannulactl serve`` starts. When a
+membership or key changes only the lines of that user are rewritten,
+when a group or project changes the lines of the members of the group
+(see the signals in `cannula.models`). If an update fails the table is
+removed with `invalidate`, every check goes to cannulactl until the next
+rebuild instead of answering from a table that may grant too much.
+"""
+
+import os
+import mmap
+import fcntl
+
+from cannula import conf
+
+# Bump when the format changes, old tables are ignored
+FORMAT = '#cannula-access 1'
+
+PERMS = {'read': 'r', 'add': 'a', 'modify': 'm', 'delete': 'd'}
+
+
+def table_path():
+    return os.path.join(conf.CANNULA_BASE, 'access')
+
+
+def _search(data, key):
+    """Return the first line in the sorted `data` that is >= `key`."""
+    lo, hi = 0, len(data)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = data.rfind('\n', 0, mid) + 1
+        end = data.find('\n', start)
+        if end == -1:
+            end = len(data)
+        if data[start:end] < key:
+            lo = end + 1
+        else:
+            hi = start
+    end = data.find('\n', lo)
+    if end == -1:
+        end = len(data)
+    return data[lo:end]
+
+
+def lookup(user, name, path=None):
+    """
+    Return the permissions of `user` on the group or repo `name`, as a
+    string of perm letters. Returns None if there is no usable table.
+    """
+    path = path or table_path()
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        if f.readline().rstrip('\n') != FORMAT:
+            return None
+        if os.fstat(f.fileno()).st_size == f.tell():
+            # Nobody has access to anything
+            return ''
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            key = u'%s\t%s\t' % (user, name)
+            key = key.encode('utf-8')
+            line = _search(data, key)
+        finally:
+            data.close()
+    finally:
+        f.close()
+    if line.startswith(key):
+        return line[len(key):]
+    return ''
+
+
+def has_perm(user, perm, group=None, repo=None, path=None):
+    """True or False, None if the table can not answer."""
+    if perm not in PERMS or not (group or repo):
+        return None
+    perms = lookup(user, repo or group, path)
+    if perms is None:
+        return None
+    return PERMS[perm] in perms
+
+
+def _lines(usernames=None):
+    """Build the table lines of `usernames` (everyone by default)."""
+    from cannula.models import GroupMembership, Project, Key
+    memberships = GroupMembership.objects.all()
+    keys = Key.objects.all()
+    if usernames is not None:
+        memberships = memberships.filter(user__username__in=usernames)
+        keys = keys.filter(user__username__in=usernames)
+    with_keys = set(keys.values_list('user__username', flat=True))
+    groups = {}
+    for username, group_id, group, add, modify, delete in memberships.values_list(
+            'user__username', 'group_id', 'group__name', 'add', 'modify', 'delete'):
+        if username not in with_keys:
+            continue
+        perms = 'r' + ''.join([letter for letter, granted in
+            (('a', add), ('m', modify), ('d', delete)) if granted])
+        groups.setdefault(group_id, []).append((username, group, perms))
+    lines = []
+    for members in groups.values():
+        for username, group, perms in members:
+            lines.append(u'%s\t%s\t%s' % (username, group, perms))
+    projects = Project.objects.filter(group__in=groups.keys())
+    for group_id, name in projects.values_list('group_id', 'name'):
+        for username, group, perms in groups[group_id]:
+            lines.append(u'%s\t%s/%s.git\t%s' % (username, group, name, perms))
+    return [line.encode('utf-8') for line in lines]
+
+
+def _write(lines, path):
+    from cannula.utils import write_content
+    content = '\n'.join([FORMAT] + sorted(lines))
+    return write_content(path, content + '\n')
+
+
+def _locked(path):
+    lock = open('%s.lock' % path, 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+
+def rebuild(path=None):
+    """Write the whole table, returns the number of lines."""
+    path = path or table_path()
+    if not os.path.isdir(os.path.dirname(path)):
+        return 0
+    lock = _locked(path)
+    try:
+        lines = _lines()
+        _write(lines, path)
+    finally:
+        lock.close()
+    return len(lines)
+
+
+def invalidate(path=None):
+    """Remove the table, lookups fall back to the database."""
+    path = path or table_path()
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def users_of(suffix, path=None):
+    """Users with a line for a group or repo name ending in `suffix`."""
+    path = path or table_path()
+    try:
+        with open(path, 'rb') as f:
+            lines = f.read().splitlines()[1:]
+    except IOError:
+        return set()
+    suffix = suffix.encode('utf-8')
+    users = set()
+    for line in lines:
+        parts = line.split('\t')
+        if len(parts) == 3 and parts[1].endswith(suffix):
+            users.add(parts[0].decode('utf-8'))
+    return users
+
+
+def update(usernames, path=None):
+    """Rewrite the lines of `usernames` only."""
+    path = path or table_path()
+    usernames = set(usernames)
+    if not usernames or not os.path.isdir(os.path.dirname(path)):
+        return
+    if not os.path.isfile(path):
+        rebuild(path)
+        return
+    lock = _locked(path)
+    try:
+        with open(path, 'rb') as f:
+            lines = f.read().splitlines()
+        if not lines or lines[0] != FORMAT:
+            lines = _lines()
+        else:
+            encoded = set([u.encode('utf-8') for u in usernames])
+            lines = [line for line in lines[1:]
+                if line.split('\t', 1)[0] not in encoded]
+            lines.extend(_lines(usernames))
+        _write(lines, path)
+    finally:
+        lock.close()
@@ -5,7 +5,6 @@ from cannula import models
 # TODO: spice these up a bit
 admin.site.register(models.Key)
 admin.site.register(models.Project)
-admin.site.register(models.Deployment)
 admin.site.register(models.Log)
 
 class GroupMembershipInline(admin.TabularInline):
@@ -17,3 +16,11 @@ class GroupAdmin(admin.ModelAdmin):
     inlines = [GroupMembershipInline]
     search_fields = ['name']
 admin.site.register(models.ProjectGroup, GroupAdmin)
+
+class DeploymentPhaseInline(admin.TabularInline):
+    model = models.DeploymentPhase
+
+class DeploymentAdmin(admin.ModelAdmin):
+    list_display = ['project', 'user', 'newrev', 'timestamp']
+    inlines = [DeploymentPhaseInline]
+admin.site.register(models.Deployment, DeploymentAdmin)
@@ -9,11 +9,14 @@ class LazyAPI(object):
         self._dotted_path = dotted_path
         self._api = None
     
-    def __getattr__(self, attr):
+    def _load(self):
         if not self._api:
             klass = import_object(self._dotted_path)
             self._api = klass()
-        return getattr(self._api, attr)
+        return self._api
+    
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
     
 class API:
     
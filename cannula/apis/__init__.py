@@ -2,14 +2,14 @@
 import os
 import posixpath
 
-from django.template.loader import render_to_string
-
 from exceptions import ApiError
 from exceptions import PermissionError
 from exceptions import UnitDoesNotExist
 from exceptions import DuplicateObject
 from cannula.conf import CANNULA_BASE
-from cannula.git import Git
+from cannula.git import Git, format_changes
+from cannula.render import render
+from cannula.utils import write_content
 
 class BaseAPI(object):
     
@@ -83,7 +83,7 @@ class Configurable(object):
             # template is not a full path, generate it now.
             template = posixpath.join(self.template_base, template)
 
-        return render_to_string(template, context)
+        return render(template, context)
     
     def write_extras(self, extra_context={}, initialized=False):
         """
@@ -103,8 +103,7 @@ class Configurable(object):
                 continue
             
             # Write the file
-            with open(fname, 'w') as conf_file:
-                conf_file.write(content)
+            write_content(fname, content)
         
         return to_commit
             
@@ -131,32 +130,31 @@ class Configurable(object):
             if not initialized and dry_run:
                 new = [self.conf_base, self.main_conf] + files
                 return 'New Files:\n\n%s\n' % '\n'.join(new)
-            with open(self.main_conf, 'w') as conf:
-                conf.write(content)
+            write_content(self.main_conf, content)
             
-            # Generate diff 
-            _, diff_out = self.git_repo.diff()
-            # Add all the files for either a commit or reset
-            self.git_repo.add_all()
-            _, output = self.git_repo.status()
-            if not output:
-                # Bail early
-                return '\n\nNo Changes Found\n'
-            else:
-                outmsg += '\n\nFiles Changed:\n %s\n%s\n' % (output, diff_out)
-                
             if dry_run:
+                # Stage everything to show the changes, then undo it
+                self.git_repo.add_all()
+                changes, diff_out = self.git_repo.staged()
                 self.git_repo.reset()
-                return outmsg
+                if not changes:
+                    return '\n\nNo Changes Found\n'
+                return '\n\nFiles Changed:\n %s\n%s\n' % (
+                    format_changes(changes), diff_out)
             
             # Commit the changes
-            code, output = self.git_repo.commit(msg)
-            if code == 0:
-                outmsg += '%s\n' % output
+            snapshot = self.git_repo.snapshot(msg)
+            if not snapshot.changes:
+                # Bail early
+                return '\n\nNo Changes Found\n'
+            outmsg += '\n\nFiles Changed:\n %s\n%s\n' % (
+                format_changes(snapshot.changes), snapshot.diff)
+            if snapshot.ok:
+                outmsg += '%s\n' % snapshot.output
                 return outmsg
             else:
                 self.git_repo.reset()
-                outmsg += "Commit Failed: %s\n" % output
+                outmsg += "Commit Failed: %s\n" % snapshot.output
                 return outmsg
         
         # Default just print the content    
@@ -1,23 +1,35 @@
 import os
+import sys
+import json
+import time
+import errno
 import shutil
 import logging
 import yaml
 import fcntl
-import re
 import datetime
 
 from logging import getLogger
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
+from django.db import connection
 from django.db.models.loading import get_model
 
-from cannula.apis import BaseAPI, ApiError
+from cannula.apis import BaseAPI, ApiError, PermissionError
 from cannula.api import api
 from cannula import conf
+from cannula import releases
 from cannula.git import Git
-from cannula.utils import import_object
+from cannula.utils import import_object, percentile, write_content
+from cannula.process import run
+from cannula.worker import socket_path
 
 log = getLogger('api')
 
+# Exit status of a deploy that a newer push superseded
+SUPERSEDED = 3
+
 class Handler(object):
     """Simple object to hold properties for wsgi handlers"""
     
@@ -27,168 +39,736 @@ class Handler(object):
         self._worker_obj = self._worker_klass(name, self._project, **kwargs)
     
     def __getattr__(self, attr):
-        return getattr(self._worker_obj, attr)
+        try:
+            return getattr(self._worker_obj, attr)
+        except AttributeError:
+            # Options from the app.yaml like 'url'
+            if attr in self._worker_obj.defaults:
+                return self._worker_obj.defaults[attr]
+            raise
 
-class DeployLock(object):
-    """Lock a deployment so that only one deploy happens at a time.
+class DeployQueue(object):
+    """Queue deployments of a project so only one runs at a time.
+    
+    Every deploy takes a ticket and waits for an exclusive flock on the
+    project lock file. The kernel drops the lock if the process dies so
+    it can not go stale. Pending pushes are coalesced, the latest
+    revision wins. A waiting deploy that sees a newer ticket behind it
+    gives up, since the newer push contains its changes anyway. The
+    newer push reports if those changes were deployed.
     
     This is meant to be used in a context like this::
     
         user = api.users.get(user)
         project = api.projects.get(project)
-        with DeployLock(project, user):
-            do_deploy()
+        with DeployQueue(project, user, newrev) as queue:
+            if not queue.superseded:
+                do_deploy()
     """
     
-    def __init__(self, project, user):
+    poll_interval = 0.5
+    
+    def __init__(self, project, user, rev, timeout=None):
         self.project = project
         self.user = user
-        self.locked = False
-        self.lock_file = os.path.join(project.conf_dir, '__locked__')
+        self.rev = rev
+        if timeout is None:
+            timeout = conf.CANNULA_DEPLOY_QUEUE_TIMEOUT
+        self.timeout = timeout
+        self.queue_dir = os.path.join(project.lock_dir, 'queue')
+        self.lock_file = os.path.join(project.lock_dir, 'deploy.lock')
+        self.ticket = None
+        self.lock = None
+        self.superseded = False
+        # Seconds spent waiting in the queue
+        self.waited = 0
+    
+    def notify(self, message):
+        sys.stderr.write('%s\n' % message)
+        sys.stderr.flush()
+    
+    def _tickets(self):
+        """Names of the pending tickets oldest first."""
+        tickets = []
+        for name in sorted(os.listdir(self.queue_dir)):
+            try:
+                pid = int(name.rsplit('-', 1)[1])
+            except (IndexError, ValueError):
+                continue
+            if not pid_alive(pid):
+                # Deploy process died without cleaning up
+                try:
+                    os.remove(os.path.join(self.queue_dir, name))
+                except OSError:
+                    pass
+                continue
+            tickets.append(name)
+        return tickets
+    
+    def holder(self):
+        """Who is holding the lock right now."""
+        with open(self.lock_file) as l:
+            return l.read().strip() or 'unknown'
     
     def __enter__(self):
-        if not os.path.isdir(self.project.conf_dir):
-            os.makedirs(self.project.conf_dir)
-        if os.path.isfile(self.lock_file):
-            # the project is locked
-            with open(self.lock_file) as l:
-                lock_info = l.read()
-            raise Exception("Project locked by: %s" % lock_info)
-        with open(self.lock_file, 'w') as l:
-            l.write('%s - %s' % (self.user, datetime.datetime.now()))
-            self.locked = True
+        if not os.path.isdir(self.queue_dir):
+            os.makedirs(self.queue_dir)
+        name = '%017.6f-%d' % (time.time(), os.getpid())
+        self.ticket = os.path.join(self.queue_dir, name)
+        with open(self.ticket, 'w') as t:
+            t.write('%s %s' % (self.user, self.rev))
+        self.lock = open(self.lock_file, 'a+')
+        
+        start = time.time()
+        deadline = start + self.timeout
+        position = None
+        try:
+            while True:
+                tickets = self._tickets()
+                mine = tickets.index(name)
+                if mine < len(tickets) - 1:
+                    # A newer push is waiting, it will deploy our changes.
+                    self.superseded = True
+                    self.notify("Deploy of %s superseded by a newer push" % self.rev)
+                    self._release()
+                    return self
+                try:
+                    fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError, e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                if time.time() > deadline:
+                    raise ApiError("Timed out after %ss waiting for deploy lock "
+                        "held by: %s" % (self.timeout, self.holder()))
+                if mine != position:
+                    position = mine
+                    self.notify("Waiting for deploy lock held by: %s "
+                        "(position %d in queue)" % (self.holder(), position))
+                time.sleep(self.poll_interval)
+        except:
+            self._release()
+            raise
+        
+        self.waited = time.time() - start
+        # We have the lock, let everyone else know who has it.
+        self.lock.truncate(0)
+        self.lock.write('%s - %s - %s' % (self.user, self.rev, datetime.datetime.now()))
+        self.lock.flush()
+        return self
+    
+    def _release(self):
+        if self.ticket and os.path.isfile(self.ticket):
+            os.remove(self.ticket)
+        if self.lock:
+            # Closing the file drops the flock
+            self.lock.close()
+            self.lock = None
     
     def __exit__(self, ex, value, trace):
-        if self.locked:
-            os.remove(self.lock_file)
-        
+        self._release()
+    
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+@contextmanager
+def deploy_lock(project):
+    """
+    Take the deploy lock of `project` without waiting. Yields False if
+    a deploy (or anything else) is holding it right now::
+    
+        with deploy_lock(project) as locked:
+            if locked:
+                do_maintenance()
+    """
+    if not os.path.isdir(project.lock_dir):
+        os.makedirs(project.lock_dir)
+    lock = open(os.path.join(project.lock_dir, 'deploy.lock'), 'a+')
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+        else:
+            yield True
+    finally:
+        # Closing the file drops the flock
+        lock.close()
+
+class PhaseTimer(object):
+    """Record the wall time and exit status of each deploy phase.
+    
+        timer = PhaseTimer()
+        with timer.phase('bootstrap'):
+            runtime.bootstrap(release, app)
+    """
+    
+    def __init__(self):
+        self.phases = []
+    
+    def record(self, name, duration, status=0):
+        self.phases.append((name, duration, status))
     
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        status = 1
+        try:
+            yield
+            status = 0
+        finally:
+            self.record(name, time.time() - start, status)
+
+
+# Worker sets of a project in 'bluegreen' restart mode
+COLORS = ('blue', 'green')
+
+# Values of 'restart' in the app.yaml
+RESTART_MODES = ('all', 'rolling', 'bluegreen')
+
+def restart_options(app, path):
+    """Keyword arguments of `Supervisord.restart` from the app config."""
+    return {
+        'mode': app.get('restart', 'all'),
+        'batch': app.get('restart_batch', 1),
+        'timeout': app.get('ready_timeout', 30),
+        'path': path,
+    }
+
+class BlueGreen(object):
+    """Track which worker set of a project is live.
+    
+    In 'bluegreen' mode the handlers of every deploy are started as a
+    new process group next to the live one. Each color listens on its
+    own sockets and the proxy is only pointed at the new color once it
+    accepts connections. The state is kept in the project conf_dir so
+    it is versioned with the rest of the configuration::
+    
+        {"live": "green", "blue": "<rev>", "green": "<rev>"}
+    """
+    
+    def __init__(self, project):
+        self.project = project
+        self.state_file = os.path.join(project.conf_dir, 'bluegreen.json')
+        self.state = {}
+        if os.path.isfile(self.state_file):
+            with open(self.state_file) as f:
+                self.state = json.load(f)
+    
+    @property
+    def live(self):
+        return self.state.get('live')
+    
+    @property
+    def idle(self):
+        """The color the next deploy (or rollback) switches to."""
+        return COLORS[1] if self.live == COLORS[0] else COLORS[0]
+    
+    def group(self, color):
+        return '%s_%s' % (self.project.name, color)
+    
+    def supervisor_conf(self, color):
+        return os.path.join(self.project.conf_dir, 'supervisor-%s.conf' % color)
+    
+    def vhost_conf(self, color):
+        return os.path.join(self.project.conf_dir, 'vhost-%s.conf' % color)
+    
+    def release(self, color):
+        rev = self.state.get(color)
+        return releases.Release(self.project, rev) if rev else None
+    
+    def releases(self):
+        """Releases either color runs from, these can not be pruned."""
+        return [self.release(c) for c in COLORS if self.state.get(c)]
+    
+    def switch(self, color, release):
+        self.state['live'] = color
+        self.state[color] = release.rev
+        with open(self.state_file, 'w') as f:
+            json.dump(self.state, f)
+
 
 class DeployAPI(BaseAPI):
     
     model = get_model('cannula', 'deployment')
+    phase_model = get_model('cannula', 'deploymentphase')
     
-    def _create(self, project, user, oldrev, newrev, conf_oldrev, conf_newrev):
-        self.model.objects.create(project=project, user=user, oldrev=oldrev,
+    def _create(self, project, user, oldrev, newrev, conf_oldrev, conf_newrev, phases=()):
+        deployment = self.model.objects.create(project=project, user=user, oldrev=oldrev,
             newrev=newrev, conf_oldrev=conf_oldrev, conf_newrev=conf_newrev)
+        for position, (name, duration, status) in enumerate(phases):
+            self.phase_model.objects.create(deployment=deployment, name=name,
+                position=position, duration=duration, status=status)
+        return deployment
+    
+    def _resolve(self, project, rev):
+        """Return the full hash of `rev` in the project repo."""
+        result = run([conf.CANNULA_GIT_CMD, '--git-dir=%s' % project.repo_dir,
+            'rev-parse', '--verify', rev])
+        if not result.ok:
+            raise ApiError("Unknown revision: %s" % rev)
+        return result.stdout.strip()
     
-    def deploy(self, project, user, oldrev='old', newrev='new'):
+    def deploy(self, project, user, oldrev='old', newrev=None):
+        """Deploy `newrev`, returns False if a newer push superseded it."""
         user = api.users.get(user)
         project = api.projects.get(project)
-        if not os.path.isfile(project.appconfig):
+        newrev = self._resolve(project, newrev or 'master')
+        if oldrev is None:
+            oldrev = "Initial Commit"
+        timer = PhaseTimer()
+        
+        # Wait in line for an exclusive lock on the project. A way
+        # to ensure only one process can deploy at any single time.
+        # This is hard because deployment is triggered by a git push
+        # (which is just an ssh connection)
+        with DeployQueue(project, user, newrev) as queue:
+            if queue.superseded:
+                log.info("Deploy of %s@%s superseded", project, newrev)
+                return False
+            timer.record('queue', queue.waited)
+            
+            # Build the new revision in its own release directory, the
+            # live release is not touched until the build succeeded.
+            previous = releases.current(project)
+            release = releases.Release(project, newrev)
+            created = not release.exists()
+            try:
+                if created:
+                    with timer.phase('export'):
+                        release.create(previous)
+                conf_oldrev, conf_newrev = self._deploy(project, release, previous, timer)
+            except:
+                exc_info = sys.exc_info()
+                if created and releases.current(project) != release:
+                    release.remove()
+                try:
+                    # Keep a record of the failed deploy and its timings
+                    self._create(project, user, oldrev, newrev, '', '', timer.phases)
+                except:
+                    log.exception("Error recording failed deployment")
+                raise exc_info[0], exc_info[1], exc_info[2]
+            self._create(project, user, oldrev, newrev, conf_oldrev, conf_newrev, timer.phases)
+            releases.prune(project, pinned=BlueGreen(project).releases())
+        return True
+    
+    def _deploy(self, project, release, previous, timer):
+        """Build and start the release, return the conf repo revisions."""
+        if not os.path.isfile(release.appconfig):
             raise ApiError("Project missing app.yaml file!")
         
-        # Attempt to get an exclusive lock on the project
-        # file. A way to ensure only one process can deploy
-        # at any single time. This is hard because deployment is
-        # triggered by a git push (which is just an ssh connection)
-        with DeployLock(project, user):
-            with open(project.appconfig) as f:
-                
-                # Store the configuration for this project in git repo
-                # so that we can roll back to previous states
-                conf_dir = Git(project.conf_dir)
-                
+        with timer.phase('yaml'):
+            
+            # Store the configuration for this project in git repo
+            # so that we can roll back to previous states
+            conf_dir = Git(project.conf_dir)
+            
+            if not os.path.isdir(os.path.join(project.conf_dir, '.git')):
                 if not os.path.isdir(project.conf_dir):
                     os.makedirs(project.conf_dir)
-                    conf_dir.init()
-                    # Add an initial commit, just to make a rollback point.
-                    open(project.deployconfig, 'a')
-                    conf_dir.add_all()
-                    conf_dir.commit("Initial Commit")
-                
-                # Copy the project app.yaml to the conf_dir
-                shutil.copy(project.appconfig, project.deployconfig)
-                
-                # read in the application configuration
+                conf_dir.init()
+                # Add an initial commit, just to make a rollback point.
+                open(project.deployconfig, 'a')
+                conf_dir.snapshot("Initial Commit")
+            
+            # Copy the project app.yaml to the conf_dir
+            shutil.copy(release.appconfig, project.deployconfig)
+            
+            # read in the application configuration
+            with open(release.appconfig) as f:
                 app = yaml.load(f.read())
-                
-                # setup any runtime specific things here
-                try:
-                    runtime = import_object(app.get('runtime'))
-                except ImportError:
-                    raise ApiError("Unsupported runtime!")
-                # runtime bootstrap, setup project environment here
-                runtime.bootstrap(project, app)    
-                    
             
-                # Simple counter to make unique names for each handler
-                # and keep them in order
-                handler_position = 0
-                sections = []
-                for handler in app.get('handlers', []):
-                    if handler.get('worker'):
-                        # Setup worker
-                        name = '%s_%d' % (project.name, handler_position)
-                        # defaults are special, they reference another
-                        # section in the app.yaml
-                        defaults = handler.pop('defaults', None)
-                        if defaults:
-                            handler_defaults = app.get(defaults, {})
-                            handler.update(handler_defaults)
-                        handle = Handler(name, project, **handler)
-                        # write out bash start up scripts
-                        handle.write_startup_script()
-                        # add handler to vhost_sections
-                        sections.append(handle)
-                        handler_position += 1
-                    else:
-                        # Just pass the dictionary to the proxy vhosts
-                        sections.append(handler)
-                
-                # Write out the proxy file to serve this app
-                ctx = {
-                    'sections': sections,
-                    'domain': app.get('domain', 'localhost'),
-                    'runtime': app.get('runtime', 'python'),
-                    'port': app.get('port', 80),
-                    'project_conf_dir': project.conf_dir,
-                    'conf_dir': os.path.join(conf.CANNULA_BASE, 'config'),
-                    'project': project,
-                }
-                api.proxy.write_vhost_conf(project, ctx)
-                api.proc.write_project_conf(project, ctx)
-                
-                # Check if any files changed and check if still valid
-                conf_dir.add_all()
-                _, changed = conf_dir.status()
-                logging.debug(changed)
-                if re.search('vhost.conf', changed):
-                    # Vhost file is either new or changed which will require 
-                    # our proxy server to reload its configuration files.
-                    try:
-                        api.proxy.restart()
-                    except:
-                        logging.exception("Error restarting proxy")
-                        conf_dir.reset()
-                        raise ApiError("Deployment failed")
-                if re.search('supervisor.conf', changed):
-                    try:
-                        api.proc.reread()
-                    except:
-                        logging.exception("Error reading supervisor configs")
-                        conf_dir.reset()
-                        raise ApiError("Deployment failed")
-                
-                # Add the project
-                api.proc.reread(stderr=True)
-                api.proc.add_project(project.name)
-                    
-                # Restart the project
+            # setup any runtime specific things here
+            try:
+                runtime = import_object(app.get('runtime'))
+            except ImportError:
+                raise ApiError("Unsupported runtime!")
+        
+        # runtime bootstrap, setup release environment here
+        with timer.phase('bootstrap'):
+            runtime.bootstrap(release, app)
+        
+        # How the new processes replace the running ones
+        mode = app.get('restart', 'all')
+        if mode not in RESTART_MODES:
+            raise ApiError("Unknown restart mode: %s, use one of: %s"
+                % (mode, ', '.join(RESTART_MODES)))
+        bluegreen = BlueGreen(project) if mode == 'bluegreen' else None
+        color = bluegreen.idle if bluegreen else None
+        
+        with timer.phase('startup_scripts'):
+            # The old color keeps running from the old release
+            project_dir = release.project_dir if bluegreen else project.project_dir
+            ctx, _ = self._context(project, app, color, project_dir)
+        
+        if bluegreen:
+            self._bluegreen(project, release, bluegreen, color,
+                ctx, conf_dir, timer, app)
+        else:
+            self._restart(project, release, previous, ctx,
+                conf_dir, timer, app)
+        
+        with timer.phase('commit'):
+            # Commit config changes, if there are any
+            snapshot = conf_dir.snapshot("Configuration: %s" % datetime.datetime.now().ctime())
+            logging.debug(snapshot.changes)
+        return snapshot.oldrev, snapshot.newrev
+    
+    def _context(self, project, app, color=None, project_dir=None):
+        """
+        Write the startup script of every handler in the `app` config
+        and return the context for the vhost and supervisor templates,
+        along with True if any of the scripts changed.
+        """
+        # Simple counter to make unique names for each handler
+        # and keep them in order
+        handler_position = 0
+        sections = []
+        scripts_changed = False
+        for handler in app.get('handlers', []):
+            if handler.get('worker'):
+                # Setup worker
+                name = '%s_%d' % (project.name, handler_position)
+                if color:
+                    # Each color listens on its own sockets
+                    name = '%s_%s' % (name, color)
+                # defaults are special, they reference another
+                # section in the app.yaml
+                defaults = handler.pop('defaults', None)
+                if defaults:
+                    handler_defaults = app.get(defaults, {})
+                    handler.update(handler_defaults)
+                handle = Handler(name, project, **handler)
+                # write out bash start up scripts
+                if handle.write_startup_script():
+                    scripts_changed = True
+                # add handler to vhost_sections
+                sections.append(handle)
+                handler_position += 1
+            else:
+                # Just pass the dictionary to the proxy vhosts
+                sections.append(handler)
+        
+        ctx = {
+            'sections': sections,
+            'handlers': [s for s in sections if isinstance(s, Handler)],
+            'group': '%s_%s' % (project.name, color) if color else project.name,
+            'domain': app.get('domain', 'localhost'),
+            'runtime': app.get('runtime', 'python'),
+            'port': app.get('port', 80),
+            'project_conf_dir': project.conf_dir,
+            'project_dir': project_dir or project.project_dir,
+            'conf_dir': os.path.join(conf.CANNULA_BASE, 'config'),
+            'project': project,
+        }
+        return ctx, scripts_changed
+    
+    def _restart(self, project, release, previous, ctx, conf_dir, timer, app):
+        """Write the configs and restart the project processes in place."""
+        with timer.phase('vhost_conf'):
+            vhost_changed = api.proxy.write_vhost_conf(project, ctx)
+        with timer.phase('project_conf'):
+            api.proc.write_project_conf(project, ctx)
+        
+        # Stage new files so a reset removes them again
+        conf_dir.add_all()
+        if vhost_changed:
+            # Vhost file is either new or changed which will require 
+            # our proxy server to reload its configuration files.
+            try:
+                with timer.phase('proxy_restart'):
+                    api.proxy.reload()
+            except:
+                logging.exception("Error restarting proxy")
+                conf_dir.reset()
+                raise ApiError("Deployment failed")
+        
+        # Switch the live release, processes are started from it.
+        release.activate()
+        
+        try:
+            with timer.phase('proc_update'):
+                updated = api.proc.update([project.name], stderr=True)
+            if not (updated['added'] or updated['changed']):
+                # Nothing (re)started the group with the new release yet
+                with timer.phase('proc_restart'):
+                    api.proc.restart(project.name, stderr=True,
+                        **restart_options(app, project.supervisor_conf))
+        except:
+            logging.exception("Error restarting project")
+            conf_dir.reset()
+            if previous is not None:
+                previous.activate()
+            raise ApiError("Deployment failed")
+    
+    def _bluegreen(self, project, release, bluegreen, color, ctx, conf_dir, timer, app):
+        """
+        Start the release as the idle color next to the live one, point
+        the proxy at it once every handler accepts connections and then
+        stop the old color.
+        """
+        group = bluegreen.group(color)
+        with timer.phase('project_conf'):
+            api.proc.write_project_conf(project, ctx, bluegreen.supervisor_conf(color))
+            conf_dir.add_all()
+        
+        try:
+            with timer.phase('proc_update'):
+                updated = api.proc.update([group], stderr=True)
+                if not (updated['added'] or updated['changed']):
+                    # Same config as the last time this color ran
+                    api.proc.restart(group)
+            with timer.phase('proc_ready'):
+                for handler in ctx['handlers']:
+                    api.proc.wait_ready(handler.socket, app.get('ready_timeout', 30))
+        except:
+            logging.exception("Error starting %s", group)
+            api.proc.remove_project(group)
+            conf_dir.reset()
+            raise ApiError("Deployment failed")
+        
+        with timer.phase('vhost_conf'):
+            api.proxy.write_vhost_conf(project, ctx)
+            # Keep a copy for rolling back to this color later
+            shutil.copy(project.vhost_conf, bluegreen.vhost_conf(color))
+        try:
+            with timer.phase('proxy_restart'):
+                api.proxy.reload()
+        except:
+            logging.exception("Error restarting proxy")
+            api.proc.remove_project(group)
+            conf_dir.reset()
+            raise ApiError("Deployment failed")
+        
+        # The proxy sends new requests to the new color now.
+        release.activate()
+        old = bluegreen.live
+        bluegreen.switch(color, release)
+        with timer.phase('proc_drain'):
+            if old:
+                api.proc.stop(bluegreen.group(old))
+            elif os.path.isfile(project.supervisor_conf):
+                # First bluegreen deploy, retire the plain group
+                os.remove(project.supervisor_conf)
+                api.proc.update([project.name])
+    
+    def rollback(self, project, user):
+        """
+        Switch a 'bluegreen' project back to the color and release that
+        was live before the last deploy. Returns False if a push came in
+        while it waited in the queue, that deploy wins.
+        """
+        user = api.users.get(user)
+        project = api.projects.get(project)
+        if not api.permissions.has_perm(user, 'read', project=project):
+            raise PermissionError("You do not have access to this project")
+        bluegreen = BlueGreen(project)
+        color = bluegreen.idle
+        release = bluegreen.release(color)
+        if (not bluegreen.live or release is None or not release.exists()
+                or not os.path.isfile(bluegreen.vhost_conf(color))):
+            raise ApiError("Nothing to roll back to, only bluegreen "
+                "deploys can be rolled back")
+        
+        conf_dir = Git(project.conf_dir)
+        timer = PhaseTimer()
+        with DeployQueue(project, user, release.rev) as queue:
+            if queue.superseded:
+                return False
+            timer.record('queue', queue.waited)
+            old = bluegreen.live
+            oldrev = bluegreen.state[old]
+            group = bluegreen.group(color)
+            try:
+                with timer.phase('proc_ready'):
+                    api.proc.start(group)
+                    conf_file = bluegreen.supervisor_conf(color)
+                    for name in api.proc.programs(group, conf_file):
+                        api.proc.wait_ready(socket_path(name))
+            except:
+                logging.exception("Error starting %s", group)
+                api.proc.stop(group)
+                raise ApiError("Rollback failed")
+            
+            with timer.phase('proxy_restart'):
+                with open(bluegreen.vhost_conf(color)) as vhost:
+                    write_content(project.vhost_conf, vhost.read())
+                api.proxy.reload()
+            release.activate()
+            bluegreen.switch(color, release)
+            with timer.phase('proc_drain'):
+                api.proc.stop(bluegreen.group(old))
+            
+            with timer.phase('commit'):
+                snapshot = conf_dir.snapshot("Rollback: %s" % datetime.datetime.now().ctime())
+            self._create(project, user, oldrev, release.rev, snapshot.oldrev,
+                snapshot.newrev, timer.phases)
+        return True
+    
+    def regenerate(self, projects=None, concurrency=None):
+        """
+        Render the configs and startup scripts of `projects` (default all
+        of them) again from their stored app.yaml, after the templates
+        changed. Only files that changed are written and each conf repo
+        gets a commit. The projects are rendered `concurrency` at a time,
+        then the proxy is reloaded once and supervisor rereads its config
+        once for all of them.
+        
+        Returns a dict of project name to 'changed', 'unchanged',
+        'skipped' (never deployed), 'locked' (a deploy is running, it
+        renders the new templates anyway) or the error.
+        """
+        model = get_model('cannula', 'project')
+        projects_qs = model.objects.select_related('group')
+        if projects is not None:
+            names = [getattr(p, 'name', p) for p in projects]
+            projects_qs = projects_qs.filter(name__in=names)
+        concurrency = concurrency or conf.CANNULA_REGENERATE_CONCURRENCY
+        
+        pool = ThreadPool(concurrency)
+        try:
+            rendered = pool.map(self._regenerate_project, list(projects_qs))
+        finally:
+            pool.close()
+            pool.join()
+        
+        results = {}
+        reloads = []
+        updates = []
+        restarts = []
+        for project, result in rendered:
+            if not isinstance(result, dict):
+                results[project.name] = result
+                continue
+            changed = result['vhost'] or result['supervisor'] or result['scripts']
+            results[project.name] = 'changed' if changed else 'unchanged'
+            if result['vhost']:
+                reloads.append(project.name)
+            if result['supervisor']:
+                updates.append((result['group'], project.name))
+            elif result['scripts']:
+                # Same supervisor config, only a restart picks them up
+                restarts.append((result['group'], project.name, result['restart']))
+        
+        # The configs are committed already, apply as much of them as
+        # possible and report what failed instead of stopping halfway.
+        def apply(names, action, func, *args, **kwargs):
+            try:
+                func(*args, **kwargs)
+            except Exception, e:
+                log.exception("Error in %s", action)
+                for name in names:
+                    results[name] = 'error: %s: %s' % (action, e)
+        
+        if reloads:
+            apply(reloads, 'proxy reload', api.proxy.reload)
+        if updates:
+            apply([name for _, name in updates], 'supervisor update',
+                api.proc.update, [group for group, _ in updates])
+        for group, name, options in restarts:
+            apply([name], 'restart', api.proc.restart, group, **options)
+        return results
+    
+    def _regenerate_project(self, project):
+        """Render the configs of one project, run in a pool thread."""
+        try:
+            with deploy_lock(project) as locked:
+                if not locked:
+                    return project, 'locked'
                 try:
-                    api.proc.restart(project.name, stderr=True)
-                except:
-                    logging.exception("Error restarting project")
-                    conf_dir.reset()
-                    raise ApiError("Deployment failed")
-                # Current revision of conf directory
-                conf_oldrev = conf_dir.head()
-                if changed:
-                    # Commit config changes
-                    conf_dir.commit("Configuration: %s" % datetime.datetime.now().ctime())
-                
-                # new revision of conf directory
-                conf_newrev = conf_dir.head()
-                if oldrev is None:
-                    oldrev = "Initial Commit"
-                self._create(project, user, oldrev, newrev, conf_oldrev, conf_newrev)     
\ No newline at end of file
+                    return project, self._render_configs(project)
+                except Exception, e:
+                    log.exception("Error regenerating %s", project)
+                    Git(project.conf_dir).reset()
+                    return project, 'error: %s' % e
+        finally:
+            # Every pool thread has its own database connection
+            connection.close()
+    
+    def _render_configs(self, project):
+        if not os.path.isfile(project.deployconfig):
+            return 'skipped'
+        with open(project.deployconfig) as f:
+            app = yaml.load(f.read())
+        if not app:
+            # Just the empty file of the initial commit
+            return 'skipped'
+        
+        if app.get('restart', 'all') == 'bluegreen':
+            bluegreen = BlueGreen(project)
+            color = bluegreen.live
+            if not color:
+                return 'skipped'
+            # Render the live color, the idle one is written on deploy
+            project_dir = bluegreen.release(color).project_dir
+            supervisor_conf = bluegreen.supervisor_conf(color)
+        else:
+            bluegreen = color = None
+            project_dir = project.project_dir
+            supervisor_conf = project.supervisor_conf
+        
+        ctx, scripts = self._context(project, app, color, project_dir)
+        vhost = api.proxy.write_vhost_conf(project, ctx)
+        if bluegreen:
+            with open(project.vhost_conf) as f:
+                write_content(bluegreen.vhost_conf(color), f.read())
+        supervisor = api.proc.write_project_conf(project, ctx, supervisor_conf)
+        
+        restart = restart_options(app, supervisor_conf)
+        if bluegreen:
+            # Only a deploy switches colors, the live one is restarted
+            # in place a batch at a time.
+            restart['mode'] = 'rolling'
+        
+        Git(project.conf_dir).snapshot("Regenerated: %s" % datetime.datetime.now().ctime())
+        return {
+            'group': ctx['group'],
+            'restart': restart,
+            'vhost': vhost,
+            'supervisor': supervisor,
+            'scripts': scripts,
+        }
+    
+    def list(self, project, user, count=10):
+        """Recent deployments of the project, newest first."""
+        project = api.projects.get(project)
+        if not api.permissions.has_perm(user, 'read', project=project):
+            raise PermissionError("You do not have access to this project")
+        deployments = self.model.objects.filter(project=project)
+        deployments = deployments.select_related('user').prefetch_related('phases')
+        return deployments.order_by('-timestamp')[:count]
+    
+    def phase_stats(self, project, count=20):
+        """
+        Return the p50 and p95 wall time of each phase over the last
+        `count` deployments of the project, in the order they run.
+        """
+        project = api.projects.get(project)
+        deployments = self.model.objects.filter(project=project)
+        ids = deployments.order_by('-timestamp').values_list('id', flat=True)[:count]
+        phases = self.phase_model.objects.filter(deployment__in=list(ids))
+        order = []
+        durations = {}
+        failures = {}
+        for name, duration, status in phases.values_list('name', 'duration', 'status'):
+            if name not in durations:
+                order.append(name)
+                durations[name] = []
+                failures[name] = 0
+            durations[name].append(duration)
+            if status != 0:
+                failures[name] += 1
+        return [{
+            'name': name,
+            'count': len(durations[name]),
+            'failures': failures[name],
+            'p50': percentile(durations[name], 50),
+            'p95': percentile(durations[name], 95),
+        } for name in order]
@@ -1,14 +1,14 @@
 import os
+import fcntl
 from logging import getLogger
-from shutil import copy2
 
 from django.db.models.loading import get_model
 
+from cannula import keystore
 from cannula.apis import BaseAPI
-from cannula.conf import CANNULA_SSH_COMMAND
 from cannula.api import api
 from cannula.models import valid_key
-from django.template.loader import render_to_string
+from cannula.utils import write_chunks
 
 log = getLogger('api.keys')
 
@@ -55,26 +55,68 @@ class KeyAPI(BaseAPI):
         """
         return self._list(user=user)
     
+    def lines(self, keys=None):
+        """Yield the authorized_keys lines of `keys` (default all keys)."""
+        if keys is None:
+            # In the order they were added, new keys go to the end
+            keys = self.model.objects.select_related('user').order_by('pk').iterator()
+        for key in keys:
+            yield keystore.line(key).encode('utf-8') + '\n'
+    
     def authorized_keys(self):
         """Returns a formated authorized_key file for all keys."""
-        ctx = {
-            'keys': self.list(),
-            'cannula_cmd': CANNULA_SSH_COMMAND,
-        }
-        return render_to_string('cannula/authorized_keys.txt', ctx)
-        
-    def write_keys(self):
-        """Write the key file to the current users .ssh/authorized_keys file."""
-        key_file = self.authorized_keys()
+        return ''.join(self.lines())
+    
+    def authorized_keys_path(self):
         ssh_path = os.path.expanduser('~/.ssh')
-        authorized_keys = os.path.join(ssh_path, 'authorized_keys')
         if not os.path.isdir(ssh_path):
             os.makedirs(ssh_path, mode=0700)
+        return os.path.join(ssh_path, 'authorized_keys')
+    
+    def _locked(self, path):
+        lock = open('%s.lock' % path, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
         
-        if os.path.isfile(authorized_keys):
-            # save the old version just incase
-            copy2(authorized_keys, '%s.bak' % authorized_keys)
+    def write_keys(self):
+        """
+        Write the key file to the current users .ssh/authorized_keys file,
+        returns True if it changed.
+        """
+        authorized_keys = self.authorized_keys_path()
+        lock = self._locked(authorized_keys)
+        try:
+            # Keep the old file around just in case
+            return write_chunks(authorized_keys, self.lines(), '600', backup=True)
+        finally:
+            lock.close()
+    
+    def update_keys(self, added=None, removed=None):
+        """
+        Add the `added` and drop the `removed` keys from the key file
+        without reading the other keys from the database. Returns True
+        if it changed.
         
-        # Write the authorized keys file
-        with open(authorized_keys, 'w') as f:
-            f.write(key_file)
\ No newline at end of file
+        Removed keys are matched by the key itself, not by the whole
+        line, the user may be gone or renamed already.
+        """
+        authorized_keys = self.authorized_keys_path()
+        if not os.path.isfile(authorized_keys):
+            return self.write_keys()
+        blobs = set([key.ssh_key.split()[1] for key in removed or []])
+        for blob in blobs:
+            if self.model.objects.filter(ssh_key__contains=blob).exists():
+                # Another user still has the same key
+                return self.write_keys()
+        lock = self._locked(authorized_keys)
+        try:
+            def lines():
+                with open(authorized_keys, 'rb') as f:
+                    for line in f:
+                        if not blobs.intersection(line.split()):
+                            yield line
+                for line in self.lines(added or []):
+                    yield line
+            return write_chunks(authorized_keys, lines(), '600', backup=True)
+        finally:
+            lock.close()
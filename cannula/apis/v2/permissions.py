@@ -1,5 +1,6 @@
 from logging import getLogger
 
+from django.core.cache import cache as django_cache
 from django.db.models.loading import get_model
 
 from cannula.apis import UnitDoesNotExist
@@ -7,10 +8,16 @@ from cannula.apis import ApiError
 from cannula.apis import BaseAPI
 from cannula.apis import PermissionError
 from cannula.api import api
+from cannula import cache
 
 
 log = getLogger('api')
 
+PERMS = ['read', 'add', 'modify', 'delete']
+
+# Seconds a permission matrix is cached, in case a change was missed
+MATRIX_TIMEOUT = 300
+
 class PermissionAPI(BaseAPI):
     
     model = get_model('cannula', 'groupmembership')
@@ -18,40 +25,116 @@ class PermissionAPI(BaseAPI):
     project = get_model('cannula', 'project')
     group = get_model('cannula', 'projectgroup')
     
+    def _build_matrix(self, username):
+        groups = {}
+        names = {}
+        memberships = self.model.objects.filter(user__username=username)
+        for group_id, name, add, modify, delete in memberships.values_list(
+                'group_id', 'group__name', 'add', 'modify', 'delete'):
+            # Read permission is given to all members
+            perms = set(['read'])
+            for perm, granted in (('add', add), ('modify', modify), ('delete', delete)):
+                if granted:
+                    perms.add(perm)
+            groups[group_id] = perms
+            names[name] = group_id
+        projects = {}
+        if groups:
+            projects = dict(self.project.objects.filter(group__in=groups.keys())
+                .values_list('name', 'group_id'))
+        return {'groups': groups, 'names': names, 'projects': projects}
+    
+    def matrix(self, user):
+        """
+        Return the permissions of `user` in each of the groups, along with
+        the ids of the groups and projects it can see by name::
+        
+            {
+                'groups': {1: set(['read', 'add'])},
+                'names': {'mygroup': 1},
+                'projects': {'myproject': 1},
+            }
+        
+        The matrix is memoized on the user object (a request). With a
+        shared cache backend it is also cached until a membership, group
+        or project changes, a per process cache would keep serving
+        revoked permissions after a change made by another process.
+        """
+        memo = getattr(user, '_cannula_perms', None)
+        if memo and memo[0] == cache.local_version('perms'):
+            return memo[1]
+        username = getattr(user, 'username', user)
+        if cache.shared():
+            key = cache.make_key('perms', username)
+            matrix = django_cache.get(key)
+            if matrix is None:
+                matrix = self._build_matrix(username)
+                django_cache.set(key, matrix, MATRIX_TIMEOUT)
+        else:
+            matrix = self._build_matrix(username)
+        if not isinstance(user, basestring):
+            user._cannula_perms = (cache.local_version('perms'), matrix)
+        return matrix
+    
     def has_perm(self, user, perm, group=None, project=None, obj=None):
-        if not perm in ['add', 'modify', 'delete', 'read']:
+        if not perm in PERMS:
             # Bail early!
             return False
-
-        user = api.users.get(user)
+        
+        matrix = self.matrix(user)
+        if isinstance(user, basestring) and not matrix['groups']:
+            # Raise UnitDoesNotExist for unknown users
+            api.users.get(user)
         
         if group:
-            group = api.groups.get(group)
+            if isinstance(group, self.group):
+                group_id = group.pk
+            else:
+                group_id = matrix['names'].get(group)
+                if group_id is None:
+                    # Not a member, or no such group
+                    api.groups.get(group)
         elif project:
-            project = api.projects.get(project)
-            group = project.group
+            if isinstance(project, self.project):
+                group_id = project.group_id
+            else:
+                group_id = matrix['projects'].get(project)
+                if group_id is None:
+                    api.projects.get(project)
         else:
             # Else check for project/group permissions
             if isinstance(obj, self.project):
-                group = obj.group
+                group_id = obj.group_id
             elif isinstance(obj, self.group):
-                group = obj
+                group_id = obj.pk
             else:
                 # We do not handle anything else
                 return False
         
-        # Else check the group membership
-        kwargs = {
-            'user': user,
-            'group': group,
-        }
-        # Read permission is given to all members so just check if they
-        # are members.
-        if perm != 'read':
-            kwargs.update({perm: True})
-
-        return self.model.objects.filter(**kwargs).count()
+        return perm in matrix['groups'].get(group_id, ())
+    
     
+    def bulk_has_perm(self, user, perms, objects):
+        """
+        Check `perms` for a list of groups and projects at once. Returns
+        a dict of object to a dict of perm to bool, for templates (see
+        the `perms_for` filter) and json::
+        
+            lookup = api.permissions.bulk_has_perm(user, ['delete'], groups)
+            lookup[group]['delete']
+        """
+        matrix = self.matrix(user)
+        lookup = {}
+        for obj in objects:
+            if isinstance(obj, self.project):
+                group_id = obj.group_id
+            elif isinstance(obj, self.group):
+                group_id = obj.pk
+            else:
+                continue
+            granted = matrix['groups'].get(group_id, ())
+            lookup[obj] = dict([(perm, perm in granted) for perm in perms])
+        return lookup
     
     def grant_admin(self, user, group):
         """
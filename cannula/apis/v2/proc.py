@@ -1,18 +1,28 @@
 import os
+import re
 import sys
+import time
+import socket
 import logging
 import xmlrpclib
-
-from supervisor.xmlrpc import SupervisorTransport
+from ConfigParser import RawConfigParser, NoSectionError, NoOptionError
 
 from cannula import conf
 from cannula.utils import shell, write_file
 from cannula.api import api
-from cannula.apis import Configurable
+from cannula.apis import Configurable, ApiError
+from cannula.rpc import SupervisorClient
+from cannula.worker import socket_path
 
 
 log = logging.getLogger("cannula.supervisor")
 
+# Supervisor process states and fault codes we care about
+STOPPED_STATES = (0, 100, 200, 1000) # STOPPED, EXITED, FATAL, UNKNOWN
+BAD_NAME = 10
+NOT_RUNNING = 70
+ALREADY_ADDED = 90
+
 class Supervisord(Configurable):
     
     conf_type = 'proc'
@@ -52,15 +62,13 @@ class Supervisord(Configurable):
             'manages_proxy': self.manages_proxy,
             'proxy': self.proxy,
         }
-        # Setup the connection to the xmlrpc backend
-        # xmlrpclib forces you to use an http uri, the SupervisorTransport
-        # handles unix sockets as well as usernames and passwords.
-        self.server = xmlrpclib.ServerProxy('http://127.0.0.1',
-            transport=SupervisorTransport(
-                username=self.username,
-                password=self.password,
-                serverurl=self.serverurl
-            )
+        # Pool of connections to the xmlrpc backend, it is used like
+        # a xmlrpclib.ServerProxy and handles unix sockets as well as
+        # usernames and passwords.
+        self.server = SupervisorClient(self.serverurl,
+            username=self.username,
+            password=self.password,
+            timeout=conf.CANNULA_SUPERVISOR_TIMEOUT,
         )
     
     def reread(self, stderr=False):
@@ -69,6 +77,36 @@ class Supervisord(Configurable):
             sys.stderr.write("Supervisor --> reloading configuration\n")
         return self.server.supervisor.reloadConfig()
 
+    def update(self, names, stderr=False):
+        """
+        Reread the configuration and apply it to the groups in `names`
+        only, every other group is left alone. Added groups are started,
+        changed groups are replaced and removed groups are stopped.
+        Returns the reloadConfig result limited to `names`.
+        """
+        if stderr:
+            sys.stderr.write("Supervisor --> updating %s\n" % ', '.join(names))
+        added, changed, removed = self.server.supervisor.reloadConfig()[0]
+        result = {
+            'added': [name for name in added if name in names],
+            'changed': [name for name in changed if name in names],
+            'removed': [name for name in removed if name in names],
+        }
+        log.info("Updating groups: %s", result)
+        # A group that failed to stop must not be replaced, stop them
+        # all first.
+        batch = self.server.batch()
+        for name in result['removed'] + result['changed']:
+            batch.add('supervisor.stopProcessGroup', name)
+        batch.run(ignore=(BAD_NAME,))
+        for name in result['removed'] + result['changed']:
+            batch.add('supervisor.removeProcessGroup', name)
+        for name in result['changed'] + result['added']:
+            # Starts the processes with autostart set
+            batch.add('supervisor.addProcessGroup', name)
+        batch.run(ignore=(BAD_NAME, ALREADY_ADDED))
+        return result
+    
     def stop(self, name):
         log.info("Stopping: %s", name)
         return self.server.supervisor.stopProcessGroup(name)
@@ -77,23 +115,101 @@ class Supervisord(Configurable):
         log.info("Starting: %s", name)
         return self.server.supervisor.startProcessGroup(name)
     
-    def restart(self, name, stderr=False):
+    def restart(self, name, stderr=False, mode='all', batch=1, timeout=30, path=None):
+        """
+        Restart the process group `name`. The default mode stops every
+        process in the group and then starts them again. In 'rolling'
+        mode the processes of each program are restarted `batch` at a
+        time and the program socket must accept connections within
+        `timeout` seconds before the next batch is stopped. `path` is
+        the supervisor config of the group, it lists the programs.
+        
+        Supervisor holds the socket of a fcgi program, so the rest of
+        its processes keep serving while one batch restarts. A program
+        with a single process is down until it is started again.
+        """
         if stderr:
-            sys.stderr.write("Supervisor --> restarting %s\n" % name)
+            sys.stderr.write("Supervisor --> restarting %s (%s)\n" % (name, mode))
         log.info("Restarting: %s", name)
+        if mode == 'rolling':
+            return self.rolling_restart(name, batch, timeout, path)
+        # Not a batch, nothing is started when the stop failed
         self.stop(name)
         self.start(name)
     
+    def processes(self, group):
+        """Process info of all processes in the group."""
+        return [info for info in self.server.supervisor.getAllProcessInfo()
+            if info['group'] == group]
+    
+    def rolling_restart(self, group, batch=1, timeout=30, path=None):
+        processes = self.processes(group)
+        programs = self.programs(group, path) if path else []
+        batch = max(int(batch), 1)
+        for program in programs or [info['name'] for info in processes]:
+            # fcgi processes are named <program>_00, <program>_01, ...
+            match = re.compile(r'^%s(_\d+)?$' % re.escape(program))
+            chunks = [info for info in processes if match.match(info['name'])]
+            for start in range(0, len(chunks), batch):
+                chunk = chunks[start:start + batch]
+                for info in chunk:
+                    if info['state'] in STOPPED_STATES:
+                        continue
+                    log.info("Stopping: %s:%s", group, info['name'])
+                    try:
+                        self.server.supervisor.stopProcess('%s:%s' % (group, info['name']))
+                    except xmlrpclib.Fault, f:
+                        if f.faultCode != NOT_RUNNING:
+                            raise
+                for info in chunk:
+                    # Returns once the process is RUNNING (startsecs)
+                    log.info("Starting: %s:%s", group, info['name'])
+                    self.server.supervisor.startProcess('%s:%s' % (group, info['name']))
+                self.wait_ready(socket_path(program), timeout)
+    
+    def programs(self, group, path):
+        """Names of the programs of `group` in the config file `path`."""
+        parser = RawConfigParser()
+        parser.read(path)
+        try:
+            names = parser.get('group:%s' % group, 'programs')
+        except (NoSectionError, NoOptionError):
+            return []
+        return [name.strip() for name in names.split(',') if name.strip()]
+    
+    def wait_ready(self, path, timeout=30):
+        """Wait until something accepts connections on the unix socket."""
+        deadline = time.time() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+                return True
+            except socket.error:
+                if time.time() > deadline:
+                    raise ApiError("Not accepting connections after %ss: %s" % (timeout, path))
+                time.sleep(0.2)
+            finally:
+                sock.close()
+    
     def add_project(self, name, stderr=False):
         try:
             self.server.supervisor.addProcessGroup(name)
             log.info("Added group: %s", name)
         except xmlrpclib.Fault, f:
-            if f.faultCode == 90:
+            if f.faultCode == ALREADY_ADDED:
                 log.warning("%s already added" % name)
             else:
                 raise
     
+    def remove_project(self, name):
+        """Stop and unload the group, it does not have to be loaded."""
+        batch = self.server.batch()
+        batch.add('supervisor.stopProcessGroup', name)
+        batch.add('supervisor.removeProcessGroup', name)
+        if batch.run(ignore=(BAD_NAME,))[1]:
+            log.info("Removed group: %s", name)
+    
     def startup(self):
         status, output = shell('%(cmd)s -c %(main_conf)s' % self.context)
         if status > 0:
@@ -104,7 +220,9 @@ class Supervisord(Configurable):
         if status > 0:
             logging.error(output)
     
-    def write_project_conf(self, project, extra_ctx):
+    def write_project_conf(self, project, extra_ctx, path=None):
+        """Write the project config, return True if it changed."""
         ctx = self.context.copy()
         ctx.update(extra_ctx)
-        return write_file(project.supervisor_conf, self.project_template, ctx)
+        path = path or project.supervisor_conf
+        return write_file(path, self.project_template, ctx)
@@ -11,6 +11,7 @@ from cannula.apis import PermissionError
 from cannula.apis import BaseAPI
 from cannula.conf import CANNULA_GIT_CMD, CANNULA_CMD
 from cannula.api import api
+from cannula import releases
 from cannula.models import valid_name
 from cannula.utils import write_file
 
@@ -98,7 +99,7 @@ class ProjectAPI(BaseAPI):
         Utility to create a project on the filesystem.
         
         #. Create a unix user for the project.
-        #. Create home directory for code.
+        #. Create the releases directory for code.
         #. Create a bare git repository for code.
         
         """
@@ -115,8 +116,8 @@ class ProjectAPI(BaseAPI):
         if not os.path.isdir(project.repo_dir):
             os.makedirs(project.repo_dir)
         
-        if not os.path.isdir(project.project_dir):
-            os.makedirs(project.project_dir)
+        # Empty release to use until the first deploy
+        releases.initialize(project)
         
         # Create the git repo
         args = {
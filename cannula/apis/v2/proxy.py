@@ -19,7 +19,11 @@ templates. The templates are arranged like this::
 """
 
 import os
+import json
+import time
+import fcntl
 import posixpath
+from logging import getLogger
 
 from cannula import conf
 from cannula.utils import shell, write_file
@@ -27,6 +31,94 @@ from cannula.utils import shell, write_file
 from cannula.api import api
 from cannula.apis import Configurable
 
+log = getLogger('cannula.proxy')
+
+class ReloadCoordinator(object):
+    """
+    Merge the proxy reloads requested by concurrent deploys into one.
+    
+    Deploys run in separate processes so the bookkeeping is done in
+    files under CANNULA_BASE/locks/proxy/:
+    
+    * `requested` the generation of the latest reload request
+    * `done` the generation the last reload covered and its result
+    
+    A deploy bumps the requested generation, waits `window` seconds so
+    others can join in and takes the reload lock. If a reload covering
+    its generation already ran it shares that result, otherwise it
+    reloads once for everyone who asked so far.
+    """
+    
+    def __init__(self, reload_func, base=None, window=None):
+        self.reload_func = reload_func
+        self.base = base or os.path.join(conf.CANNULA_BASE, 'locks', 'proxy')
+        if window is None:
+            window = conf.CANNULA_PROXY_RELOAD_WINDOW
+        self.window = window
+        self.requested_file = os.path.join(self.base, 'requested')
+        self.done_file = os.path.join(self.base, 'done')
+    
+    def _lock(self, name):
+        if not os.path.isdir(self.base):
+            os.makedirs(self.base)
+        lock = open(os.path.join(self.base, name), 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+    
+    def _read(self, path, default):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return default
+    
+    def _write(self, path, data):
+        tmp = '%s.tmp' % path
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+    
+    def request(self):
+        """Register a reload request, returns its generation."""
+        lock = self._lock('requested.lock')
+        try:
+            generation = self._read(self.requested_file, 0) + 1
+            self._write(self.requested_file, generation)
+        finally:
+            lock.close()
+        return generation
+    
+    def reload(self):
+        """
+        Wait for a reload that covers this request. Returns True if this
+        process did the reload, raises if the shared reload failed.
+        """
+        generation = self.request()
+        time.sleep(self.window)
+        lock = self._lock('reload.lock')
+        try:
+            done = self._read(self.done_file, {})
+            if done.get('generation', 0) < generation:
+                # Every request up to now is covered by this reload,
+                # their config files were written before they asked.
+                target = self._read(self.requested_file, generation)
+                log.info("Reloading proxy for requests up to %d", target)
+                try:
+                    self.reload_func()
+                except Exception, e:
+                    self._write(self.done_file, {'generation': target,
+                        'status': 1, 'output': str(e)})
+                    raise
+                self._write(self.done_file, {'generation': target,
+                    'status': 0, 'output': ''})
+                return True
+        finally:
+            lock.close()
+        log.info("Proxy reload %d covered by a concurrent deploy", generation)
+        if done['status'] != 0:
+            raise Exception(done['output'])
+        return False
+
 class Proxy(Configurable):
     
     conf_type = 'proxy'
@@ -51,6 +143,7 @@ class Proxy(Configurable):
             'vhost_base': self.vhost_base,
             'supervisor_managed': self.supervisor_managed,
         }
+        self.coordinator = ReloadCoordinator(self.restart)
     
     @property
     def manual_start_cmd(self):
@@ -86,7 +179,15 @@ class Proxy(Configurable):
         if code != 0:
             raise Exception(output)
         
+    def reload(self):
+        """
+        Reload the proxy configuration. Reloads requested by concurrent
+        deploys within `reload_window` seconds are done only once.
+        """
+        return self.coordinator.reload()
+    
     def write_vhost_conf(self, project, extra_context={}):
+        """Write the project config, return True if it changed."""
         ctx = self.context.copy()
         ctx.update(extra_context)
         template = posixpath.join(self.template_base, 'vhost.conf')
@@ -1,5 +1,6 @@
 from logging import getLogger
 
+from django.core.cache import cache as django_cache
 from django.db.models.loading import get_model
 
 from cannula.apis import DuplicateObject
@@ -7,12 +8,17 @@ from cannula.apis import UnitDoesNotExist
 from cannula.apis import PermissionError
 from cannula.apis import BaseAPI
 from cannula.api import api
+from cannula import cache
 
 log = getLogger('api.users')
 
+# Seconds the output of `info` is cached, in case a change was missed
+INFO_TIMEOUT = 300
+
 class UserAPI(BaseAPI):
     
     model = get_model('auth', 'user')
+    membership = get_model('cannula', 'groupmembership')
     lookup_field = 'username'
       
     def _create(self, username, **kwargs):
@@ -52,18 +58,41 @@ class UserAPI(BaseAPI):
         user.delete()
     
     def info(self, username):
-        user = self.get(username)
+        """
+        Text listing the groups and projects of `username`. With a shared
+        cache backend it is cached until a membership, group or project
+        changes, like the permission matrix.
+        """
+        if not cache.shared():
+            return self._info(username)
+        key = cache.make_key('perms', 'info', username)
+        output = django_cache.get(key)
+        if output is None:
+            output = self._info(username)
+            django_cache.set(key, output, INFO_TIMEOUT)
+        return output
+    
+    def _info(self, username):
+        # Every group with its projects in one query
+        memberships = self.membership.objects.filter(user__username=username)
+        rows = memberships.order_by('pk', 'group__project__pk').values_list(
+            'group__name', 'group__project__name')
+        if not rows:
+            # Raises UnitDoesNotExist for unknown users
+            self.get(username)
         #TODO: make version live
         output = "Cannula Version: 0.1\n"
         output += "-------------------------------------------\n"
         output += "Your Groups and Projects\n"
-        groups = [g.group for g in user.groupmembership_set.all()]
-        for group in groups:
-            output += " - %s:\n" % group
-            for project in group.projects:
+        current = None
+        for group, project in rows:
+            if group != current:
+                output += " - %s:\n" % group
+                current = group
+            if project is not None:
                 output += "\t- %s\n" % project
-        
-        return output
+        # Bytes like the str() of the models, this is printed over ssh
+        return output.encode('utf-8')
     
     def update(self, user):
         """Hook for updating user information. (LDAP, external DB, etc.)"""
\ No newline at end of file
@@ -135,6 +135,12 @@ def initialize(interactive, verbosity):
     if status == 0:
         config['cannula_cmd'] = cmd.strip()
     config = set_option(config, 'cannula_cmd', interactive, logger)
+    
+    # Same for the client of the cannula daemon
+    status, cmd = shell('which cannula-client')
+    if status == 0:
+        config['cannula_client_cmd'] = cmd.strip()
+    config = set_option(config, 'cannula_client_cmd', interactive, logger)
 
     # Cannula ssh command, run by authorized keys
     base = config.get('cannula_base')
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""\
+%prog username command [options]
+
+Tiny client for the ``cannulactl serve`` daemon. Takes the exact same
+arguments as ``cannulactl`` and streams the output of the command back.
+It does not import django so it starts up fast, which is the whole point.
+
+If the daemon is not running this just runs ``cannulactl`` directly.
+
+``has_perm`` checks of a repo or group are answered from the access
+table (see `cannula.access`) without talking to the daemon at all.
+Only a granted permission is trusted, anything else is still checked
+by ``cannulactl``.
+"""
+import os
+import errno
+import re
+import sys
+import socket
+
+from cannula import access
+from cannula.conf import CANNULA_CMD
+from cannula.daemon import request
+
+# Same as cannulactl
+NAME_MATCH = re.compile('^([a-zA-Z][-_a-zA-Z0-9]*)/([a-zA-Z][-_a-zA-Z0-9]*)\.git')
+
+
+def check_access(argv):
+    """True if the access table grants the `has_perm` in `argv`."""
+    args = [arg for arg in argv if not arg.startswith('--')]
+    options = dict([arg[2:].split('=', 1) for arg in argv
+        if arg.startswith('--') and '=' in arg])
+    if len(args) != 3 or args[1] != 'has_perm' or 'project' in options:
+        return False
+    user, _, perm = args
+    if 'repo' in options:
+        match = NAME_MATCH.match(options['repo'])
+        if not match:
+            return False
+        return bool(access.has_perm(user, perm,
+            repo='%s/%s.git' % match.groups()))
+    if 'group' in options:
+        return bool(access.has_perm(user, perm, group=options['group']))
+    return False
+
+
+def main():
+    argv = sys.argv[1:]
+    if check_access(argv):
+        sys.exit(0)
+    try:
+        status = request(argv)
+    except socket.error, e:
+        if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+            raise
+        # Daemon is not running, fall back to a cold start.
+        os.execvp(CANNULA_CMD, [CANNULA_CMD] + argv)
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
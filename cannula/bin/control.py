@@ -13,23 +13,40 @@ $SSH_ORIGINAL_COMMAND, usually "git-receive-pack 'myrepo.git'"
 But it could be some following special commands:
 
 * info                                - List out all your projects and groups.
+* deploys --project=[project]         - Recent deployments with phase timings.
+* status [--project=[project]]        - State of the processes of your projects.
 * logs [project]                      - Print out the last few deployment logs.
-* rollback [project] [hash]           - Rollback last deployment, or force 
-                                        'hash' to be deployed.
+* rollback --project=[project]        - Switch a bluegreen project back to
+                                        the release that was live before.
 * create_group [groupname]            - Create new group.
 * create_project [group] [project]    - Create new project in group.
 * django.syncdb [project]             - Run django syncdb command on project.
 
 Which can be run simply thru ssh like so::
 
-    $ ssh cannula@example.com rollback myproject [commithash]
+    $ ssh cannula@example.com rollback --project=myproject
     $ ssh cannula@example.com create_group newgroup
     $ ssh cannula@example.com create_project newgroup newproject
 
+There are also a few commands which do not take a username:
+
+* serve                               - Run the cannula daemon, keeps django
+                                        loaded for `cannula-client` calls.
+* wheelhouse [show|prune]             - Show or prune the shared wheel cache,
+                                        prune takes an optional --max-size.
+* regenerate --all|--project=[project] - Render the configs of every (or one)
+                                        project again after a template change.
+* maintain                            - gc and repack all git repos, run it
+                                        from cron.
+* keys lookup [fingerprint]           - Print the authorized_keys line of a
+                                        key, for sshd's AuthorizedKeysCommand.
+* keys rebuild                        - Write the key store again.
+
 """
 import sys
 import os
 import re
+import time
 
 from optparse import OptionParser
 
@@ -54,12 +71,59 @@ def initialize(user, project):
 
 def deploy(user, project, oldrev, newrev):
     from cannula.api import api
+    from cannula.apis.v2.deploy import SUPERSEDED
     try:
-        api.deploy.deploy(project, user, oldrev, newrev)
+        deployed = api.deploy.deploy(project, user, oldrev, newrev)
     except Exception, e:
         raise
         sys.exit("Error deploying project: %s" % e)
-    sys.exit(0)
+    sys.exit(0 if deployed else SUPERSEDED)
+
+def deploys(user, project):
+    """Print recent deployments of a project and how long each phase took."""
+    from cannula.api import api
+    if not project:
+        sys.exit("Must specify --project!")
+    for deployment in api.deploy.list(project, user):
+        status = 'FAILED' if deployment.failed else 'ok'
+        print "%s  %s  %-12s %-6s %8.2fs" % (
+            deployment.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+            deployment.newrev[:8], deployment.user, status, deployment.duration)
+        for phase in deployment.phases.all():
+            failed = '' if phase.status == 0 else '  (failed)'
+            print "    %-18s %8.2fs%s" % (phase.name, phase.duration, failed)
+
+def rollback(user, project):
+    from cannula.api import api
+    if not project:
+        sys.exit("Must specify --project!")
+    from cannula.apis.v2.deploy import SUPERSEDED
+    try:
+        rolled_back = api.deploy.rollback(project, user)
+    except Exception, e:
+        sys.exit("Error rolling back project: %s" % e)
+    if not rolled_back:
+        sys.stderr.write("A newer push is deployed instead of the rollback\n")
+    sys.exit(0 if rolled_back else SUPERSEDED)
+
+def status(user, project=None):
+    """Print the process status snapshot for the projects of the user."""
+    from cannula.api import api
+    from cannula import status as snapshot
+    if project:
+        projects = [api.projects.get(project)]
+    else:
+        projects = api.projects.list(user=user)
+    projects = [p for p in projects
+        if api.permissions.has_perm(user, 'read', project=p)]
+    current = snapshot.read()
+    if current['error']:
+        print "Warning: %s" % current['error']
+    if snapshot.is_stale(current):
+        print "Warning: status is out of date, is `cannulactl serve` running?"
+    for info in snapshot.processes(projects, current):
+        print "%-20s %-30s %-10s %s" % (info['project'], info['name'],
+            info['statename'], info['description'])
 
 def has_perm(user, perm, group=None, project=None):
     """
@@ -71,7 +135,81 @@ def has_perm(user, perm, group=None, project=None):
         sys.exit(0)
     sys.exit("Access Denied!")
 
-def main():
+def serve():
+    """Run the daemon that cannula-client talks to."""
+    from cannula.daemon import serve
+    serve()
+
+def wheelhouse(action='show', max_size=None):
+    """Show the contents of the shared wheelhouse or prune it."""
+    from cannula.wheelhouse import Wheelhouse
+    house = Wheelhouse()
+    if action == 'prune':
+        if max_size is not None:
+            max_size = int(max_size) * 1024 * 1024
+        removed = house.prune(max_size)
+        for filename in removed:
+            print "Removed: %s" % filename
+        print "Removed %d wheels" % len(removed)
+    elif action != 'show':
+        sys.exit("Unknown wheelhouse action: %s" % action)
+    
+    for filename, info in house.entries():
+        last_used = time.strftime('%Y-%m-%d %H:%M', time.localtime(info['last_used']))
+        print "%8.1f MB  %s  %s" % (info['size'] / 1048576.0, last_used, filename)
+    print "Total: %.1f MB (max %.1f MB)" % (house.size() / 1048576.0,
+        house.max_size / 1048576.0)
+
+def regenerate(project=None, concurrency=None):
+    """Render the configs of all projects (or `project`) again."""
+    from cannula.api import api
+    projects = [project] if project else None
+    if concurrency is not None:
+        concurrency = int(concurrency)
+    results = api.deploy.regenerate(projects, concurrency)
+    for name in sorted(results):
+        print "%-30s %s" % (name, results[name])
+    changed = len([r for r in results.values() if r == 'changed'])
+    print "Regenerated %d projects, %d changed" % (len(results), changed)
+    if [r for r in results.values() if r.startswith('error')]:
+        sys.exit(1)
+
+def maintain(concurrency=None):
+    """Compact all the git repositories."""
+    from cannula.maintenance import maintain
+    if concurrency is not None:
+        concurrency = int(concurrency)
+    reclaimed = 0
+    failed = False
+    for repo in maintain(concurrency=concurrency):
+        if repo.status == 'ok':
+            reclaimed += repo.reclaimed
+            print "%-60s %8.1f MB reclaimed %6.1fs" % (repo.path,
+                repo.reclaimed / 1048576.0, repo.duration)
+        else:
+            failed = failed or repo.status != 'locked'
+            print "%-60s %s" % (repo.path, repo.status)
+    print "Reclaimed %.1f MB" % (reclaimed / 1048576.0)
+    if failed:
+        sys.exit(1)
+
+def keys(action, fingerprint=None):
+    """Look up a key in the key store or rebuild it."""
+    from cannula import keystore
+    if action == 'lookup':
+        if not fingerprint:
+            sys.exit("Must specify a fingerprint!")
+        # Unknown keys print nothing, sshd denies the login then
+        sys.stdout.write(keystore.lookup(fingerprint))
+    elif action == 'rebuild':
+        print "Wrote %d keys" % keystore.rebuild()
+    else:
+        sys.exit("Unknown keys action: %s" % action)
+
+# Commands that are not run on behalf of a user
+SYSTEM_COMMANDS = ['serve', 'wheelhouse', 'regenerate', 'maintain', 'keys']
+
+def main(argv=None):
     parser = OptionParser(__doc__)
     parser.add_option("--settings", dest="settings", help="settings file to use")
     parser.add_option("--project", dest="project", help="project to update")
@@ -79,15 +217,39 @@ def main():
     parser.add_option("--repo", dest="repo", help="repo to update")
     parser.add_option("--oldrev", dest="oldrev", help="Previous revision of repository")
     parser.add_option("--newrev", dest="newrev", help="New revision of repository")
+    parser.add_option("--max-size", dest="max_size", help="Size limit in MB")
+    parser.add_option("--all", dest="all", action="store_true", default=False,
+        help="regenerate every project")
+    parser.add_option("--concurrency", dest="concurrency",
+        help="Number of projects to work on at the same time")
     
-    (options, args) = parser.parse_args()
-    if len(args) < 2:
-        parser.error("incorrect number of arguments")
+    (options, args) = parser.parse_args(argv)
     if options.settings:
         os.environ['DJANGO_SETTINGS_MODULE'] = options.settings
-    else:
+    elif not os.environ.get('DJANGO_SETTINGS_MODULE'):
         os.environ['DJANGO_SETTINGS_MODULE'] = 'cannula.settings'
     
+    if args and args[0] in SYSTEM_COMMANDS:
+        command = args[0]
+        if command == 'serve':
+            return serve()
+        elif command == 'wheelhouse':
+            action = args[1] if len(args) > 1 else 'show'
+            return wheelhouse(action, options.max_size)
+        elif command == 'regenerate':
+            if not (options.all or options.project):
+                parser.error("Must specify --all or --project!")
+            return regenerate(options.project, options.concurrency)
+        elif command == 'maintain':
+            return maintain(options.concurrency)
+        elif command == 'keys':
+            if len(args) < 2:
+                parser.error("Must specify lookup or rebuild!")
+            return keys(args[1], args[2] if len(args) > 2 else None)
+    
+    if len(args) < 2:
+        parser.error("incorrect number of arguments")
+    
     # Parse the group and project from repo or group/project options
     group = None
     project = None
@@ -131,6 +293,15 @@ def main():
         return deploy(user=user, project=project, oldrev=options.oldrev, 
             newrev=options.newrev)
     
+    elif command == 'deploys':
+        return deploys(user=user, project=project)
+    
+    elif command == 'rollback':
+        return rollback(user=user, project=project)
+    
+    elif command == 'status':
+        return status(user=user, project=project)
+    
     elif command == 'has_perm':
         # user has_perm perm --project=project --group=group
         if len(args) > 3:
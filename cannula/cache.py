@@ -0,0 +1,83 @@
+"""
+Cannula Cache
+=============
+
+Versioned keys on top of the django cache. Every cached value lives in
+a namespace with a version number, when the data behind it changes the
+version is bumped and the old keys are never read again, they simply
+expire::
+
+    key = make_key('perms', username)
+    matrix = cache.get(key)
+    ...
+    # in a post_save signal handler
+    bump('perms')
+
+The versions are shared by all processes through the cache, so the
+web server and ``cannulactl`` only see each others changes with a shared
+cache backend (memcached, set in the ``[cache]`` section of the config).
+With the default per process cache a bump in ``cannulactl`` never
+reaches the web server, check `shared` before caching anything that has
+to be invalidated. `local_version` only counts the bumps of this
+process, it is cheap enough to check on every call to drop values
+memoized on an object.
+"""
+
+import time
+
+from django.core.cache import cache
+
+# Seconds a version number is kept in the cache
+VERSION_TIMEOUT = 86400
+
+# Backends that keep the values in the process that set them
+LOCAL_BACKENDS = ('LocMemCache', 'DummyCache')
+
+# namespace -> number of bumps in this process
+_local = {}
+
+
+def shared():
+    """True if every process reads and bumps the same versions."""
+    return cache.__class__.__name__ not in LOCAL_BACKENDS
+
+
+def _version_key(namespace):
+    return 'cannula:%s:version' % namespace
+
+
+def _initial():
+    # Start from the clock, a version that was evicted from the cache
+    # never comes back with a number that was used before.
+    return int(time.time() * 1000)
+
+
+def version(namespace):
+    key = _version_key(namespace)
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, _initial(), VERSION_TIMEOUT)
+        value = cache.get(key)
+        if value is None:
+            # The dummy cache stores nothing, never reuse a key
+            value = _initial()
+    return value
+
+
+def bump(namespace):
+    """Invalidate all keys of `namespace`."""
+    _local[namespace] = _local.get(namespace, 0) + 1
+    try:
+        cache.incr(_version_key(namespace))
+    except ValueError:
+        # Not in the cache, start over
+        cache.set(_version_key(namespace), _initial(), VERSION_TIMEOUT)
+
+
+def local_version(namespace):
+    return _local.get(namespace, 0)
+
+
+def make_key(namespace, *parts):
+    parts = ':'.join([unicode(part) for part in parts])
+    return ('cannula:%s:%s:%s' % (namespace, version(namespace), parts)).encode('utf-8')
@@ -20,6 +20,8 @@ CANNULA_BASE = config.get('cannula', 'base')
 # Proxy client, default options are:
 CANNULA_PROXY_CMD = config.get('proxy', 'cmd')
 CANNULA_PROXY_NEEDS_SUDO = config.getboolean('proxy', 'needs_sudo')
+# Seconds to wait for other deploys to join a proxy reload
+CANNULA_PROXY_RELOAD_WINDOW = config.getfloat('proxy', 'reload_window')
 
 # Process Supervisor Settings
 CANNULA_SUPERVISOR_USE_INET = config.getboolean('proc', 'use_inet')
@@ -27,14 +29,26 @@ CANNULA_SUPERVISOR_INET_PORT = config.get('proc', 'inet_port')
 CANNULA_SUPERVISOR_USER = config.get('proc', 'user')
 CANNULA_SUPERVISOR_PASSWORD = config.get('proc', 'password')
 CANNULA_SUPERVISOR_MANAGES_PROXY = config.getboolean('proc', 'manages_proxy')
+# Seconds to wait for a supervisor xmlrpc call
+CANNULA_SUPERVISOR_TIMEOUT = config.getint('proc', 'timeout')
+# Seconds between process status polls of `cannulactl serve`
+CANNULA_STATUS_INTERVAL = config.getint('proc', 'status_interval')
 
 # Path to 'git' command
 CANNULA_GIT_CMD = config.get('cannula', 'git_cmd') #reese
 
 # Path to cannulactl command
 CANNULA_CMD = config.get('cannula', 'cmd')
+# Path to cannula-client command (talks to `cannulactl serve`)
+CANNULA_CLIENT_CMD = config.get('cannula', 'client_cmd')
 # Path to canner.sh bash script 
 CANNULA_SSH_COMMAND = config.get('cannula', 'ssh_cmd')
+# Update ~/.ssh/authorized_keys of this user when a key changes
+CANNULA_SYNC_AUTHORIZED_KEYS = config.getboolean('cannula', 'sync_authorized_keys')
+
+# Unix socket the `cannulactl serve` daemon listens on
+CANNULA_DAEMON_SOCKET = (config.get('cannula', 'daemon_socket') or
+    os.path.join(CANNULA_BASE, 'cannula.sock'))
 
 # API classes you can override a single one in django settings
 # this dictionary will be updated with the user defined one.
@@ -43,6 +57,21 @@ CANNULA_API = dict(config.items('api'))
 # Lock timeout in seconds
 CANNULA_LOCK_TIMEOUT = config.getint('cannula', 'lock_timeout')
 
+# Seconds a deploy waits in the queue for the running one to finish
+CANNULA_DEPLOY_QUEUE_TIMEOUT = config.getint('cannula', 'deploy_queue_timeout')
+
+# Max size of the shared wheel cache in megabytes
+CANNULA_WHEELHOUSE_MAX_SIZE = config.getint('cannula', 'wheelhouse_max_size')
+
+# Number of old release directories to keep around for each project
+CANNULA_RELEASES_KEEP = config.getint('cannula', 'releases_keep')
+
+# Projects rendered at the same time by `cannulactl regenerate`
+CANNULA_REGENERATE_CONCURRENCY = config.getint('cannula', 'regenerate_concurrency')
+
+# Repositories compacted at the same time by `cannulactl maintain`
+CANNULA_MAINTAIN_CONCURRENCY = config.getint('cannula', 'maintain_concurrency')
+
 def conf_dict():
     """Generate a configuration dict to use in a form."""
     sections = ['django', 'database', 'cannula', 'proxy', 'proc', 'api']
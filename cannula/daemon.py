@@ -0,0 +1,197 @@
+"""
+Cannula Daemon
+==============
+
+Long running ``cannulactl serve`` process. Every git push used to spawn
+``cannulactl`` several times (``has_perm``, ``initialize``, ``deploy``)
+and each one paid for importing django, reading the config and setting
+up the api objects. The daemon does all of that once and then forks a
+child for every request, so the child starts with a warm interpreter.
+
+The protocol is intentionally dumb so the client does not need django:
+
+#. The client sends a single json line: ``{"argv": [...]}``
+#. The server writes the raw stdout/stderr of the command back.
+#. The last thing written is a NULL byte followed by the exit code and
+   a newline. The output may contain NULL bytes itself (a binary diff),
+   only the last one in the stream starts the exit code.
+
+The daemon also runs the `cannula.status.StatusPoller`, which keeps the
+process status snapshot up to date, in a process of its own. The daemon
+forks while the poller may hold the logging or import lock, it must
+not run as a thread next to the children.
+"""
+
+import os
+import re
+import sys
+import json
+import signal
+import socket
+import traceback
+import SocketServer
+from logging import getLogger
+
+from cannula import conf
+from cannula.status import StatusPoller
+
+log = getLogger('cannula.daemon')
+
+# Marks the end of the output, followed by the exit status.
+TRAILER = '\0'
+STATUS = re.compile(r'\0(-?\d+)\n\Z')
+# What could still turn out to be the start of the status
+PARTIAL = re.compile(r'\0-?\d*\n?\Z')
+
+
+def run_command(argv):
+    """Run a cannulactl command and return the exit status."""
+    from cannula.bin import control
+    try:
+        control.main(argv)
+    except SystemExit, e:
+        code = e.code
+        if code is None:
+            return 0
+        if not isinstance(code, int):
+            # sys.exit("message") prints the message and exits with 1
+            sys.stderr.write('%s\n' % code)
+            return 1
+        return code
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+class CommandHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        argv = [str(arg) for arg in request.get('argv', [])]
+        log.info("Running: %s", ' '.join(argv))
+        # We are in a forked child, point stdout and stderr at the
+        # socket so that anything the command (or its subprocesses)
+        # print goes straight back to the client.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        fd = self.connection.fileno()
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        code = run_command(argv)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.wfile.write('%s%d\n' % (TRAILER, code))
+
+
+class CannulaServer(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+    """Fork a warm child for every request."""
+
+
+def warm_up():
+    """Import django and load all the api objects in the parent."""
+    from cannula.api import api, API, LazyAPI
+    for name, lazy in vars(API).items():
+        if isinstance(lazy, LazyAPI):
+            log.debug("Loading api: %s", name)
+            lazy._load()
+    # Children render the config templates from the compiled forms
+    from cannula import render
+    log.debug("Compiled %d templates", render.warm())
+    # Pushes check their access here before the daemon is asked
+    from cannula import access
+    log.debug("Wrote %d access lines", access.rebuild())
+    # and sshd looks up their keys
+    from cannula import keystore
+    log.debug("Wrote %d keys", keystore.rebuild())
+    # Do not share a database connection with the children,
+    # each of them will open their own when they need one.
+    from django.db import connection
+    connection.close()
+    return api
+
+
+def start_poller():
+    """Fork a process that runs the `StatusPoller`, return its pid."""
+    parent = os.getpid()
+    pid = os.fork()
+    if pid:
+        return pid
+    try:
+        StatusPoller(parent=parent).run()
+    finally:
+        os._exit(0)
+
+
+def serve(socket_path=None):
+    """Listen on `socket_path` until killed."""
+    socket_path = socket_path or conf.CANNULA_DAEMON_SOCKET
+    if os.path.exists(socket_path):
+        # Stale socket from a previous run
+        os.remove(socket_path)
+
+    warm_up()
+    poller = start_poller()
+    # Only the cannula user may talk to the daemon, from the moment
+    # the socket exists.
+    umask = os.umask(0077)
+    try:
+        server = CannulaServer(socket_path, CommandHandler)
+    finally:
+        os.umask(umask)
+    os.chmod(socket_path, 0700)
+    log.info("Listening on %s", socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        os.kill(poller, signal.SIGTERM)
+        os.waitpid(poller, 0)
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def request(argv, socket_path=None, out=None):
+    """
+    Send `argv` to the daemon and stream the output to `out`.
+
+    Returns the exit status of the command. Raises socket.error only
+    when the daemon can not be reached, the command was not sent then.
+    """
+    socket_path = socket_path or conf.CANNULA_DAEMON_SOCKET
+    out = out or sys.stdout
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        raise
+    pending = ''
+    try:
+        sock.sendall(json.dumps({'argv': argv}) + '\n')
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            pending += data
+            # Stream everything but a possible status at the end
+            cut = pending.rfind(TRAILER)
+            if cut == -1 or not PARTIAL.match(pending, cut):
+                cut = len(pending)
+            if cut:
+                out.write(pending[:cut])
+                out.flush()
+                pending = pending[cut:]
+    except socket.error, e:
+        # The command may be running already, it must not run twice
+        sys.stderr.write("Lost connection to the cannula daemon: %s\n" % e)
+    finally:
+        sock.close()
+
+    match = STATUS.match(pending)
+    if match is None:
+        # Connection dropped before the command finished
+        out.write(pending)
+        out.flush()
+        return 1
+    return int(match.group(1))
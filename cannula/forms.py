@@ -74,6 +74,8 @@ class SettingsForm(forms.Form):
         help_text="Base Directory that cannula manages, must be writable by cannula user.")
     cannula_cmd= forms.CharField(
         help_text="Path to cannulactl command.")
+    cannula_client_cmd= forms.CharField(
+        help_text="Path to cannula-client command, talks to 'cannulactl serve'.")
     cannula_ssh_cmd=forms.CharField(
         help_text="Path to canner.sh, used in authorized_keys to handle authorization.")
     cannula_git_cmd=forms.CharField(
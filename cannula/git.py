@@ -1,6 +1,29 @@
+import os
 
 from cannula.conf import CANNULA_GIT_CMD
-from cannula.utils import shell
+from cannula.process import run
+
+
+def format_changes(changes):
+    """Show (status, path) changes like `git status -s` does."""
+    return '\n'.join('%s %s' % change for change in changes)
+
+
+class Snapshot(object):
+    """What `Git.snapshot` committed."""
+    
+    def __init__(self, oldrev):
+        self.oldrev = oldrev
+        self.newrev = oldrev
+        # (status, path) of the committed files
+        self.changes = []
+        self.diff = ''
+        self.output = ''
+        self.ok = True
+    
+    @property
+    def changed(self):
+        return self.newrev != self.oldrev
 
 
 class Git(object):
@@ -13,45 +36,129 @@ class Git(object):
     
     We store changes to the configs in git in order to allow rollbacks
     and to show history of changes, you know like in your code!
+    
+    Git is run without a shell and only when it has to write something,
+    HEAD and the refs are read straight from the git directory.
     """
     
     def __init__(self, directory):
         self.directory = directory
     
-    def _exec(self, cmd, **kwargs):
-        options = {'git': CANNULA_GIT_CMD}
-        options.update(kwargs)
-        return shell(cmd % options, cwd=self.directory)
+    @property
+    def git_dir(self):
+        git_dir = os.path.join(self.directory, '.git')
+        if os.path.isdir(git_dir):
+            return git_dir
+        # Bare repository
+        return self.directory
+    
+    def _run(self, *args):
+        return run([CANNULA_GIT_CMD] + list(args), cwd=self.directory)
+    
+    def _exec(self, *args):
+        result = self._run(*args)
+        if result.ok:
+            return result.status, result.stdout + result.stderr
+        return result.status, result.stderr + result.stdout
+    
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.git_dir, name)) as f:
+                return f.read().strip()
+        except IOError:
+            return None
     
     def init(self):
-        return self._exec('%(git)s init')
+        return self._exec('init')
     
     def add_all(self):
-        return self._exec('%(git)s add --all')
+        return self._exec('add', '--all')
     
     def reset(self, revision=''):
-        return self._exec('%(git)s reset --hard %(revision)s', revision=revision)
+        if revision:
+            return self._exec('reset', '--hard', revision)
+        return self._exec('reset', '--hard')
+    
+    def changes(self):
+        """List of (status, path) of every change in the work tree."""
+        _, output = self._exec('status', '--porcelain')
+        changes = []
+        for line in output.splitlines():
+            if len(line) > 3:
+                changes.append((line[:2].strip(), line[3:]))
+        return changes
     
     def new_files(self):
-        return self._exec("%(git)s status -s |awk '/A/ {print $2}'")
+        names = [path for status, path in self.changes() if 'A' in status]
+        return 0, '\n'.join(names)
     
     def modified_files(self):
-        return self._exec("%(git)s status -s |awk '/M/ {print $2}'")
+        names = [path for status, path in self.changes() if 'M' in status]
+        return 0, '\n'.join(names)
     
     def status(self):
-        return self._exec('%(git)s status -s')
+        return self._exec('status', '-s')
+    
+    def packed_refs(self):
+        refs = {}
+        for line in (self._read('packed-refs') or '').splitlines():
+            if line.startswith('#') or line.startswith('^'):
+                continue
+            parts = line.split(' ', 1)
+            if len(parts) == 2:
+                refs[parts[1]] = parts[0]
+        return refs
+    
+    def ref(self, name):
+        """Hash the ref `name` points to, '' if it does not exist yet."""
+        # Follow symbolic refs like HEAD -> refs/heads/master
+        for _ in range(5):
+            value = self._read(name)
+            if value is None:
+                value = self.packed_refs().get(name)
+            if not value:
+                return ''
+            if not value.startswith('ref: '):
+                return value
+            name = value[5:]
+        return ''
     
     def head(self):
-        _, head = self._exec("%(git)s log -1 --pretty=oneline |awk '{print $1}'")
-        return head
+        return self.ref('HEAD')
     
     def commit(self, message):
-        return self._exec("%(git)s commit -m '%(message)s'", message=message)
+        return self._exec('commit', '-m', message)
     
     def diff(self):
-        return self._exec("%(git)s diff")
+        return self._exec('diff')
+    
+    def staged(self):
+        """Return the (status, path) of the staged changes and their diff."""
+        _, output = self._exec('diff', '--cached', '--raw', '-p', '--no-color')
+        changes = []
+        lines = output.splitlines(True)
+        while lines and lines[0].startswith(':'):
+            meta, path = lines.pop(0).rstrip('\n').split('\t', 1)
+            # Renames list the old and the new path
+            changes.append((meta.split()[-1][0], path.split('\t')[-1]))
+        return changes, ''.join(lines).lstrip('\n')
+    
+    def snapshot(self, message):
+        """
+        Stage every change in the work tree and commit it. Returns a
+        `Snapshot`, nothing is committed if there were no changes.
+        """
+        snapshot = Snapshot(self.head())
+        self.add_all()
+        snapshot.changes, snapshot.diff = self.staged()
+        if not snapshot.changes:
+            return snapshot
+        code, snapshot.output = self.commit(message)
+        snapshot.ok = code == 0
+        snapshot.newrev = self.head()
+        return snapshot
     
     def push(self, location, branch="master"):
-        return self._exec("%(git)s push %(location)s %(branch)s", location=location, branch=branch)
+        return self._exec('push', location, branch)
     
     
\ No newline at end of file
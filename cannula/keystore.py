@@ -0,0 +1,199 @@
+"""
+Key Store
+=========
+
+sshd reads ``~/.ssh/authorized_keys`` from top to bottom on every login,
+with thousands of keys that is a lot of parsing for a single ``git push``.
+Instead sshd can ask ``cannulactl keys lookup`` for the one key that is
+offered (see ``AuthorizedKeysCommand`` in the install docs), which reads
+it from a directory indexed by the fingerprint of the key::
+
+    CANNULA_BASE/keys
+        3f9d...e1          # authorized_keys line of the key(s)
+        ids/
+            42             # fingerprint and line of the Key with pk 42
+
+The fingerprint is the hex sha256 of the key blob, `lookup` also takes
+the ``SHA256:...`` form sshd passes for ``%f``. When two users add the
+same key both lines are kept and sshd uses the first one.
+
+The store is rebuilt when ``cannulactl serve`` starts and kept in sync
+with the `Key` saves and deletes by the signals in `cannula.models`.
+Only `line` needs django, lookups just read one file.
+"""
+
+import os
+import re
+import fcntl
+import hashlib
+from base64 import b64decode
+
+from cannula import conf
+
+HEX_MATCH = re.compile('^[0-9a-f]{64}$')
+
+
+def store_path():
+    return os.path.join(conf.CANNULA_BASE, 'keys')
+
+
+def fingerprint(ssh_key):
+    """Hex sha256 of the blob of the public key `ssh_key`."""
+    parts = ssh_key.split()
+    # 'ssh-rsa AAAA... comment' or just the base64 blob
+    blob = parts[1] if len(parts) > 1 else parts[0]
+    return hashlib.sha256(b64decode(blob)).hexdigest()
+
+
+def normalize(value):
+    """
+    Return the hex fingerprint of `value`, which is a hex fingerprint,
+    a ``SHA256:`` fingerprint or the public key itself.
+    """
+    value = value.strip()
+    if value.startswith('SHA256:'):
+        encoded = value[7:]
+        encoded += '=' * (-len(encoded) % 4)
+        try:
+            digest = b64decode(encoded)
+        except TypeError:
+            return None
+        # b64decode skips characters that are not base64
+        if len(digest) != 32:
+            return None
+        return digest.encode('hex')
+    if HEX_MATCH.match(value.lower()):
+        return value.lower()
+    try:
+        return fingerprint(value)
+    except (TypeError, IndexError):
+        return None
+
+
+def lookup(value, path=None):
+    """Return the authorized_keys line(s) of the key `value` or ''."""
+    fp = normalize(value)
+    if fp is None:
+        return ''
+    try:
+        with open(os.path.join(path or store_path(), fp)) as f:
+            return f.read()
+    except IOError:
+        return ''
+
+
+def line(key):
+    """The authorized_keys line of the `Key` instance `key`."""
+    from cannula.render import render
+    ctx = {'key': key, 'cannula_cmd': conf.CANNULA_SSH_COMMAND}
+    return render('cannula/authorized_key.txt', ctx).strip()
+
+
+def _locked(path):
+    lock = open(os.path.join(path, '.lock'), 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+
+def _prepare(path):
+    """Create the store, False if there is no CANNULA_BASE to put it in."""
+    if not os.path.isdir(os.path.dirname(path)):
+        return False
+    ids = os.path.join(path, 'ids')
+    if not os.path.isdir(ids):
+        os.makedirs(ids)
+    return True
+
+
+def _read(file_name):
+    try:
+        with open(file_name) as f:
+            return f.read().splitlines()
+    except IOError:
+        return []
+
+
+def _write_lines(file_name, lines):
+    from cannula.utils import write_content
+    if lines:
+        write_content(file_name, '\n'.join(lines) + '\n')
+    elif os.path.isfile(file_name):
+        os.remove(file_name)
+
+
+def _remove(path, key_id):
+    """Remove the line of `key_id` from its fingerprint file."""
+    id_file = os.path.join(path, 'ids', str(key_id))
+    entry = _read(id_file)
+    if len(entry) < 2:
+        return
+    fp, old = entry[0], entry[1]
+    fp_file = os.path.join(path, fp)
+    lines = _read(fp_file)
+    if old in lines:
+        lines.remove(old)
+    _write_lines(fp_file, lines)
+    os.remove(id_file)
+
+
+def add(key, path=None):
+    """Add or update the `Key` instance `key`."""
+    path = path or store_path()
+    if not _prepare(path):
+        return
+    fp = fingerprint(key.ssh_key)
+    new = line(key).encode('utf-8')
+    lock = _locked(path)
+    try:
+        id_file = os.path.join(path, 'ids', str(key.pk))
+        if _read(id_file) == [fp, new]:
+            return
+        _remove(path, key.pk)
+        fp_file = os.path.join(path, fp)
+        _write_lines(fp_file, _read(fp_file) + [new])
+        _write_lines(id_file, [fp, new])
+    finally:
+        lock.close()
+
+
+def remove(key_id, path=None):
+    """Remove the key with the primary key `key_id`."""
+    path = path or store_path()
+    if not os.path.isdir(path):
+        return
+    lock = _locked(path)
+    try:
+        _remove(path, key_id)
+    finally:
+        lock.close()
+
+
+def rebuild(path=None):
+    """Write the whole store, returns the number of keys."""
+    from cannula.models import Key
+    path = path or store_path()
+    if not _prepare(path):
+        return 0
+    lock = _locked(path)
+    try:
+        fingerprints = {}
+        ids = {}
+        for key in Key.objects.select_related('user').order_by('pk').iterator():
+            fp = fingerprint(key.ssh_key)
+            new = line(key).encode('utf-8')
+            fingerprints.setdefault(fp, []).append(new)
+            ids[str(key.pk)] = [fp, new]
+        for fp, lines in fingerprints.items():
+            _write_lines(os.path.join(path, fp), lines)
+        for key_id, entry in ids.items():
+            _write_lines(os.path.join(path, 'ids', key_id), entry)
+        # Drop what is left of deleted keys
+        for name in os.listdir(path):
+            if HEX_MATCH.match(name) and name not in fingerprints:
+                os.remove(os.path.join(path, name))
+        for name in os.listdir(os.path.join(path, 'ids')):
+            if name not in ids:
+                os.remove(os.path.join(path, 'ids', name))
+    finally:
+        lock.close()
+    return len(ids)
@@ -0,0 +1,153 @@
+"""
+Cannula Maintenance
+===================
+
+Every push adds loose objects to the bare repo of a project and every
+deploy commits to its conf repo, nothing ever packs them. Run
+``cannulactl maintain`` from cron to compact all the repositories::
+
+    CANNULA_BASE/repos/(group)/(project).git
+    CANNULA_BASE/config/(project)/
+    CANNULA_BASE/proxy/
+    CANNULA_BASE/proc/
+
+Each repo is garbage collected and repacked into a single pack with a
+bitmap index, then a commit-graph is written. `maintain_concurrency`
+repos are done at the same time. A project that is being deployed is
+skipped, it will be done on the next run.
+"""
+
+import os
+import time
+from multiprocessing.pool import ThreadPool
+from logging import getLogger
+
+from cannula import conf
+from cannula.process import run
+
+log = getLogger('cannula.maintenance')
+
+
+class Repo(object):
+    """A repository to maintain, `project` is set for project repos."""
+
+    def __init__(self, path, project=None, bare=False):
+        self.path = path
+        self.project = project
+        self.bare = bare
+        self.git_dir = path if bare else os.path.join(path, '.git')
+        # Filled in by `maintain`
+        self.status = None
+        self.before = 0
+        self.after = 0
+        self.duration = 0
+
+    @property
+    def reclaimed(self):
+        return self.before - self.after
+
+    def __repr__(self):
+        return '<Repo %s: %s>' % (self.path, self.status)
+
+
+def objects_size(git_dir):
+    """Bytes of disk used by the objects of the repository."""
+    total = 0
+    for root, dirs, files in os.walk(os.path.join(git_dir, 'objects')):
+        for name in files:
+            try:
+                # Loose objects are tiny, count the blocks they take up
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                # Removed by a gc in the meantime
+                pass
+    return total
+
+
+def repositories(projects=None):
+    """All repositories under CANNULA_BASE that exist."""
+    from cannula.api import api
+    if projects is None:
+        projects = api.projects.list().select_related('group')
+    repos = []
+    for project in projects:
+        repos.append(Repo(project.repo_dir, project, bare=True))
+        repos.append(Repo(project.conf_dir, project))
+    for configurable in (api.proxy, api.proc):
+        repos.append(Repo(configurable.conf_base))
+    return [repo for repo in repos if os.path.isdir(repo.git_dir)]
+
+
+def _git(repo, *args):
+    cmd = [conf.CANNULA_GIT_CMD, '--git-dir=%s' % repo.git_dir] + list(args)
+    result = run(cmd)
+    if not result.ok:
+        raise Exception("%s: %s" % (' '.join(args), result.output.strip()))
+    return result
+
+
+def _compact(repo):
+    start = time.time()
+    repo.before = objects_size(repo.git_dir)
+    # gc packs the loose objects, prunes the unreachable ones and
+    # packs the refs. Its repack writes the bitmap index.
+    _git(repo, '-c', 'repack.writeBitmaps=true', 'gc', '--quiet')
+    _git(repo, 'commit-graph', 'write', '--reachable')
+    repo.after = objects_size(repo.git_dir)
+    repo.duration = time.time() - start
+    repo.status = 'ok'
+    log.info("Maintained %s in %.1fs, reclaimed %d bytes", repo.path,
+        repo.duration, repo.reclaimed)
+
+
+def maintain_repo(repo):
+    """Compact `repo` unless its project is being deployed."""
+    from cannula.apis.v2.deploy import deploy_lock
+    try:
+        if repo.project is None:
+            _compact(repo)
+            return repo
+        with deploy_lock(repo.project) as locked:
+            if locked and not repo.bare:
+                # Deploys commit to the conf repo, they wait for us
+                _compact(repo)
+        if not locked:
+            repo.status = 'locked'
+        elif repo.bare:
+            # Pushes do not take the deploy lock and gc is safe next to
+            # them, do not keep a deploy waiting on a big repo.
+            _compact(repo)
+    except Exception, e:
+        log.exception("Error maintaining %s", repo.path)
+        repo.status = 'failed: %s' % e
+    return repo
+
+
+def _maintain_all(repos):
+    return [maintain_repo(repo) for repo in repos]
+
+
+def maintain(repos=None, concurrency=None):
+    """Maintain `repos` (default all of them), return them with results."""
+    if repos is None:
+        repos = repositories()
+    concurrency = concurrency or conf.CANNULA_MAINTAIN_CONCURRENCY
+    # The repos of a project are done one after the other, the one
+    # holding the deploy lock would make the other look locked.
+    batches = []
+    projects = {}
+    for repo in repos:
+        if repo.project is None:
+            batches.append([repo])
+        elif repo.project in projects:
+            projects[repo.project].append(repo)
+        else:
+            projects[repo.project] = [repo]
+            batches.append(projects[repo.project])
+    pool = ThreadPool(concurrency)
+    try:
+        pool.map(_maintain_all, batches)
+    finally:
+        pool.close()
+        pool.join()
+    return list(repos)
@@ -1,12 +1,17 @@
 from datetime import datetime
+from logging import getLogger
 import re
 from base64 import b64decode
 
 from django.db import models
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from django.db.models.signals import post_save, post_delete
 import os
 from cannula import conf
+from cannula import cache
+from cannula import access
+from cannula import keystore
 
 PROJECT_RE = re.compile('^[a-zA-Z][-_a-zA-Z0-9]*$')
 
@@ -138,23 +143,38 @@ class Project(models.Model):
         directory = '%s/%s.git' % (self.group.name, self.name)
         return os.path.join(conf.CANNULA_BASE, 'repos', directory)
     
+    @property
+    def releases_dir(self):
+        """Holds a directory for every revision that was deployed."""
+        directory = '%s/%s' % (self.group.name, self.name)
+        return os.path.join(conf.CANNULA_BASE, 'releases', directory)
+    
+    @property
+    def current_release(self):
+        """Symlink to the release that is live."""
+        return os.path.join(self.releases_dir, 'current')
+    
     @property
     def project_dir(self):
-        """Actual working directory of the project code. Code is checked
-        out here after a push.
+        """Actual working directory of the project code. This is the
+        code of the current release, processes are started here.
         """
-        directory = '%s/%s' % (self.group.name, self.name)
-        return os.path.join(conf.CANNULA_BASE, 'repos', directory)
+        return os.path.join(self.current_release, 'code')
     
     @property
     def conf_dir(self):
         """Project configuration directory."""
         return os.path.join(conf.CANNULA_BASE, 'config', self.name)
     
+    @property
+    def lock_dir(self):
+        """Deploy lock and queue, kept out of the conf_dir git repo."""
+        return os.path.join(conf.CANNULA_BASE, 'locks', self.name)
+    
     @property
     def virtualenv(self):
-        """Project specific environment."""
-        return os.path.join(self.conf_dir, 'venv')
+        """Project specific environment of the current release."""
+        return os.path.join(self.current_release, 'venv')
         
     @property
     def appconfig(self):
@@ -244,4 +264,108 @@ class Deployment(models.Model):
         app_label = "cannula"
     
     def __unicode__(self):
-        return "Deployment of: %s @ %s" % (self.project, self.newrev)
\ No newline at end of file
+        return "Deployment of: %s @ %s" % (self.project, self.newrev)
+    
+    @property
+    def duration(self):
+        """Total wall time of all the phases in seconds."""
+        return sum([phase.duration for phase in self.phases.all()])
+    
+    @property
+    def failed(self):
+        return any([phase.status != 0 for phase in self.phases.all()])
+
+class DeploymentPhase(models.Model):
+    """Wall time and exit status of a single step of a deployment."""
+    deployment = models.ForeignKey(Deployment, related_name='phases')
+    name = models.CharField(max_length=100)
+    position = models.IntegerField(default=0)
+    duration = models.FloatField(help_text="Wall time in seconds")
+    status = models.IntegerField(default=0)
+    
+    class Meta:
+        app_label = "cannula"
+        ordering = ('deployment', 'position')
+    
+    def __unicode__(self):
+        return "%s: %.2fs" % (self.name, self.duration)
+
+
+def invalidate_permissions(sender, **kwargs):
+    """Memberships, groups or projects changed, drop cached permissions."""
+    cache.bump('perms')
+
+for model in (GroupMembership, ProjectGroup, Project):
+    post_save.connect(invalidate_permissions, sender=model,
+        dispatch_uid='perms_save_%s' % model.__name__)
+    post_delete.connect(invalidate_permissions, sender=model,
+        dispatch_uid='perms_delete_%s' % model.__name__)
+
+
+def update_access(sender, instance, **kwargs):
+    """Keep the access table of the ssh push path up to date."""
+    try:
+        if sender in (GroupMembership, Key):
+            users = User.objects.filter(pk=instance.user_id)
+            access.update(users.values_list('username', flat=True))
+        elif sender is User:
+            access.update([instance.username])
+        else:
+            group_id = instance.pk if sender is ProjectGroup else instance.group_id
+            members = GroupMembership.objects.filter(group=group_id)
+            users = set(members.values_list('user__username', flat=True))
+            if sender is Project:
+                # Members of the group a project was moved away from
+                users |= access.users_of(u'/%s.git' % instance.name)
+            access.update(users)
+    except Exception:
+        # Never fail the save, but never answer from a stale table
+        getLogger('cannula.access').exception("Error updating the access table")
+        access.invalidate()
+
+for model in (GroupMembership, ProjectGroup, Project, Key):
+    post_save.connect(update_access, sender=model,
+        dispatch_uid='access_save_%s' % model.__name__)
+    post_delete.connect(update_access, sender=model,
+        dispatch_uid='access_delete_%s' % model.__name__)
+post_delete.connect(update_access, sender=User, dispatch_uid='access_delete_User')
+
+def update_keystore(sender, instance, **kwargs):
+    """Keep the key store of `cannulactl keys lookup` up to date."""
+    try:
+        if kwargs['signal'] is post_delete:
+            keystore.remove(instance.pk)
+        else:
+            keystore.add(instance)
+    except Exception:
+        # Never fail the save, the store is rebuilt on the next start
+        getLogger('cannula.keystore').exception("Error updating the key store")
+
+post_save.connect(update_keystore, sender=Key, dispatch_uid='keystore_save')
+post_delete.connect(update_keystore, sender=Key, dispatch_uid='keystore_delete')
+
+def update_authorized_keys(sender, instance, **kwargs):
+    """Add or remove the line of `instance` from ~/.ssh/authorized_keys."""
+    if not conf.CANNULA_SYNC_AUTHORIZED_KEYS:
+        return
+    from cannula.api import api
+    try:
+        if kwargs['signal'] is post_delete:
+            api.keys.update_keys(removed=[instance])
+        elif kwargs.get('created'):
+            api.keys.update_keys(added=[instance])
+        else:
+            # The old line is gone, write the whole file
+            api.keys.write_keys()
+    except Exception:
+        log = getLogger('api.keys')
+        log.exception("Error updating authorized_keys, writing all keys")
+        try:
+            api.keys.write_keys()
+        except Exception:
+            log.exception("Error writing authorized_keys")
+
+post_save.connect(update_authorized_keys, sender=Key,
+    dispatch_uid='authorized_keys_save')
+post_delete.connect(update_authorized_keys, sender=Key,
+    dispatch_uid='authorized_keys_delete')
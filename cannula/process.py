@@ -0,0 +1,221 @@
+"""
+Cannula Processes
+=================
+
+Every external command cannula runs goes through here. A command is
+either a list, run without a shell, or a string run by ``/bin/sh`` for
+the callers that need pipes. Any number of commands can run at the
+same time from one thread, their pipes are read with select so a
+chatty child never blocks on a full pipe::
+
+    compiling = spawn(['python', '-m', 'compileall', '-q', code_dir])
+    run('pip install -r requirements.txt', stream=sys.stderr)
+    compiling.wait()
+
+Each command can have a deadline (`timeout` in seconds) after which it
+is killed. The `Result` holds the exit status, output, wall time and
+the resource usage of the command (cpu time and max rss from wait4).
+"""
+
+import os
+import time
+import fcntl
+import select
+import signal
+from logging import getLogger
+from subprocess import Popen, PIPE
+
+log = getLogger('cannula.process')
+
+
+class Result(object):
+    """Outcome of a command."""
+
+    def __init__(self, cmd, name=None):
+        self.cmd = cmd
+        self.name = name
+        self.status = None
+        self.stdout = ''
+        self.stderr = ''
+        # stdout and stderr in the order they arrived
+        self.output = ''
+        self.duration = 0
+        self.timed_out = False
+        self.utime = 0
+        self.stime = 0
+        # kilobytes on linux
+        self.maxrss = 0
+
+    @property
+    def ok(self):
+        return self.status == 0
+
+    def __iter__(self):
+        # Unpacks like the (returncode, output) tuples we used to return
+        return iter((self.status, self.output))
+
+    def __repr__(self):
+        return '<Result %s: %s>' % (self.name or self.cmd, self.status)
+
+
+class Process(object):
+    """
+    A running command, use `Process.wait` or `wait_all` to collect it.
+
+    Output lines are written to `stream` as they arrive when it is
+    given, prefixed with ``[name]`` when `name` is set.
+    """
+
+    def __init__(self, cmd, cwd=None, env=None, timeout=None, name=None,
+            stream=None):
+        self.result = Result(cmd, name)
+        self.name = name
+        self.stream = stream
+        self.started = time.time()
+        self.deadline = self.started + timeout if timeout else None
+        self.timeout = timeout
+        shell = isinstance(cmd, basestring)
+        if shell:
+            cmd = cmd.strip()
+        log.debug("Running: %s", cmd)
+        # Own process group so a timeout also kills what a shell started
+        preexec = os.setpgrp if timeout else None
+        self.proc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=shell,
+            cwd=cwd, env=env, preexec_fn=preexec)
+        self.pid = self.proc.pid
+        # fd -> [kind, chunks, partial line, file]
+        self.pipes = {}
+        self.output = []
+        for kind, pipe in (('stdout', self.proc.stdout), ('stderr', self.proc.stderr)):
+            fd = pipe.fileno()
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self.pipes[fd] = [kind, [], '', pipe]
+
+    @property
+    def done(self):
+        return self.result.status is not None
+
+    def fds(self):
+        return self.pipes.keys()
+
+    def _emit(self, line):
+        if self.name:
+            line = '[%s] %s' % (self.name, line)
+        self.stream.write(line)
+        self.stream.flush()
+
+    def read(self, fd):
+        """Read what is available on `fd`, reap the process at the end."""
+        pipe = self.pipes[fd]
+        data = os.read(fd, 65536)
+        if data:
+            pipe[1].append(data)
+            self.output.append(data)
+            if self.stream is not None:
+                lines = (pipe[2] + data).split('\n')
+                for line in lines[:-1]:
+                    self._emit(line + '\n')
+                pipe[2] = lines[-1]
+            return
+        if pipe[2]:
+            self._emit(pipe[2] + '\n')
+        pipe[3].close()
+        del self.pipes[fd]
+        setattr(self.result, pipe[0], ''.join(pipe[1]))
+        if not self.pipes:
+            self.reap()
+
+    def expire(self, now):
+        """Kill the command if it is past its deadline."""
+        if self.deadline is None or self.result.timed_out or now < self.deadline:
+            return
+        log.warning("Command timed out after %ss: %s", self.timeout, self.result.cmd)
+        self.result.timed_out = True
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def reap(self):
+        _, status, rusage = os.wait4(self.pid, 0)
+        if os.WIFSIGNALED(status):
+            code = -os.WTERMSIG(status)
+        else:
+            code = os.WEXITSTATUS(status)
+        # Popen must not try to wait for it again
+        self.proc.returncode = code
+        result = self.result
+        result.status = code
+        result.output = ''.join(self.output)
+        result.duration = time.time() - self.started
+        result.utime = rusage.ru_utime
+        result.stime = rusage.ru_stime
+        result.maxrss = rusage.ru_maxrss
+        log.debug("Finished %s: status %s, %.2fs wall, %.2fs cpu, %d KB max rss",
+            result.cmd, code, result.duration, result.utime + result.stime,
+            result.maxrss)
+
+    def wait(self):
+        return wait_all([self])[0]
+
+
+def _step(processes):
+    """Wait for output (or a deadline) of the running `processes`."""
+    fds = {}
+    deadlines = []
+    for process in processes:
+        for fd in process.fds():
+            fds[fd] = process
+        if process.deadline and not process.result.timed_out:
+            deadlines.append(process.deadline)
+    wait = None
+    if deadlines:
+        wait = max(min(deadlines) - time.time(), 0)
+    readable, _, _ = select.select(fds.keys(), [], [], wait)
+    for fd in readable:
+        fds[fd].read(fd)
+    now = time.time()
+    for process in processes:
+        if not process.done:
+            process.expire(now)
+
+
+def wait_all(processes):
+    """Wait for all `processes` and return their results in order."""
+    while True:
+        running = [process for process in processes if not process.done]
+        if not running:
+            break
+        _step(running)
+    return [process.result for process in processes]
+
+
+def spawn(cmd, **kwargs):
+    """Start `cmd` in the background, see `Process` for the arguments."""
+    return Process(cmd, **kwargs)
+
+
+def run(cmd, **kwargs):
+    """Run `cmd` and return its `Result`."""
+    return spawn(cmd, **kwargs).wait()
+
+
+def run_all(cmds, concurrency=4, names=None, **kwargs):
+    """
+    Run `cmds` with at most `concurrency` of them at the same time and
+    return their results in the same order.
+    """
+    names = names or [str(i) for i in range(len(cmds))]
+    pending = zip(cmds, names)
+    processes = []
+    running = []
+    while pending or running:
+        while pending and len(running) < concurrency:
+            cmd, name = pending.pop(0)
+            process = spawn(cmd, name=name, **kwargs)
+            processes.append(process)
+            running.append(process)
+        _step(running)
+        running = [process for process in running if not process.done]
+    return [process.result for process in processes]
@@ -0,0 +1,178 @@
+"""
+Cannula Releases
+================
+
+Every deploy is built into its own immutable release directory and the
+processes are started from a `current` symlink that is only switched
+once the build succeeded::
+
+    CANNULA_BASE/releases/(group)/(project)/
+        current -> 68f7abf4e6f922807889f52bc043ecd31b79f814
+        68f7abf4e6f922807889f52bc043ecd31b79f814/
+            code/   # git archive of the pushed revision
+            venv/   # virtualenv, hard linked from the previous release
+        aa453216d1b3e49e7f6f98441fa56946ddcd6a20/
+            ...
+
+A `Release` has the same `project_dir`, `virtualenv` and `appconfig`
+attributes as a `Project` so it can be handed to the runtimes.
+"""
+
+import os
+import shutil
+from logging import getLogger
+
+from cannula import conf
+from cannula.conf import CANNULA_GIT_CMD
+from cannula.utils import shell
+
+log = getLogger('cannula.releases')
+
+# Name of the empty release created when a project is initialized.
+INITIAL = 'initial'
+
+
+class Release(object):
+
+    def __init__(self, project, rev):
+        self.project = project
+        self.rev = rev
+        self.path = os.path.join(project.releases_dir, rev)
+        self.project_dir = os.path.join(self.path, 'code')
+        self.virtualenv = os.path.join(self.path, 'venv')
+        self.appconfig = os.path.join(self.project_dir, 'app.yaml')
+
+    def __str__(self):
+        return '%s@%s' % (self.project, self.rev[:8])
+
+    def __eq__(self, other):
+        return isinstance(other, Release) and self.path == other.path
+
+    def __ne__(self, other):
+        return not self == other
+
+    def exists(self):
+        return os.path.isdir(self.project_dir)
+
+    def create(self, previous=None):
+        """
+        Export the code for this revision and seed the virtualenv with
+        hard links to the one in the `previous` release.
+        """
+        if os.path.isdir(self.path):
+            # Left over from a failed build, start clean.
+            shutil.rmtree(self.path)
+        os.makedirs(self.project_dir)
+        log.info("Creating release %s", self)
+        cmd = '%s --git-dir=%s archive --format=tar %s | tar -x -C %s'
+        status, output = shell(cmd % (CANNULA_GIT_CMD, self.project.repo_dir,
+            self.rev, self.project_dir))
+        if status != 0:
+            shutil.rmtree(self.path)
+            raise Exception("Could not export %s: %s" % (self, output))
+
+        if previous is not None and os.path.isdir(previous.virtualenv):
+            log.info("Linking virtualenv from %s", previous)
+            link_virtualenv(previous.virtualenv, self.virtualenv)
+
+    def activate(self):
+        """Atomically point the `current` symlink at this release."""
+        current = self.project.current_release
+        tmp = '%s.tmp' % current
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(self.rev, tmp)
+        os.rename(tmp, current)
+        log.info("Activated release %s", self)
+
+    def remove(self):
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+
+
+def initialize(project):
+    """Create the releases directory with an empty initial release."""
+    if os.path.lexists(project.current_release):
+        return
+    release = Release(project, INITIAL)
+    if not release.exists():
+        os.makedirs(release.project_dir)
+    release.activate()
+
+
+def current(project):
+    """Return the live release of the project or None."""
+    if not os.path.islink(project.current_release):
+        return None
+    return Release(project, os.readlink(project.current_release))
+
+
+def history(project):
+    """All releases of the project, oldest first."""
+    if not os.path.isdir(project.releases_dir):
+        return []
+    releases = []
+    for name in os.listdir(project.releases_dir):
+        path = os.path.join(project.releases_dir, name)
+        if os.path.islink(path) or not os.path.isdir(path):
+            continue
+        releases.append((os.path.getmtime(path), Release(project, name)))
+    return [release for _, release in sorted(releases)]
+
+
+def prune(project, keep=None, pinned=()):
+    """
+    Remove all but the last `keep` releases, never the live one or
+    any of the `pinned` releases.
+    """
+    if keep is None:
+        keep = conf.CANNULA_RELEASES_KEEP
+    live = current(project)
+    old = history(project)[:-keep] if keep else history(project)
+    for release in old:
+        if release == live or release in pinned:
+            continue
+        log.info("Removing old release %s", release)
+        release.remove()
+
+
+def link_virtualenv(src, dst):
+    """
+    Copy the virtualenv `src` to `dst` using hard links for the
+    installed packages. Scripts and .pth files are copied instead and
+    the old path is rewritten, so they can be changed safely in the
+    new release without touching the live one.
+    """
+    lib = os.path.join(src, 'lib')
+    for root, dirs, files in os.walk(src):
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+        if not os.path.isdir(target_root):
+            os.makedirs(target_root)
+        for name in dirs + files:
+            source = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            if os.path.islink(source):
+                link = os.readlink(source)
+                if link.startswith(src):
+                    link = dst + link[len(src):]
+                os.symlink(link, target)
+                if name in dirs:
+                    # os.walk does not follow links, it is copied now.
+                    dirs.remove(name)
+            elif name in dirs:
+                continue
+            elif source.startswith(lib) and not name.endswith('.pth'):
+                os.link(source, target)
+            else:
+                _copy_relocated(source, target, src, dst)
+
+
+def _copy_relocated(source, target, src, dst):
+    with open(source, 'rb') as f:
+        content = f.read()
+    if '\0' not in content:
+        # Text file (scripts, activate, .pth) fix up the paths.
+        content = content.replace(src, dst)
+    with open(target, 'wb') as f:
+        f.write(content)
+    shutil.copymode(source, target)
@@ -0,0 +1,123 @@
+"""
+Config Rendering
+================
+
+Every deploy renders the vhost, supervisor and worker templates and
+`render_to_string` finds and parses them through the django loaders on
+each call. Here every template is compiled once and rendered from the
+compiled form afterwards::
+
+    content = render('proxy/nginx/vhost.conf', ctx)
+
+A compiled template is used as long as the file on disk has the same
+mtime, or the same content (sha1) when only the mtime changed, so an
+edited template is picked up right away. A template that is added to a
+template directory that comes first in the search path is not noticed
+until the process restarts.
+
+Django templates can not be pickled so the cache lives in the process.
+``cannulactl serve`` fills it with `warm` before forking the children
+that run the commands, they all start with compiled templates.
+"""
+
+import os
+import hashlib
+import threading
+from logging import getLogger
+
+from django.conf import settings
+from django.template import Context, Template, TemplateDoesNotExist
+from django.template.loader import find_template_loader
+
+log = getLogger('cannula.render')
+
+# Template directories compiled by `warm`
+CONFIG_TEMPLATES = ('proxy', 'proc', 'git', 'worker', 'cannula/authorized_key.txt')
+
+# name -> (path, mtime, sha1, compiled template)
+_cache = {}
+_lock = threading.Lock()
+
+
+def _loaders():
+    loaders = []
+    for loader_name in settings.TEMPLATE_LOADERS:
+        loader = find_template_loader(loader_name)
+        if loader is not None and hasattr(loader, 'load_template_source'):
+            loaders.append(loader)
+    return loaders
+
+
+def _load_source(name):
+    """Return the source and path of the template `name`."""
+    for loader in _loaders():
+        try:
+            return loader.load_template_source(name)
+        except TemplateDoesNotExist:
+            pass
+    raise TemplateDoesNotExist(name)
+
+
+def _compile(name, source, path, mtime):
+    digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    cached = _cache.get(name)
+    if cached and cached[0] == path and cached[2] == digest:
+        # Touched but not changed
+        template = cached[3]
+    else:
+        log.debug("Compiling template: %s", path)
+        template = Template(source, name=name)
+    with _lock:
+        _cache[name] = (path, mtime, digest, template)
+    return template
+
+
+def get_template(name):
+    """Return the compiled template `name`."""
+    cached = _cache.get(name)
+    if cached:
+        try:
+            mtime = os.stat(cached[0]).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == cached[1]:
+            return cached[3]
+    source, path = _load_source(name)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        # Not a file on disk, can not tell when it changes
+        return Template(source, name=name)
+    return _compile(name, source, path, mtime)
+
+
+def render(name, context=None):
+    """Render the template `name`, same as `render_to_string`."""
+    return get_template(name).render(Context(context or {}))
+
+
+def _template_dirs():
+    from django.template.loaders.app_directories import app_template_dirs
+    return [d for d in list(settings.TEMPLATE_DIRS) + list(app_template_dirs) if d]
+
+
+def warm(prefixes=CONFIG_TEMPLATES):
+    """Compile all templates under `prefixes`, return how many."""
+    names = set()
+    for base in _template_dirs():
+        for prefix in prefixes:
+            path = os.path.join(base, prefix)
+            if os.path.isfile(path):
+                names.add(prefix)
+                continue
+            for root, dirs, files in os.walk(path):
+                for filename in files:
+                    full = os.path.join(root, filename)
+                    names.add(os.path.relpath(full, base).replace(os.sep, '/'))
+    for name in sorted(names):
+        try:
+            get_template(name)
+        except Exception, e:
+            # Not every file in there has to be a valid template
+            log.warning("Could not compile %s: %s", name, e)
+    return len(names)
@@ -0,0 +1,214 @@
+"""
+Supervisor XML-RPC Client
+=========================
+
+Drop in replacement for the `xmlrpclib.ServerProxy` the proc api used,
+calls still look like ``client.supervisor.getAllProcessInfo()``. On top
+of that it adds:
+
+* A pool of persistent connections, safe to share between the threads
+  of the web process.
+* A timeout on every call so a hung supervisord can not block a deploy
+  forever. Pass ``timeout`` to `SupervisorClient.call` to override it.
+* Batches, which send several calls in one ``system.multicall`` round
+  trip. Supervisors with a broken multicall (3.0a10 answers it with a
+  500 error) get the calls one by one over the same connection::
+
+    batch = client.batch()
+    batch.add('supervisor.stopProcessGroup', 'myproject')
+    batch.add('supervisor.removeProcessGroup', 'myproject')
+    batch.add('supervisor.addProcessGroup', 'myproject')
+    stopped, removed, added = batch.run()
+
+A fault does not stop the calls after it, supervisord runs every call
+of a multicall and so does the fallback. Faults are only raised by
+`Batch.run` once all of them ran. Calls that must not run when an
+earlier one failed, like a start after a stop, belong in a later batch.
+"""
+
+import os
+import socket
+import httplib
+import xmlrpclib
+import threading
+import Queue
+from contextlib import contextmanager
+from logging import getLogger
+
+from supervisor.xmlrpc import SupervisorTransport
+
+log = getLogger('cannula.rpc')
+
+# Seconds to wait for a single call
+DEFAULT_TIMEOUT = 60
+
+
+class TimeoutTransport(SupervisorTransport):
+    """SupervisorTransport with a socket timeout on its connection."""
+
+    def __init__(self, username=None, password=None, serverurl=None,
+            timeout=DEFAULT_TIMEOUT):
+        SupervisorTransport.__init__(self, username, password, serverurl)
+        self.timeout = timeout
+        get_connection = self._get_connection
+
+        def _get_connection():
+            conn = get_connection()
+            connect = conn.connect
+            def timed_connect():
+                # httplib reconnects on its own, so set it every time
+                connect()
+                conn.sock.settimeout(self.timeout)
+            conn.connect = timed_connect
+            return conn
+        self._get_connection = _get_connection
+
+    def set_timeout(self, timeout):
+        self.timeout = timeout
+        if self.connection is not None and self.connection.sock is not None:
+            self.connection.sock.settimeout(timeout)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def request(self, host, handler, request_body, verbose=0):
+        try:
+            return SupervisorTransport.request(self, host, handler,
+                request_body, verbose)
+        except (socket.error, httplib.HTTPException):
+            # Do not reuse a connection in an unknown state
+            self.close()
+            raise
+
+
+class SupervisorClient(object):
+    """Thread safe pool of connections to one supervisord."""
+
+    def __init__(self, serverurl, username=None, password=None,
+            timeout=DEFAULT_TIMEOUT, size=4):
+        self.serverurl = serverurl
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.size = size
+        self._multicall = None
+        self._reset()
+    
+    def _reset(self):
+        self.pid = os.getpid()
+        self.pool = Queue.Queue()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        transport = TimeoutTransport(self.username, self.password,
+            self.serverurl, self.timeout)
+        # xmlrpclib forces you to use an http uri, the transport
+        # knows where to really connect to.
+        return xmlrpclib.ServerProxy('http://127.0.0.1', transport=transport), transport
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Check out a connection from the pool."""
+        if self.pid != os.getpid():
+            # Forked, the connections (and locks) belong to the parent
+            self._reset()
+        try:
+            proxy, transport = self.pool.get_nowait()
+        except Queue.Empty:
+            proxy, transport = self._connect()
+        transport.set_timeout(timeout or self.timeout)
+        try:
+            yield proxy
+        except (socket.error, httplib.HTTPException, xmlrpclib.ProtocolError):
+            transport.close()
+            raise
+        finally:
+            # A fault is an answer, the connection is still good
+            if transport.connection is not None and self.pool.qsize() < self.size:
+                self.pool.put((proxy, transport))
+            else:
+                transport.close()
+
+    def call(self, method, *args, **kwargs):
+        """Call `method` ('supervisor.getPID'), takes a `timeout` keyword."""
+        with self.connection(kwargs.get('timeout')) as proxy:
+            return getattr(proxy, method)(*args)
+
+    def _request(self, method, params):
+        return self.call(method, *params)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        # Same interface as ServerProxy: client.supervisor.getPID()
+        return xmlrpclib._Method(self._request, name)
+
+    def supports_multicall(self):
+        """Probe once if system.multicall returns a result per call."""
+        with self._lock:
+            if self._multicall is None:
+                try:
+                    results = self.call('system.multicall', [
+                        {'methodName': 'supervisor.getPID', 'params': []},
+                        {'methodName': 'supervisor.getPID', 'params': []},
+                    ])
+                    self._multicall = len(results) == 2
+                except (xmlrpclib.ProtocolError, xmlrpclib.Fault):
+                    self._multicall = False
+                if not self._multicall:
+                    log.info("system.multicall is broken, batches are sent one by one")
+            return self._multicall
+
+    def batch(self, timeout=None):
+        return Batch(self, timeout)
+
+
+class Batch(object):
+    """Calls to send in a single round trip, in order."""
+
+    def __init__(self, client, timeout=None):
+        self.client = client
+        self.timeout = timeout
+        self.calls = []
+
+    def __len__(self):
+        return len(self.calls)
+
+    def add(self, method, *args):
+        self.calls.append((method, args))
+
+    def run(self, ignore=()):
+        """
+        Return the result of each call. A fault with a code in `ignore`
+        gives a None result, any other fault is raised after all calls
+        ran, a fault does not stop the calls that follow it.
+        """
+        if not self.calls:
+            return []
+        if self.client.supports_multicall():
+            results = self.client.call('system.multicall', [
+                {'methodName': method, 'params': list(args)}
+                for method, args in self.calls], timeout=self.timeout)
+        else:
+            results = []
+            with self.client.connection(self.timeout) as proxy:
+                for method, args in self.calls:
+                    try:
+                        results.append([getattr(proxy, method)(*args)])
+                    except xmlrpclib.Fault, f:
+                        results.append({'faultCode': f.faultCode,
+                            'faultString': f.faultString})
+
+        values = []
+        for (method, args), result in zip(self.calls, results):
+            if isinstance(result, dict) and 'faultCode' in result:
+                if result['faultCode'] not in ignore:
+                    raise xmlrpclib.Fault(result['faultCode'], result['faultString'])
+                log.warning("%s%r: %s", method, args, result['faultString'])
+                values.append(None)
+            else:
+                values.append(result[0])
+        self.calls = []
+        return values
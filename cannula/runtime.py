@@ -16,10 +16,20 @@ You specify the runtime in the application's `app.yaml` file like so
 """
 
 import os
+import re
 import sys
+import json
+import shutil
+import hashlib
+import tempfile
 
 # click here: [[utils.py]]
-from cannula.utils import call_subprocess
+from cannula.utils import call_subprocess, shell, shell_escape
+from cannula.process import run, spawn
+from cannula.wheelhouse import Wheelhouse
+
+# Splits the project name off a requirement line 'Django>=1.4 # comment'
+REQUIREMENT_NAME = re.compile(r'^([A-Za-z0-9][-_.A-Za-z0-9]*)')
 
 class Runtime(object):
     """###Base Runtime
@@ -41,7 +51,7 @@ class Runtime(object):
         sys.stderr.flush()
 
     @classmethod
-    def call(cls, cmd, cwd=None, env=None, status=0):
+    def call(cls, cmd, cwd=None, env=None, status=0, timeout=None):
         """
         #### `call(cmd)`
         
@@ -49,14 +59,26 @@ class Runtime(object):
         the expected output. Pass `status=None` to allow ignore
         all errors. `cwd` specifies the directory to execute in
         otherwise the current dir is used. `env` allows you to 
-        pass a dictionary of environment settings to use. 
+        pass a dictionary of environment settings to use. The
+        command is killed after `timeout` seconds.
         """
-        st = call_subprocess(cmd, cwd, env)
+        st = call_subprocess(cmd, cwd, env, timeout)
         if status is None:
             return st
         if st != status:
             raise RuntimeError("Command Failed: %s" % cmd)
         return st
+    
+    @classmethod
+    def spawn(cls, cmd, cwd=None, env=None, timeout=None):
+        """
+        #### `spawn(cmd)`
+        
+        Start `cmd` in the background and return a handle, its
+        `wait()` method returns the result. Use this for steps
+        that can run while something else is going on.
+        """
+        return spawn(cmd, cwd=cwd, env=env, timeout=timeout)
         
     @classmethod
     def bootstrap(cls, project, application):
@@ -96,8 +118,220 @@ class Python(Runtime):
     Initialize a virtual environment for this project.
     All python projects must include a `requirements.txt` file
     with all the dependancies.
+    
+    After every install a fingerprint of the requirements and the
+    interpreter version is stored in the virtualenv. When nothing
+    changed the install is skipped, otherwise only the requirements
+    that were added, removed or changed are (un)installed.
     """
     
+    fingerprint_name = 'requirements.fingerprint'
+    
+    @classmethod
+    def read_requirements(cls, requirements):
+        """
+        #### `read_requirements(requirements)`
+        
+        Return the list of requirement lines with comments and blank
+        lines removed. Nested `-r` files are included inline.
+        """
+        lines = []
+        base = os.path.dirname(requirements)
+        with open(requirements) as req_file:
+            for line in req_file:
+                line = line.split(' #', 1)[0].strip()
+                if not line or line.startswith('#'):
+                    continue
+                for flag in ('-r ', '--requirement '):
+                    if line.startswith(flag):
+                        nested = os.path.join(base, line[len(flag):].strip())
+                        lines.extend(cls.read_requirements(nested))
+                        break
+                else:
+                    lines.append(line)
+        return lines
+    
+    @classmethod
+    def requirement_name(cls, line):
+        """
+        #### `requirement_name(line)`
+        
+        Return the lowercase project name of a requirement line or
+        None for options and editable (`-e`) requirements.
+        """
+        if line.startswith('-'):
+            return None
+        match = REQUIREMENT_NAME.match(line)
+        if match is None:
+            return None
+        return match.group(1).lower()
+    
+    @classmethod
+    def interpreter_version(cls, python):
+        """
+        #### `interpreter_version(python)`
+        
+        Full version string of the python executable.
+        """
+        status, output = shell('%s -c "import sys; print(sys.version)"' % python)
+        if status != 0:
+            raise RuntimeError("Unable to run python: %s" % python)
+        return output.strip()
+    
+    @classmethod
+    def fingerprint(cls, requirements, version):
+        """
+        #### `fingerprint(requirements, version)`
+        
+        Build the fingerprint for a list of requirement lines.
+        """
+        content = '\n'.join([version] + requirements)
+        return {
+            'hash': hashlib.sha1(content).hexdigest(),
+            'python': version,
+            'requirements': requirements,
+        }
+    
+    @classmethod
+    def read_fingerprint(cls, virtualenv):
+        path = os.path.join(virtualenv, cls.fingerprint_name)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path) as fp:
+                return json.load(fp)
+        except ValueError:
+            return None
+    
+    @classmethod
+    def write_fingerprint(cls, virtualenv, fingerprint):
+        path = os.path.join(virtualenv, cls.fingerprint_name)
+        with open(path, 'w') as fp:
+            json.dump(fingerprint, fp)
+    
+    @classmethod
+    def requirements_delta(cls, old, new):
+        """
+        #### `requirements_delta(old, new)`
+        
+        Compare two lists of requirement lines and return a tuple of
+        (`install`, `uninstall`) lists. Returns None if the delta can
+        not be computed safely (options or editables changed) and a
+        full install is needed.
+        """
+        old_names = {}
+        for line in old:
+            old_names[cls.requirement_name(line) or line] = line
+        new_names = {}
+        for line in new:
+            new_names[cls.requirement_name(line) or line] = line
+        
+        install = []
+        uninstall = []
+        for name, line in new_names.items():
+            if old_names.get(name) == line:
+                continue
+            if cls.requirement_name(line) is None:
+                return None
+            install.append(line)
+        for name, line in old_names.items():
+            if name in new_names:
+                continue
+            if cls.requirement_name(line) is None:
+                return None
+            uninstall.append(name)
+        return sorted(install), sorted(uninstall)
+    
+    @classmethod
+    def pip_install(cls, pip, args):
+        """
+        #### `pip_install(pip, args)`
+        
+        Install `args` (requirement lines or `-r file`) from the shared
+        wheelhouse. Wheels are built with the network only if they are
+        missing from the wheelhouse, then the install itself never
+        touches the network.
+        """
+        wheelhouse = Wheelhouse()
+        wheelhouse.initialize()
+        build_dir = tempfile.mkdtemp(prefix='cannula-wheels-')
+        wheel_cmd = "%s wheel %s --find-links=%s --wheel-dir=%s %s"
+        try:
+            if not os.path.isfile(os.path.join(os.path.dirname(pip), 'wheel')):
+                # `pip wheel` needs the wheel package next to it, the wheels
+                # are built by the project env to match its python. Only
+                # the very first install downloads it and adds a wheel of
+                # it to the wheelhouse for every other project.
+                status, _ = shell("%s install --no-index --find-links=%s wheel"
+                    % (pip, wheelhouse.wheel_dir))
+                if status != 0:
+                    cls.call("%s install wheel" % pip)
+                    cls.call(wheel_cmd % (pip, '', wheelhouse.wheel_dir, build_dir, 'wheel'))
+                else:
+                    # pip freeze does not list it
+                    wheelhouse.touch(wheelhouse.find([('wheel', None)]))
+            status, _ = shell(wheel_cmd % (pip, '--no-index',
+                wheelhouse.wheel_dir, build_dir, args))
+            if status != 0:
+                cls.notify("Building wheels missing from the wheelhouse\n")
+                cls.call(wheel_cmd % (pip, '', wheelhouse.wheel_dir, build_dir, args))
+            wheelhouse.add_dir(build_dir)
+            # Some versions of pip do not copy wheels that are already in
+            # --find-links to the build dir, install from both.
+            cls.call("%s install --no-index --find-links=%s --find-links=%s %s"
+                % (pip, build_dir, wheelhouse.wheel_dir, args))
+        finally:
+            shutil.rmtree(build_dir)
+        # Most wheels came straight from the wheelhouse, keep what the
+        # environment uses from being evicted first.
+        wheelhouse.touch(wheelhouse.find(cls.installed(pip)))
+        wheelhouse.prune()
+    
+    @classmethod
+    def installed(cls, pip):
+        """
+        #### `installed(pip)`
+        
+        Return the (name, version) of every distribution installed in
+        the environment of `pip`, editable ones are left out.
+        """
+        result = run("%s freeze" % pip)
+        if not result.ok:
+            return []
+        installed = []
+        for line in result.stdout.splitlines():
+            name, sep, version = line.strip().partition('==')
+            if sep and not name.startswith('-'):
+                installed.append((name, version))
+        return installed
+    
+    @classmethod
+    def install_requirements(cls, pip, requirements, previous, current):
+        """
+        #### `install_requirements(pip, requirements, previous, current)`
+        
+        Install the requirements file, or only the difference between
+        the `previous` and `current` fingerprints if possible.
+        """
+        delta = None
+        if previous and previous.get('python') == current['python']:
+            delta = cls.requirements_delta(previous['requirements'],
+                current['requirements'])
+        
+        if delta is None:
+            cls.notify("Installing requirements\n")
+            cls.pip_install(pip, '-r %s' % requirements)
+            return
+        
+        install, uninstall = delta
+        if uninstall:
+            cls.notify("Removing requirements: %s\n" % ', '.join(uninstall))
+            cls.call("%s uninstall -y %s" % (pip, ' '.join(uninstall)))
+        if install:
+            cls.notify("Installing changed requirements: %s\n" % ', '.join(install))
+            args = ' '.join([shell_escape(line) for line in install])
+            cls.pip_install(pip, args)
+    
     @classmethod
     def bootstrap(cls, project, application):
         # The requirements file of the project that was pushed.
@@ -106,16 +340,37 @@ class Python(Runtime):
             raise Exception("Requirement file not found: %s" % requirements)
         
         py_version = application.get('python_version', sys.executable)
+        current = cls.fingerprint(cls.read_requirements(requirements),
+            cls.interpreter_version(py_version))
+        previous = cls.read_fingerprint(project.virtualenv)
+        
+        if previous and previous.get('python') != current['python']:
+            # The interpreter changed, start over with a fresh env.
+            cls.notify("Python version changed, rebuilding environment")
+            cls.teardown(project, application)
+            previous = None
         
         cmd = 'virtualenv --distribute --python=%s %s'
         
         if not os.path.isdir(project.virtualenv):
             cls.notify("Creating virtual environment for %s" % project)
             cls.call(cmd % (py_version, project.virtualenv))
+            previous = None
         
-        pip = os.path.join(project.virtualenv, 'bin', 'pip')
-        cls.notify("Installing requirements\n")
-        
-        cls.call("%s install -r %s" % (pip, requirements))
+        # Byte compile the code while pip is busy, the processes
+        # can not write the .pyc files themselves.
+        python = os.path.join(project.virtualenv, 'bin', 'python')
+        compiling = cls.spawn([python, '-m', 'compileall', '-q', project.project_dir])
+        try:
+            if previous and previous.get('hash') == current['hash']:
+                cls.notify("Requirements unchanged, skipping install\n")
+            else:
+                pip = os.path.join(project.virtualenv, 'bin', 'pip')
+                cls.install_requirements(pip, requirements, previous, current)
+                cls.write_fingerprint(project.virtualenv, current)
+        finally:
+            result = compiling.wait()
+            if not result.ok:
+                cls.notify("Could not compile all python files:\n%s" % result.output)
         
         
\ No newline at end of file
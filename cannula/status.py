@@ -0,0 +1,143 @@
+"""
+Process Status
+==============
+
+Pages and the cli never ask supervisord for the process state. A
+`StatusPoller` process of ``cannulactl serve`` calls getAllProcessInfo
+every `status_interval` seconds and writes a snapshot that everyone
+else reads::
+
+    CANNULA_BASE/status.json
+        {"updated": 1350000000.0, "error": null, "processes": [...]}
+
+The snapshot is only parsed again when the file changed, so a busy
+dashboard costs a stat call per page load.
+"""
+
+import os
+import json
+import time
+import threading
+from logging import getLogger
+
+from cannula import conf
+
+log = getLogger('cannula.status')
+
+# Process info kept in the snapshot
+FIELDS = ('group', 'name', 'statename', 'state', 'pid', 'start', 'now',
+    'description', 'spawnerr')
+
+_cache = {}
+
+
+def snapshot_path():
+    return os.path.join(conf.CANNULA_BASE, 'status.json')
+
+
+def write(snapshot, path=None):
+    path = path or snapshot_path()
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f)
+    os.rename(tmp, path)
+
+
+def read(path=None):
+    """Return the latest snapshot, an empty one if there is none."""
+    path = path or snapshot_path()
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return {'updated': None, 'error': "No status available", 'processes': []}
+    cached = _cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError):
+        return {'updated': None, 'error': "Corrupt status file", 'processes': []}
+    _cache[path] = (mtime, snapshot)
+    return snapshot
+
+
+def is_stale(snapshot, interval=None):
+    """True if the poller has not updated the snapshot in a while."""
+    interval = interval or conf.CANNULA_STATUS_INTERVAL
+    if not snapshot.get('updated'):
+        return True
+    return time.time() - snapshot['updated'] > interval * 3
+
+
+def project_groups(project):
+    """Supervisor groups a project can run as."""
+    from cannula.apis.v2.deploy import COLORS
+    name = getattr(project, 'name', project)
+    return [name] + ['%s_%s' % (name, color) for color in COLORS]
+
+
+def processes(projects, snapshot=None):
+    """
+    Processes of `projects` in the snapshot, each with the name of
+    its project and the uptime in seconds added.
+    """
+    snapshot = snapshot or read()
+    groups = {}
+    for project in projects:
+        for group in project_groups(project):
+            groups[group] = getattr(project, 'name', project)
+    result = []
+    for info in snapshot['processes']:
+        if info['group'] not in groups:
+            continue
+        info = dict(info)
+        info['project'] = groups[info['group']]
+        info['uptime'] = info['now'] - info['start'] if info['pid'] else 0
+        result.append(info)
+    return result
+
+
+class StatusPoller(threading.Thread):
+    """Keep the snapshot up to date in the background."""
+
+    def __init__(self, interval=None, path=None, parent=None):
+        threading.Thread.__init__(self, name='status-poller')
+        self.daemon = True
+        self.interval = interval or conf.CANNULA_STATUS_INTERVAL
+        self.path = path or snapshot_path()
+        # Stop when the process `parent` is gone
+        self.parent = parent
+        self.stopped = threading.Event()
+        self.snapshot = None
+
+    def poll(self):
+        from cannula.api import api
+        try:
+            infos = api.proc.server.supervisor.getAllProcessInfo()
+            processes = [dict((k, info.get(k)) for k in FIELDS) for info in infos]
+            error = None
+        except Exception, e:
+            log.warning("Could not get process status: %s", e)
+            # Keep showing what we knew, flagged with the error
+            processes = self.snapshot['processes'] if self.snapshot else []
+            error = str(e)
+        snapshot = {'updated': time.time(), 'error': error, 'processes': processes}
+        write(snapshot, self.path)
+        self.snapshot = snapshot
+        return snapshot
+
+    def run(self):
+        log.info("Polling process status every %ss", self.interval)
+        while not self.stopped.is_set():
+            if self.parent and os.getppid() != self.parent:
+                log.info("Parent exited, stopping")
+                break
+            try:
+                self.poll()
+            except Exception:
+                log.exception("Error writing process status")
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
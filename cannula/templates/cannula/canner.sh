@@ -26,8 +26,8 @@
 # 
 # * info                                - List out all your projects and groups.
 # * logs [project]                      - Print out the last few deployment logs.
-# * rollback [project] [hash]           - Rollback last deployment, or force 
-#                                         'hash' to be deployed.
+# * rollback --project=[project]        - Switch a bluegreen project back to
+#                                         the release that was live before.
 # * create_group [groupname]            - Create new group.
 # * create_project [group] [project]    - Create new project in group.
 # * django.syncdb [project]             - Run django syncdb command on project.
@@ -35,6 +35,8 @@
 #
 
 export CANNULA_CMD={{ cannula_cmd }}
+# Talks to a running `cannulactl serve` and falls back to $CANNULA_CMD
+export CANNULA_CLIENT={{ cannula_client_cmd }}
 export CANNULA_ROOT={{ cannula_base }}
 
 # This needs to be globally available
@@ -57,13 +59,13 @@ CMD=`echo $SSH_ORIGINAL_COMMAND | awk '{print $1}'`
 case $CMD in
     "")
         # no command found default just info command
-        $CANNULA_CMD $C_USER info
+        $CANNULA_CLIENT $C_USER info
         ;;
         
     "git-receive-pack")
         # Check permissions to repo and strip off any quote chars added by git.
         export REPO=`echo $SSH_ORIGINAL_COMMAND | awk '{print $2}'|sed "s/^\([\"']\)\(.*\)\1\$/\2/g"`
-        $CANNULA_CMD $C_USER has_perm read --repo=$REPO
+        $CANNULA_CLIENT $C_USER has_perm read --repo=$REPO
         if [[ ! $? == 0 ]]
         then 
             echo "Access denied!"
@@ -73,7 +75,7 @@ case $CMD in
         # Initialize the project, this is safe to do 
         # everytime and allows us to pick up any changes to
         # either the base templates or environment settings
-        $CANNULA_CMD $C_USER initialize --repo=$REPO
+        $CANNULA_CLIENT $C_USER initialize --repo=$REPO
         
         # Do the push and deploy
         $CMD $CANNULA_ROOT/repos/$REPO
@@ -84,12 +86,12 @@ case $CMD in
         fi
         
         # Do the actual deployment
-        $CANNULA_CMD $C_USER deploy --repo=$REPO
+        $CANNULA_CLIENT $C_USER deploy --repo=$REPO
         ;;
         
     *)
         # Just pass everything onto the cannula command
-        $CANNULA_CMD $C_USER $SSH_ORIGINAL_COMMAND
+        $CANNULA_CLIENT $C_USER $SSH_ORIGINAL_COMMAND
         ;;
 esac
 
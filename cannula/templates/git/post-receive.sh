@@ -1,6 +1,6 @@
 #!/bin/bash
 #
-# Checkout the revision that was just pushed to the remote repo
+# Deploy the revision that was just pushed to the remote repo
 #
 # The "post-receive" script is run after receive-pack has accepted a pack
 # and the repository has been updated.  It is passed arguments in through
@@ -9,32 +9,33 @@
 # For example:
 #  aa453216d1b3e49e7f6f98441fa56946ddcd6a20 68f7abf4e6f922807889f52bc043ecd31b79f814 refs/heads/master
 #
+# The deploy builds the new revision in its own release directory and
+# only switches the live 'current' symlink when the build succeeded, so
+# there is nothing to revert here when it fails.
+#
+
+# Use the cannula daemon client if canner.sh gave us one
+CANNULA_CLIENT=${CANNULA_CLIENT:-$CANNULA_CMD}
 
-checkout()
+deploy()
 {
     newrev=$(git rev-parse $1)
     oldrev=$(git rev-parse $2)
-    
-    git-checkout -f $newrev &> /dev/null
-    
-    if [ $? == 0 ]
+
+    echo "Deploying revision $newrev"
+    echo "using settings: $DJANGO_SETTINGS_MODULE"
+    echo "Repo: $REPO"
+    $CANNULA_CLIENT $C_USER deploy --oldrev=$oldrev --newrev=$newrev --repo=$REPO --settings=$DJANGO_SETTINGS_MODULE
+    status=$?
+    if [ $status == 0 ]
+    then
+        echo "Success!"
+    elif [ $status == 3 ]
     then
-        echo "Checked out revision $newrev"
-        echo "Deploying new version"
-        echo "using settings: $DJANGO_SETTINGS_MODULE"
-        echo "Repo: $REPO"
-        $CANNULA_CMD $C_USER deploy --oldrev=$oldrev --newrev=$newrev --repo=$REPO --settings=$DJANGO_SETTINGS_MODULE
-        if [ $? == 0 ]
-        then 
-            echo "Success!"
-        else
-            echo "Reverting failed deploy"
-            git-checkout -f $oldrev
-            # TODO: MAKE A REVERT COMMAND!
-            $CANNULA_CMD $C_USER deploy --oldrev=$newrev --newrev=$oldrev --repo=$REPO --settings=$DJANGO_SETTINGS_MODULE
-        fi
+        # Superseded, the newer push deploys these changes too
+        echo "Not deployed, a newer push is deployed instead. Its output has the result."
     else
-        echo "Checkout failed, please reset project"
+        echo "Deploy failed, the previous release is still live."
     fi
 }
 
@@ -42,11 +43,11 @@ checkout()
 
 if [ -n "$1" -a -n "$2" -a -n "$3" ]; then
         # Output to the terminal in command line mode
-        checkout $2
+        deploy $2 $1
 else
         while read oldrev newrev refname
         do
-                echo "Preparing to checkout $refname"
-                checkout $newrev
+                echo "Preparing to deploy $refname"
+                deploy $newrev $oldrev
         done
 fi
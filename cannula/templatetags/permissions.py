@@ -0,0 +1,17 @@
+from django import template
+
+register = template.Library()
+
+@register.filter
+def perms_for(lookup, obj):
+    """
+    Permissions of an object in a `PermissionAPI.bulk_has_perm` lookup::
+    
+        {% load permissions %}
+        {% with group_perms=object_perms|perms_for:group %}
+            {% if group_perms.delete %}...{% endif %}
+        {% endwith %}
+    """
+    if not lookup:
+        return {}
+    return lookup.get(obj, {})
@@ -3,7 +3,7 @@ import shutil
 import os
 import tempfile
 
-from django.test import TransactionTestCase
+from django.test import TransactionTestCase, TestCase
 from django.db import transaction
 from django.core.exceptions import ValidationError
 
@@ -136,4 +136,1316 @@ class CannulaTestCase(TransactionTestCase):
     def tearDown(self):
         super(CannulaTestCase, self).tearDown()
         self.api.proc.shutdown()
-        shutil.rmtree(self.base_dir)
\ No newline at end of file
+        shutil.rmtree(self.base_dir)
+
+
+class RequirementsTestCase(TestCase):
+    
+    def test_read_requirements(self):
+        from cannula.runtime import Python
+        directory = tempfile.mkdtemp(prefix="cannula_test_")
+        try:
+            with open(os.path.join(directory, 'base.txt'), 'w') as f:
+                f.write("# shared\nsimplejson==2.6\n")
+            requirements = os.path.join(directory, 'requirements.txt')
+            with open(requirements, 'w') as f:
+                f.write("Django==1.4  # web\n\n-r base.txt\nPyYAML\n")
+            self.assertEqual(Python.read_requirements(requirements),
+                ['Django==1.4', 'simplejson==2.6', 'PyYAML'])
+        finally:
+            shutil.rmtree(directory)
+    
+    def test_requirements_delta(self):
+        from cannula.runtime import Python
+        old = ['Django==1.4', 'South', '-e git+git://example.com/foo.git#egg=foo']
+        self.assertEqual(Python.requirements_delta(old, old), ([], []))
+        new = ['django==1.4.2', 'PyYAML', '-e git+git://example.com/foo.git#egg=foo']
+        self.assertEqual(Python.requirements_delta(old, new),
+            (['PyYAML', 'django==1.4.2'], ['south']))
+        # Changed options or editables need a full install
+        changed = old[:2] + ['-e git+git://example.com/bar.git#egg=foo']
+        self.assertEqual(Python.requirements_delta(old, changed), None)
+        self.assertEqual(Python.requirements_delta(old, old[:2]), None)
+    
+    def test_fingerprint(self):
+        from cannula.runtime import Python
+        first = Python.fingerprint(['Django==1.4'], '2.7.3')
+        self.assertEqual(first, Python.fingerprint(['Django==1.4'], '2.7.3'))
+        self.assertNotEqual(first['hash'],
+            Python.fingerprint(['Django==1.4'], '2.7.4')['hash'])
+        self.assertNotEqual(first['hash'],
+            Python.fingerprint(['Django==1.4.2'], '2.7.3')['hash'])
+
+
+class ProcessTestCase(TestCase):
+    
+    def test_run(self):
+        from cannula.process import run
+        result = run(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+        self.assertEqual(result.status, 3)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.stdout, 'out\n')
+        self.assertEqual(result.stderr, 'err\n')
+        status, output = run('echo one | tr o O')
+        self.assertEqual((status, output), (0, 'One\n'))
+    
+    def test_timeout(self):
+        from cannula.process import run
+        result = run('sleep 5', timeout=0.2)
+        self.assertTrue(result.timed_out)
+        self.assertFalse(result.ok)
+        self.assertTrue(result.duration < 5)
+    
+    def test_run_all(self):
+        import time
+        from cannula.process import run_all
+        cmds = ['sleep 0.5; echo %d' % i for i in range(4)]
+        start = time.time()
+        results = run_all(cmds, concurrency=4)
+        self.assertEqual([r.stdout for r in results], ['0\n', '1\n', '2\n', '3\n'])
+        # They ran at the same time
+        self.assertTrue(time.time() - start < 1.5)
+
+
+class WriteContentTestCase(TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="cannula_test_")
+        self.path = os.path.join(self.directory, 'vhost.conf')
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def test_write_content(self):
+        from cannula.utils import write_content
+        self.assertTrue(write_content(self.path, u'server caf\xe9;\n'))
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'server caf\xc3\xa9;\n')
+        os.utime(self.path, (1000, 1000))
+        # Same content is not written again
+        self.assertFalse(write_content(self.path, u'server caf\xe9;\n'))
+        self.assertEqual(os.stat(self.path).st_mtime, 1000)
+        # A different mode is
+        self.assertTrue(write_content(self.path, u'server caf\xe9;\n', '600'))
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0600)
+        self.assertTrue(write_content(self.path, 'server other;\n', '600'))
+        # No temp files are left behind
+        self.assertEqual(os.listdir(self.directory), ['vhost.conf'])
+
+
+class CacheTestCase(TestCase):
+    
+    def test_versions(self):
+        from django.core.cache import cache as django_cache
+        from cannula import cache
+        key = cache.make_key('test', 'abby')
+        self.assertEqual(key, cache.make_key('test', 'abby'))
+        self.assertNotEqual(key, cache.make_key('test', 'jim'))
+        django_cache.set(key, 'value')
+        local = cache.local_version('test')
+        cache.bump('test')
+        self.assertEqual(cache.local_version('test'), local + 1)
+        # Old keys are never read again
+        self.assertNotEqual(key, cache.make_key('test', 'abby'))
+        self.assertEqual(django_cache.get(cache.make_key('test', 'abby')), None)
+        # Other namespaces keep their keys
+        other = cache.make_key('other', 'abby')
+        cache.bump('test')
+        self.assertEqual(other, cache.make_key('other', 'abby'))
+    
+    def test_shared(self):
+        from django.core.cache import get_cache
+        from cannula import cache
+        original = cache.cache
+        directory = tempfile.mkdtemp(prefix="cannula_test_")
+        try:
+            # A per process cache can not be invalidated by the others
+            cache.cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+            self.assertFalse(cache.shared())
+            cache.cache = get_cache('django.core.cache.backends.filebased.FileBasedCache',
+                LOCATION=directory)
+            self.assertTrue(cache.shared())
+        finally:
+            cache.cache = original
+            shutil.rmtree(directory)
+
+
+
+class WheelhouseTestCase(TestCase):
+    
+    def setUp(self):
+        from cannula.wheelhouse import Wheelhouse
+        self.directory = tempfile.mkdtemp(prefix="cannula_test_")
+        self.build_dir = os.path.join(self.directory, 'build')
+        os.makedirs(self.build_dir)
+        self.wheelhouse = Wheelhouse(os.path.join(self.directory, 'wheelhouse'), 1)
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def build(self, *names):
+        # Every wheel is 10 bytes
+        for name in names:
+            with open(os.path.join(self.build_dir, name), 'w') as f:
+                f.write(name[:10].ljust(10))
+        return self.wheelhouse.add_dir(self.build_dir)
+    
+    def test_add_dir(self):
+        self.build('Django-1.4-py2-none-any.whl', 'not-a-wheel.txt')
+        self.assertEqual(os.listdir(self.wheelhouse.wheel_dir), ['Django-1.4-py2-none-any.whl'])
+        # Hard linked to the stored object
+        link = os.path.join(self.wheelhouse.wheel_dir, 'Django-1.4-py2-none-any.whl')
+        self.assertEqual(os.stat(link).st_nlink, 2)
+        self.assertEqual(self.wheelhouse.size(), 10)
+        # Adding it again does not store anything new
+        self.build('Django-1.4-py2-none-any.whl')
+        self.assertEqual(self.wheelhouse.size(), 10)
+    
+    def test_prune(self):
+        import time
+        wheels = ['a-1-py2-none-any.whl', 'b-1-py2-none-any.whl', 'c-1-py2-none-any.whl']
+        for name in wheels:
+            shutil.rmtree(self.build_dir)
+            os.makedirs(self.build_dir)
+            self.build(name)
+            time.sleep(0.01)
+        self.assertEqual([name for name, _ in self.wheelhouse.entries()], wheels)
+        # A wheel pip installed from the wheelhouse is used again
+        self.wheelhouse.touch(['a-1-py2-none-any.whl', 'unknown-1-py2-none-any.whl'])
+        self.assertEqual(self.wheelhouse.prune(20), ['b-1-py2-none-any.whl'])
+        self.assertEqual(self.wheelhouse.prune(20), [])
+        self.assertEqual(self.wheelhouse.prune(0), ['c-1-py2-none-any.whl', 'a-1-py2-none-any.whl'])
+        self.assertEqual(os.listdir(self.wheelhouse.wheel_dir), [])
+        # The stored objects are gone too
+        self.assertEqual([f for _, _, files in os.walk(self.wheelhouse.objects_dir)
+            for f in files], [])
+    
+    def test_installed(self):
+        from cannula.runtime import Python
+        self.build('Django-1.4-py2-none-any.whl', 'django_foo-2.0-py2-none-any.whl',
+            'Django-1.5-py2-none-any.whl', 'wheel-0.24.0-py2.py3-none-any.whl')
+        pip = os.path.join(self.directory, 'pip')
+        with open(pip, 'w') as f:
+            f.write('#!/bin/sh\necho "-e git+https://example.com/x#egg=x"\n'
+                'echo Django==1.4\necho Django.Foo==2.0\necho "warning" >&2\n')
+        os.chmod(pip, 0755)
+        installed = Python.installed(pip)
+        self.assertEqual(installed, [('Django', '1.4'), ('Django.Foo', '2.0')])
+        self.assertEqual(sorted(self.wheelhouse.find(installed)),
+            ['Django-1.4-py2-none-any.whl', 'django_foo-2.0-py2-none-any.whl'])
+        self.assertEqual(self.wheelhouse.find([('wheel', None)]),
+            ['wheel-0.24.0-py2.py3-none-any.whl'])
+
+
+class PermissionMatrixTestCase(TestCase):
+    
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from cannula.models import ProjectGroup, GroupMembership, Project
+        from cannula.api import api
+        self.api = api
+        self.jim = User.objects.create_user('jim', 'jim@cannula.com', 'lkjh')
+        self.g1 = ProjectGroup.objects.create(name='one')
+        self.g2 = ProjectGroup.objects.create(name='two')
+        self.g3 = ProjectGroup.objects.create(name='three')
+        self.p1 = Project.objects.create(name='p1', group=self.g1)
+        self.p2 = Project.objects.create(name='p2', group=self.g2)
+        self.p3 = Project.objects.create(name='p3', group=self.g3)
+        GroupMembership.objects.create(user=self.jim, group=self.g1,
+            add=True, modify=True, delete=True)
+        self.membership = GroupMembership.objects.create(user=self.jim,
+            group=self.g2, modify=True)
+    
+    def test_invalidation(self):
+        from django.contrib.auth.models import User
+        has_perm = self.api.permissions.has_perm
+        self.assertTrue(has_perm(self.jim, 'modify', group='two'))
+        self.membership.modify = False
+        self.membership.save()
+        # The memo on the user and the cached matrix are both dropped
+        self.assertFalse(has_perm(self.jim, 'modify', group='two'))
+        self.assertFalse(has_perm('jim', 'modify', group='two'))
+        # GroupMembership has a 'delete' field which shadows delete()
+        type(self.membership).objects.filter(pk=self.membership.pk).delete()
+        self.assertFalse(has_perm(User.objects.get(username='jim'), 'read', project='p2'))
+    
+    def test_bulk_has_perm(self):
+        from django.contrib.auth.models import User
+        from cannula.apis.v2.permissions import PERMS
+        permissions = self.api.permissions
+        bob = User.objects.create_user('bob', 'bob@cannula.com', 'lkjh')
+        objects = [self.g1, self.g2, self.g3, self.p1, self.p2, self.p3]
+        for user in (self.jim, bob):
+            result = permissions.bulk_has_perm(user, PERMS, objects)
+            self.assertEqual(set(result), set(objects))
+            for obj in objects:
+                for perm in PERMS:
+                    self.assertEqual(result[obj][perm],
+                        permissions.has_perm(user, perm, obj=obj))
+        self.assertTrue(permissions.bulk_has_perm(self.jim, ['modify'], [self.p2])[self.p2]['modify'])
+        self.assertFalse(permissions.bulk_has_perm(self.jim, ['add'], [self.p2])[self.p2]['add'])
+        result = permissions.bulk_has_perm(bob, PERMS, objects)
+        self.assertFalse(any(any(perms.values()) for perms in result.values()))
+
+
+class AccessTableTestCase(TestCase):
+    
+    ssh_key = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAAAgQC3X2ksR/Go5oyUGwBbwOb6PhRsOYDTOZJKzj9BVMtCM8W4nvGbSIfHvZZ5D/wEZgXHvmOHMNQdA4GbXjO4FwOEhhuKgXn2Fi2PgBy+ZknK+Hm8AZ8E2jYKiFeluYPn0ba1WUezALjMJzjyMSOM/tTCYRVOiY62LOy4Xszz94bRWQ== test@localhost'
+    
+    def setUp(self):
+        self.sync = conf.CANNULA_SYNC_AUTHORIZED_KEYS
+        conf.CANNULA_SYNC_AUTHORIZED_KEYS = False
+        self.directory = tempfile.mkdtemp(prefix="cannula_test_")
+        self.path = os.path.join(self.directory, 'access')
+    
+    def tearDown(self):
+        conf.CANNULA_SYNC_AUTHORIZED_KEYS = self.sync
+        shutil.rmtree(self.directory)
+    
+    def write(self, *lines):
+        from cannula import access
+        with open(self.path, 'w') as f:
+            f.write('\n'.join((access.FORMAT,) + lines) + '\n')
+    
+    def test_lookup(self):
+        from cannula import access
+        self.assertEqual(access.lookup('abby', 'mygroup', self.path), None)
+        self.write('abby\tmygroup\tradm', 'abby\tmygroup/myproject.git\tradm',
+            'abby\tmygroup2\tr', 'bob\tmygroup\tr', 'bob\tmygroup/myproject.git\tr',
+            'zed\tz\tra')
+        self.assertEqual(access.lookup('abby', 'mygroup', self.path), 'radm')
+        self.assertEqual(access.lookup('abby', 'mygroup2', self.path), 'r')
+        self.assertEqual(access.lookup('bob', 'mygroup/myproject.git', self.path), 'r')
+        self.assertEqual(access.lookup('zed', 'z', self.path), 'ra')
+        # Prefixes of a name do not match
+        self.assertEqual(access.lookup('abby', 'mygrou', self.path), '')
+        self.assertEqual(access.lookup('ab', 'mygroup', self.path), '')
+        self.assertEqual(access.lookup('aaa', 'a', self.path), '')
+        self.assertEqual(access.lookup('zzz', 'z', self.path), '')
+        self.assertTrue(access.has_perm('abby', 'delete', repo='mygroup/myproject.git', path=self.path))
+        self.assertFalse(access.has_perm('bob', 'add', group='mygroup', path=self.path))
+        self.assertEqual(access.has_perm('bob', 'fly', group='mygroup', path=self.path), None)
+        self.assertEqual(access.users_of(u'/myproject.git', self.path), set([u'abby', u'bob']))
+        self.write()
+        self.assertEqual(access.lookup('abby', 'mygroup', self.path), '')
+        # Tables in another format are not used
+        with open(self.path, 'w') as f:
+            f.write('abby\tmygroup\tradm\n')
+        self.assertEqual(access.lookup('abby', 'mygroup', self.path), None)
+    
+    def test_update(self):
+        from django.contrib.auth.models import User
+        from cannula.models import ProjectGroup, GroupMembership, Project, Key
+        from cannula import access
+        jim = User.objects.create_user('jim', 'jim@cannula.com', 'lkjh')
+        bob = User.objects.create_user('bob', 'bob@cannula.com', 'lkjh')
+        User.objects.create_user('ann', 'ann@cannula.com', 'lkjh')
+        group = ProjectGroup.objects.create(name='grp')
+        Project.objects.create(name='proj', group=group)
+        membership = GroupMembership.objects.create(user=jim, group=group, modify=True)
+        GroupMembership.objects.create(user=bob, group=group)
+        Key.objects.create(user=jim, name='jim', ssh_key=self.ssh_key)
+        Key.objects.create(user=bob, name='bob', ssh_key=self.ssh_key)
+        self.assertEqual(access.rebuild(self.path), 4)
+        self.assertEqual(access.lookup('jim', 'grp', self.path), 'rm')
+        self.assertEqual(access.lookup('jim', 'grp/proj.git', self.path), 'rm')
+        self.assertEqual(access.lookup('bob', 'grp/proj.git', self.path), 'r')
+        # Users without a key are not listed
+        self.assertEqual(access.lookup('ann', 'grp', self.path), '')
+        
+        membership.modify = False
+        membership.add = True
+        membership.save()
+        with open(self.path) as f:
+            before = [line for line in f if line.startswith('bob\t')]
+        access.update(['jim'], self.path)
+        self.assertEqual(access.lookup('jim', 'grp/proj.git', self.path), 'ra')
+        with open(self.path) as f:
+            self.assertEqual([line for line in f if line.startswith('bob\t')], before)
+        # Same as writing the whole table
+        rebuilt = os.path.join(self.directory, 'rebuilt')
+        access.rebuild(rebuilt)
+        with open(self.path) as f:
+            with open(rebuilt) as r:
+                self.assertEqual(f.read(), r.read())
+        
+        access.invalidate(self.path)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(access.lookup('jim', 'grp', self.path), None)
+        # Updating without a table writes the whole table again
+        access.update(['bob'], self.path)
+        self.assertEqual(access.lookup('jim', 'grp', self.path), 'ra')
+
+
+class KeyStoreTestCase(TestCase):
+    
+    ssh_key = AccessTableTestCase.ssh_key
+    other_key = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAAAgQCuywBW/nlzMy2/x9iWvG7chglPhkGToGNjAXjCpw4QmC0TVg0A+cS2OU3VwQkhjuZD8mJ4wTLEmLAzibwS3+exdgg7vyCBgbfBNHrpaI8QimaNvX+tgqShzsJZYo28FwEdr0mVkks0aNmm4NfrU9bYl5oQQCpOxb1r/nGTPQmK3Q== test@localhost'
+    
+    def setUp(self):
+        self.sync = conf.CANNULA_SYNC_AUTHORIZED_KEYS
+        conf.CANNULA_SYNC_AUTHORIZED_KEYS = False
+        self.directory = tempfile.mkdtemp(prefix="cannula_test_")
+        self.path = os.path.join(self.directory, 'keys')
+    
+    def tearDown(self):
+        conf.CANNULA_SYNC_AUTHORIZED_KEYS = self.sync
+        shutil.rmtree(self.directory)
+    
+    def test_normalize(self):
+        import hashlib
+        from base64 import b64decode, b64encode
+        from cannula import keystore
+        digest = hashlib.sha256(b64decode(self.ssh_key.split()[1])).digest()
+        fp = digest.encode('hex')
+        self.assertEqual(keystore.fingerprint(self.ssh_key), fp)
+        self.assertEqual(keystore.fingerprint(self.ssh_key.split()[1]), fp)
+        self.assertEqual(keystore.normalize(fp), fp)
+        self.assertEqual(keystore.normalize(fp.upper()), fp)
+        self.assertEqual(keystore.normalize(self.ssh_key + '\n'), fp)
+        # sshd passes %f without the padding
+        self.assertEqual(keystore.normalize('SHA256:' + b64encode(digest).rstrip('=')), fp)
+        self.assertEqual(keystore.normalize('SHA256:!!'), None)
+        self.assertEqual(keystore.normalize('not a key'), None)
+        self.assertEqual(keystore.lookup('not a key', self.path), '')
+    
+    def test_store(self):
+        from django.contrib.auth.models import User
+        from cannula.models import Key
+        from cannula import keystore
+        jim = User.objects.create_user('jim', 'jim@cannula.com', 'lkjh')
+        bob = User.objects.create_user('bob', 'bob@cannula.com', 'lkjh')
+        key = Key.objects.create(user=jim, name='jim', ssh_key=self.ssh_key)
+        self.assertEqual(keystore.lookup(self.ssh_key, self.path), '')
+        keystore.add(key, self.path)
+        line = keystore.line(key)
+        self.assertEqual(keystore.lookup(self.ssh_key, self.path), line + '\n')
+        
+        # The same key for another user is kept as a second line
+        same = Key.objects.create(user=bob, name='bob', ssh_key=self.ssh_key)
+        keystore.add(same, self.path)
+        self.assertEqual(keystore.lookup(self.ssh_key, self.path),
+            '%s\n%s\n' % (line, keystore.line(same)))
+        
+        # Changing the key moves its line
+        key.ssh_key = self.other_key
+        key.save()
+        keystore.add(key, self.path)
+        self.assertEqual(keystore.lookup(self.other_key, self.path), keystore.line(key) + '\n')
+        self.assertEqual(keystore.lookup(self.ssh_key, self.path), keystore.line(same) + '\n')
+        
+        keystore.remove(same.pk, self.path)
+        self.assertEqual(keystore.lookup(self.ssh_key, self.path), '')
+        self.assertFalse(os.path.exists(os.path.join(self.path, keystore.fingerprint(self.ssh_key))))
+        
+        # rebuild writes what is in the database and drops the rest
+        Key.objects.filter(pk=key.pk).delete()
+        self.assertEqual(keystore.rebuild(self.path), 1)
+        self.assertEqual(keystore.lookup(self.other_key, self.path), '')
+        self.assertEqual(keystore.lookup(self.ssh_key, self.path), keystore.line(same) + '\n')
+        self.assertEqual(os.listdir(os.path.join(self.path, 'ids')), [str(same.pk)])
+
+
+class AuthorizedKeysTestCase(TestCase):
+    
+    ssh_key = AccessTableTestCase.ssh_key
+    other_key = KeyStoreTestCase.other_key
+    
+    def setUp(self):
+        from cannula.apis.v2.keys import KeyAPI
+        self.sync = conf.CANNULA_SYNC_AUTHORIZED_KEYS
+        conf.CANNULA_SYNC_AUTHORIZED_KEYS = False
+        self.directory = tempfile.mkdtemp(prefix="cannula_test_")
+        self.path = os.path.join(self.directory, 'authorized_keys')
+        # Keep away from the real ~/.ssh
+        self.authorized_keys_path = KeyAPI.authorized_keys_path
+        KeyAPI.authorized_keys_path = lambda api: self.path
+    
+    def tearDown(self):
+        from cannula.apis.v2.keys import KeyAPI
+        KeyAPI.authorized_keys_path = self.authorized_keys_path
+        conf.CANNULA_SYNC_AUTHORIZED_KEYS = self.sync
+        shutil.rmtree(self.directory)
+    
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+    
+    def test_write_chunks(self):
+        from cannula.utils import write_chunks
+        self.assertTrue(write_chunks(self.path, iter(['a\n', u'caf\xe9\n']), '600'))
+        self.assertEqual(self.read(), 'a\ncaf\xc3\xa9\n')
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0600)
+        os.utime(self.path, (1000, 1000))
+        self.assertFalse(write_chunks(self.path, iter(['a\ncaf\xc3\xa9\n']), '600'))
+        self.assertEqual(os.stat(self.path).st_mtime, 1000)
+        self.assertTrue(write_chunks(self.path, iter(['a\n']), '600'))
+        self.assertEqual(self.read(), 'a\n')
+        self.assertEqual(os.listdir(self.directory), ['authorized_keys'])
+    
+    def test_update_keys(self):
+        from django.contrib.auth.models import User
+        from cannula.models import Key
+        from cannula.api import api
+        from cannula import keystore
+        jim = User.objects.create_user('jim', 'jim@cannula.com', 'lkjh')
+        bob = User.objects.create_user('bob', 'bob@cannula.com', 'lkjh')
+        key = Key.objects.create(user=jim, name='jim', ssh_key=self.ssh_key)
+        # No file yet, all keys are written
+        self.assertTrue(api.keys.update_keys(added=[key]))
+        self.assertEqual(self.read(), api.keys.authorized_keys())
+        
+        first = self.read()
+        other = Key.objects.create(user=bob, name='bob', ssh_key=self.other_key)
+        self.assertTrue(api.keys.update_keys(added=[other]))
+        self.assertEqual(self.read(), api.keys.authorized_keys())
+        # The file before the change is kept
+        with open(self.path + '.bak') as f:
+            self.assertEqual(f.read(), first)
+        self.assertEqual(os.stat(self.path + '.bak').st_mode & 0777, 0600)
+        self.assertFalse(api.keys.write_keys())
+        with open(self.path + '.bak') as f:
+            self.assertEqual(f.read(), first)
+        
+        # Removed keys are matched by the key, the user may be renamed
+        jim.username = 'jimmy'
+        jim.save()
+        Key.objects.filter(pk=key.pk).delete()
+        self.assertTrue(api.keys.update_keys(removed=[key]))
+        self.assertEqual(self.read(), keystore.line(other).encode('utf-8') + '\n')
+        
+        # A key that another user still has stays in the file
+        same = Key.objects.create(user=jim, name='jim', ssh_key=self.other_key)
+        api.keys.update_keys(added=[same])
+        Key.objects.filter(pk=other.pk).delete()
+        api.keys.update_keys(removed=[other])
+        self.assertEqual(self.read(), keystore.line(same).encode('utf-8') + '\n')
+
+
+class UserInfoTestCase(TestCase):
+    
+    def old_info(self, user):
+        # What info() used to build with a query per group
+        output = "Cannula Version: 0.1\n"
+        output += "-------------------------------------------\n"
+        output += "Your Groups and Projects\n"
+        for group in [g.group for g in user.groupmembership_set.all()]:
+            output += " - %s:\n" % group
+            for project in group.projects:
+                output += "\t- %s\n" % project
+        return output
+    
+    def test_info(self):
+        from django.contrib.auth.models import User
+        from cannula.models import ProjectGroup, GroupMembership, Project
+        from cannula.apis.exceptions import UnitDoesNotExist
+        from cannula.api import api
+        jim = User.objects.create_user('jim', 'jim@cannula.com', 'lkjh')
+        self.assertEqual(api.users.info('jim'), self.old_info(jim))
+        
+        empty = ProjectGroup.objects.create(name='empty')
+        zeta = ProjectGroup.objects.create(name='zeta')
+        alpha = ProjectGroup.objects.create(name=u'caf\xe9')
+        for name in ('two', 'one', 'three'):
+            Project.objects.create(name=name, group=zeta)
+        Project.objects.create(name='only', group=alpha)
+        Project.objects.create(name='other', group=empty).delete()
+        for group in (zeta, empty, alpha):
+            GroupMembership.objects.create(user=jim, group=group)
+        info = api.users.info('jim')
+        self.assertEqual(info, self.old_info(jim))
+        self.assertTrue(' - empty:\n - caf' in info)
+        self.assertTrue(isinstance(info, str))
+        
+        self.assertRaises(UnitDoesNotExist, api.users.info, 'nobody')
+    
+    def test_cached(self):
+        from django.core.cache import get_cache
+        from django.contrib.auth.models import User
+        from cannula.models import ProjectGroup, GroupMembership, Project
+        from cannula.apis.v2 import users
+        from cannula.api import api
+        from cannula import cache
+        directory = tempfile.mkdtemp(prefix="cannula_test_")
+        originals = cache.cache, users.django_cache
+        shared = get_cache('django.core.cache.backends.filebased.FileBasedCache',
+            LOCATION=directory)
+        cache.cache = users.django_cache = shared
+        try:
+            jim = User.objects.create_user('jim', 'jim@cannula.com', 'lkjh')
+            group = ProjectGroup.objects.create(name='grp')
+            GroupMembership.objects.create(user=jim, group=group)
+            info = api.users.info('jim')
+            self.assertEqual(shared.get(cache.make_key('perms', 'info', 'jim')), info)
+            # Served from the cache
+            self.assertNumQueries(0, api.users.info, 'jim')
+            
+            Project.objects.create(name='proj', group=group)
+            self.assertTrue('\t- proj\n' in api.users.info('jim'))
+            group.name = 'renamed'
+            group.save()
+            self.assertTrue(' - renamed:\n' in api.users.info('jim'))
+            GroupMembership.objects.filter(user=jim).delete()
+            self.assertEqual(api.users.info('jim'), self.old_info(jim))
+            self.assertFalse('renamed' in api.users.info('jim'))
+        finally:
+            cache.cache, users.django_cache = originals
+            shutil.rmtree(directory)
+
+
+class FakeSupervisor(object):
+    """
+    Stands in for the `SupervisorClient` of the proc api, records every
+    call and answers with `faults` ({(method, args): code}) or a result.
+    """
+    
+    def __init__(self, processes=(), changes=([], [], []), faults=None, multicall=True):
+        self.processes = list(processes)
+        self.changes = changes
+        self.faults = faults or {}
+        self.multicall = multicall
+        self.calls = []
+    
+    def _request(self, method, params):
+        import xmlrpclib
+        if method == 'system.multicall':
+            results = []
+            for call in params[0]:
+                try:
+                    results.append([self._request(call['methodName'], call['params'])])
+                except xmlrpclib.Fault, f:
+                    results.append({'faultCode': f.faultCode, 'faultString': f.faultString})
+            return results
+        self.calls.append((method,) + tuple(params))
+        code = self.faults.get((method,) + tuple(params))
+        if code:
+            raise xmlrpclib.Fault(code, 'fault %s' % code)
+        if method == 'supervisor.getAllProcessInfo':
+            return self.processes
+        if method == 'supervisor.reloadConfig':
+            return [list(self.changes)]
+        return True
+    
+    def __getattr__(self, name):
+        import xmlrpclib
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return xmlrpclib._Method(self._request, name)
+    
+    def call(self, method, *args, **kwargs):
+        return self._request(method, args)
+    
+    def connection(self, timeout=None):
+        from contextlib import contextmanager
+        return contextmanager(lambda: (yield self))()
+    
+    def supports_multicall(self):
+        return self.multicall
+    
+    def batch(self, timeout=None):
+        from cannula.rpc import Batch
+        return Batch(self, timeout)
+
+
+class SupervisordTestCase(TestCase):
+    
+    def setUp(self):
+        from cannula.apis.v2.proc import Supervisord
+        self.directory = tempfile.mkdtemp(prefix="cannula_test_")
+        self.proc = Supervisord()
+        self.ready = []
+        self.proc.wait_ready = lambda path, timeout=30: self.ready.append(path)
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def test_rolling_restart(self):
+        from cannula.worker import socket_path
+        path = os.path.join(self.directory, 'proj.conf')
+        with open(path, 'w') as f:
+            f.write('[group:proj]\nprograms:proj_0,proj_1\n\n'
+                '[fastcgi-program:proj_0]\nnumprocs=3\n\n[program:proj_1]\n')
+        info = lambda name, state=20: {'group': 'proj', 'name': name, 'state': state}
+        self.proc.server = FakeSupervisor([
+            info('proj_1'), info('proj_0_00'), info('proj_0_01'),
+            info('proj_0_02', 0), info('other_0', 20)],
+            faults={('supervisor.stopProcess', 'proj:proj_1'): 70})
+        self.proc.server.processes[-1]['group'] = 'other'
+        self.proc.restart('proj', mode='rolling', batch=2, path=path)
+        calls = [c for c in self.proc.server.calls if c[0] != 'supervisor.getAllProcessInfo']
+        # Each batch is back on the socket before the next one goes down
+        self.assertEqual(calls, [
+            ('supervisor.stopProcess', 'proj:proj_0_00'),
+            ('supervisor.stopProcess', 'proj:proj_0_01'),
+            ('supervisor.startProcess', 'proj:proj_0_00'),
+            ('supervisor.startProcess', 'proj:proj_0_01'),
+            ('supervisor.startProcess', 'proj:proj_0_02'),
+            ('supervisor.stopProcess', 'proj:proj_1'),
+            ('supervisor.startProcess', 'proj:proj_1'),
+        ])
+        self.assertEqual(self.ready, [socket_path('proj_0')] * 2 + [socket_path('proj_1')])
+    
+    def test_restart_failed_stop(self):
+        import xmlrpclib
+        self.proc.server = FakeSupervisor([{'group': 'proj', 'name': 'proj_0', 'state': 20}],
+            faults={('supervisor.stopProcess', 'proj:proj_0'): 60})
+        self.assertRaises(xmlrpclib.Fault, self.proc.restart, 'proj', mode='rolling')
+        # Not started again after a failed stop
+        self.assertEqual(self.proc.server.calls[-1], ('supervisor.stopProcess', 'proj:proj_0'))
+        self.assertEqual(self.ready, [])
+        self.proc.server = FakeSupervisor()
+        self.proc.restart('proj')
+        self.assertEqual(self.proc.server.calls, [
+            ('supervisor.stopProcessGroup', 'proj'),
+            ('supervisor.startProcessGroup', 'proj'),
+        ])
+
+    
+    def test_update(self):
+        for multicall in (True, False):
+            self.proc.server = FakeSupervisor(
+                changes=(['proj', 'other_new'], ['changed'], ['gone', 'other_gone']),
+                faults={('supervisor.stopProcessGroup', 'gone'): 10,
+                    ('supervisor.addProcessGroup', 'proj'): 90},
+                multicall=multicall)
+            result = self.proc.update(['proj', 'changed', 'gone'])
+            self.assertEqual(result, {'added': ['proj'], 'changed': ['changed'],
+                'removed': ['gone']})
+            # Other groups are left alone, every stop runs before a remove
+            self.assertEqual(self.proc.server.calls, [
+                ('supervisor.reloadConfig',),
+                ('supervisor.stopProcessGroup', 'gone'),
+                ('supervisor.stopProcessGroup', 'changed'),
+                ('supervisor.removeProcessGroup', 'gone'),
+                ('supervisor.removeProcessGroup', 'changed'),
+                ('supervisor.addProcessGroup', 'changed'),
+                ('supervisor.addProcessGroup', 'proj'),
+            ])
+    
+    def test_update_failed_stop(self):
+        import xmlrpclib
+        self.proc.server = FakeSupervisor(changes=([], ['changed', 'other'], []),
+            faults={('supervisor.stopProcessGroup', 'changed'): 60})
+        self.assertRaises(xmlrpclib.Fault, self.proc.update, ['changed'])
+        # Not replaced while its processes may still run
+        self.assertEqual(self.proc.server.calls[-1], ('supervisor.stopProcessGroup', 'changed'))
+        self.proc.server = FakeSupervisor()
+        self.assertEqual(self.proc.update(['proj']), {'added': [], 'changed': [], 'removed': []})
+        self.assertEqual(self.proc.server.calls, [('supervisor.reloadConfig',)])
+
+
+class DeployQueueTestCase(TestCase):
+    
+    class Project(object):
+        def __init__(self, lock_dir):
+            self.lock_dir = lock_dir
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="cannula_test_")
+        self.project = self.Project(self.directory)
+        self.messages = []
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def queue(self, rev, timeout=5):
+        from cannula.apis.v2.deploy import DeployQueue
+        queue = DeployQueue(self.project, 'jim', rev, timeout)
+        queue.poll_interval = 0.01
+        queue.notify = self.messages.append
+        return queue
+    
+    def enter(self, queue, results):
+        # Waits for the lock in a thread, flock works per open file
+        import threading
+        def run():
+            with queue:
+                results.append((queue.rev, queue.superseded))
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+    
+    def wait_for(self, count):
+        import time
+        deadline = time.time() + 5
+        while len(os.listdir(os.path.join(self.directory, 'queue'))) < count:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+    
+    def test_superseded(self):
+        results = []
+        with self.queue('one') as first:
+            self.assertFalse(first.superseded)
+            second = self.enter(self.queue('two'), results)
+            self.wait_for(2)
+            third = self.enter(self.queue('three'), results)
+            second.join(5)
+            # 'two' gave up for the newer push without taking the lock
+            self.assertEqual(results, [('two', True)])
+            self.wait_for(2)
+        third.join(5)
+        self.assertEqual(results, [('two', True), ('three', False)])
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'queue')), [])
+        self.assertTrue(any('superseded' in m for m in self.messages))
+    
+    def test_timeout(self):
+        from cannula.apis import ApiError
+        with self.queue('one') as first:
+            self.assertRaises(ApiError, self.queue('two', timeout=0.2).__enter__)
+            # The ticket of the timed out deploy is gone
+            self.assertEqual(os.listdir(os.path.join(self.directory, 'queue')),
+                [os.path.basename(first.ticket)])
+        with self.queue('three') as queue:
+            self.assertFalse(queue.superseded)
+    
+    def test_dead_tickets(self):
+        import time
+        queue_dir = os.path.join(self.directory, 'queue')
+        os.makedirs(queue_dir)
+        # A newer ticket of a deploy that died does not supersede
+        dead = '%017.6f-%d' % (time.time() + 60, 2 ** 22 + 1)
+        open(os.path.join(queue_dir, dead), 'w').close()
+        with self.queue('one') as queue:
+            self.assertFalse(queue.superseded)
+            self.assertEqual(os.listdir(queue_dir), [os.path.basename(queue.ticket)])
+        # Deploys wait longer than other locks by default
+        from cannula.apis.v2.deploy import DeployQueue
+        self.assertEqual(DeployQueue(self.project, 'jim', 'x').timeout,
+            conf.CANNULA_DEPLOY_QUEUE_TIMEOUT)
+
+
+class DaemonTestCase(TestCase):
+    
+    def setUp(self):
+        from cannula import daemon
+        self.directory = tempfile.mkdtemp(prefix="cannula_test_")
+        self.socket_path = os.path.join(self.directory, 'cannula.sock')
+        self.run_command = daemon.run_command
+    
+    def tearDown(self):
+        from cannula import daemon
+        daemon.run_command = self.run_command
+        shutil.rmtree(self.directory)
+    
+    def request(self, command, argv=('jim', 'info')):
+        """Answer one request with `command` in a forked child."""
+        import threading
+        from StringIO import StringIO
+        from cannula import daemon
+        daemon.run_command = command
+        server = daemon.CannulaServer(self.socket_path, daemon.CommandHandler)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        try:
+            out = StringIO()
+            status = daemon.request(list(argv), self.socket_path, out)
+        finally:
+            thread.join(5)
+            server.server_close()
+            os.remove(self.socket_path)
+        return status, out.getvalue()
+    
+    def test_round_trip(self):
+        import sys
+        def command(argv):
+            sys.stdout.write(' '.join(argv) + '\n')
+            # A binary diff, with something that looks like a status
+            sys.stdout.write('\0\x01\x02' * 3000 + '\x007\n' + 'x\0')
+            return 5
+        status, output = self.request(command)
+        self.assertEqual(status, 5)
+        self.assertEqual(output, 'jim info\n' + '\0\x01\x02' * 3000 + '\x007\n' + 'x\0')
+        
+        status, output = self.request(lambda argv: 0)
+        self.assertEqual((status, output), (0, ''))
+    
+    def test_lost_connection(self):
+        import sys
+        def command(argv):
+            sys.stdout.write('half\x003')
+            sys.stdout.flush()
+            # Dies before the status is written
+            os._exit(0)
+        status, output = self.request(command)
+        self.assertEqual((status, output), (1, 'half\x003'))
+    
+    def test_not_running(self):
+        import socket
+        from cannula import daemon
+        self.assertRaises(socket.error, daemon.request, ['jim', 'info'], self.socket_path)
+
+
+class GitTestCase(TestCase):
+    
+    def setUp(self):
+        from cannula.git import Git
+        self.directory = tempfile.mkdtemp(prefix="cannula_test_")
+        self.git = Git(self.directory)
+        self.git.init()
+        self.git._exec('config', 'user.name', 'Cannula Test')
+        self.git._exec('config', 'user.email', 'test@cannula.com')
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def write(self, name, content):
+        with open(os.path.join(self.directory, name), 'w') as f:
+            f.write(content)
+    
+    def rev_parse(self):
+        return self.git._exec('rev-parse', 'HEAD')[1].strip()
+    
+    def test_snapshot(self):
+        snapshot = self.git.snapshot("Nothing")
+        self.assertFalse(snapshot.changed)
+        self.assertEqual((snapshot.oldrev, snapshot.changes), ('', []))
+        
+        self.write('vhost.conf', 'server one;\n')
+        self.write('app.yaml', 'domain: one\n')
+        snapshot = self.git.snapshot("First")
+        self.assertTrue(snapshot.ok and snapshot.changed)
+        self.assertEqual(sorted(snapshot.changes), [('A', 'app.yaml'), ('A', 'vhost.conf')])
+        self.assertEqual(snapshot.newrev, self.rev_parse())
+        self.assertTrue('+server one;' in snapshot.diff)
+        first = snapshot.newrev
+        
+        self.write('vhost.conf', 'server two;\n')
+        os.remove(os.path.join(self.directory, 'app.yaml'))
+        snapshot = self.git.snapshot("Second")
+        self.assertEqual(snapshot.oldrev, first)
+        self.assertEqual(sorted(snapshot.changes), [('D', 'app.yaml'), ('M', 'vhost.conf')])
+        self.assertTrue('-server one;\n+server two;' in snapshot.diff)
+        self.assertEqual(self.git._exec('log', '-1', '--format=%s')[1].strip(), 'Second')
+        
+        # Nothing changed, nothing is committed
+        head = self.rev_parse()
+        snapshot = self.git.snapshot("Third")
+        self.assertFalse(snapshot.changed)
+        self.assertEqual(self.rev_parse(), head)
+    
+    def test_refs(self):
+        self.write('vhost.conf', 'server one;\n')
+        self.git.snapshot("First")
+        head = self.rev_parse()
+        self.assertEqual(self.git.head(), head)
+        branch = self.git._exec('symbolic-ref', 'HEAD')[1].strip()
+        self.assertEqual(self.git.ref(branch), head)
+        # Refs moved to packed-refs are found there
+        self.git._exec('pack-refs', '--all')
+        self.assertFalse(os.path.exists(os.path.join(self.directory, '.git', branch)))
+        self.assertEqual(self.git.head(), head)
+        self.assertEqual(self.git.ref('refs/heads/missing'), '')
+
+
+class ReloadCoordinatorTestCase(TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="cannula_test_")
+        self.reloads = []
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def reload_func(self):
+        import time
+        self.reloads.append(time.time())
+        time.sleep(0.05)
+    
+    def coordinator(self, window=0.2, reload_func=None):
+        from cannula.apis.v2.proxy import ReloadCoordinator
+        return ReloadCoordinator(reload_func or self.reload_func, self.directory, window)
+    
+    def reload_all(self, count, reload_func=None):
+        """Reload from `count` threads at once, like concurrent deploys."""
+        import threading
+        results = []
+        def run():
+            try:
+                results.append(self.coordinator(reload_func=reload_func).reload())
+            except Exception, e:
+                results.append(str(e))
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results
+    
+    def test_merged(self):
+        results = self.reload_all(5)
+        self.assertEqual(len(self.reloads), 1)
+        self.assertEqual(sorted(results), [False] * 4 + [True])
+        # A later request is not covered by the reload before it
+        self.assertTrue(self.coordinator(window=0).reload())
+        self.assertEqual(len(self.reloads), 2)
+    
+    def test_failed(self):
+        def reload_func():
+            self.reload_func()
+            raise Exception("nginx: [emerg] bad config")
+        results = self.reload_all(3, reload_func)
+        self.assertEqual(len(self.reloads), 1)
+        # Everyone who shared the reload sees it failed
+        self.assertEqual(results, ["nginx: [emerg] bad config"] * 3)
+        self.assertTrue(self.coordinator(window=0).reload())
+
+
+class SupervisorClientTestCase(TestCase):
+    
+    def serve(self, multicall=True):
+        """An xmlrpc server that answers like supervisord, in a thread."""
+        import time
+        import threading
+        import xmlrpclib
+        from SimpleXMLRPCServer import SimpleXMLRPCServer
+        server = SimpleXMLRPCServer(('127.0.0.1', 0), logRequests=False)
+        self.calls = []
+        def stop(name):
+            self.calls.append(('stop', name))
+            if name == 'gone':
+                raise xmlrpclib.Fault(10, 'BAD_NAME: gone')
+            if name == 'stuck':
+                raise xmlrpclib.Fault(60, 'FAILED: stuck')
+            return True
+        def start(name):
+            self.calls.append(('start', name))
+            return True
+        server.register_function(lambda: 42, 'supervisor.getPID')
+        server.register_function(stop, 'supervisor.stopProcessGroup')
+        server.register_function(start, 'supervisor.startProcessGroup')
+        server.register_function(lambda: time.sleep(0.5) or True, 'supervisor.slow')
+        if multicall:
+            server.register_multicall_functions()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.shutdown)
+        self.addCleanup(server.server_close)
+        return 'http://127.0.0.1:%d' % server.server_address[1]
+    
+    def test_batch(self):
+        import xmlrpclib
+        from cannula.rpc import SupervisorClient
+        for multicall in (True, False):
+            client = SupervisorClient(self.serve(multicall))
+            self.assertEqual(client.supervisor.getPID(), 42)
+            self.assertEqual(client.supports_multicall(), multicall)
+            self.assertEqual(client.batch().run(), [])
+            
+            batch = client.batch()
+            batch.add('supervisor.stopProcessGroup', 'gone')
+            batch.add('supervisor.stopProcessGroup', 'proj')
+            batch.add('supervisor.startProcessGroup', 'proj')
+            self.assertEqual(batch.run(ignore=(10,)), [None, True, True])
+            self.assertEqual(len(batch), 0)
+            
+            # A fault does not stop the calls after it, it is raised
+            # once they all ran.
+            self.calls = []
+            batch.add('supervisor.stopProcessGroup', 'stuck')
+            batch.add('supervisor.stopProcessGroup', 'gone')
+            batch.add('supervisor.startProcessGroup', 'proj')
+            try:
+                batch.run(ignore=(10,))
+                self.fail("Fault not raised")
+            except xmlrpclib.Fault, f:
+                self.assertEqual(f.faultCode, 60)
+            self.assertEqual(self.calls, [('stop', 'stuck'), ('stop', 'gone'), ('start', 'proj')])
+    
+    def test_timeout(self):
+        import socket
+        from cannula.rpc import SupervisorClient
+        client = SupervisorClient(self.serve(), timeout=0.1)
+        self.assertEqual(client.supervisor.getPID(), 42)
+        self.assertEqual(client.pool.qsize(), 1)
+        self.assertRaises(socket.timeout, client.supervisor.slow)
+        # The connection in an unknown state is not reused
+        self.assertEqual(client.pool.qsize(), 0)
+        self.assertTrue(client.call('supervisor.slow', timeout=5))
+        self.assertEqual(client.supervisor.getPID(), 42)
+
+
+class ReleasesTestCase(TestCase):
+    
+    class Project(object):
+        def __init__(self, base):
+            self.releases_dir = os.path.join(base, 'releases')
+            self.current_release = os.path.join(self.releases_dir, 'current')
+            self.repo_dir = os.path.join(base, 'repo', '.git')
+        
+        def __str__(self):
+            return 'proj'
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="cannula_test_")
+        self.project = self.Project(self.directory)
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def release(self, rev, mtime):
+        from cannula import releases
+        release = releases.Release(self.project, rev)
+        os.makedirs(release.project_dir)
+        os.utime(release.path, (mtime, mtime))
+        return release
+    
+    def test_current(self):
+        from cannula import releases
+        self.assertEqual(releases.current(self.project), None)
+        releases.initialize(self.project)
+        self.assertEqual(releases.current(self.project).rev, releases.INITIAL)
+        release = self.release('abc', 1000)
+        release.activate()
+        self.assertEqual(releases.current(self.project), release)
+        # Initializing again does not switch back
+        releases.initialize(self.project)
+        self.assertEqual(releases.current(self.project), release)
+    
+    def test_prune(self):
+        from cannula import releases
+        old = [self.release('rev%d' % i, 1000 + i) for i in range(6)]
+        old[1].activate()
+        self.assertEqual(releases.history(self.project), old)
+        releases.prune(self.project, keep=2, pinned=[old[2]])
+        # The live and pinned releases are kept with the newest two
+        self.assertEqual(releases.history(self.project), [old[1], old[2], old[4], old[5]])
+        releases.prune(self.project, keep=0)
+        self.assertEqual(releases.history(self.project), [old[1]])
+    
+    def test_link_virtualenv(self):
+        from cannula.releases import link_virtualenv
+        src = os.path.join(self.directory, 'one', 'venv')
+        dst = os.path.join(self.directory, 'two', 'venv')
+        site = os.path.join(src, 'lib', 'python2.7', 'site-packages')
+        os.makedirs(site)
+        os.makedirs(os.path.join(src, 'bin'))
+        files = {
+            'lib/python2.7/site-packages/pkg.py': 'import os\n',
+            'lib/python2.7/site-packages/easy.pth': '%s/src/egg\n' % src,
+            'bin/activate': 'VIRTUAL_ENV="%s"\n' % src,
+            'bin/python': '\x7fELF\0%s' % src,
+        }
+        for name, content in files.items():
+            with open(os.path.join(src, name), 'w') as f:
+                f.write(content)
+        os.chmod(os.path.join(src, 'bin', 'python'), 0755)
+        os.symlink('python', os.path.join(src, 'bin', 'python2'))
+        os.symlink(site, os.path.join(src, 'site'))
+        
+        link_virtualenv(src, dst)
+        read = lambda name: open(os.path.join(dst, name)).read()
+        # Installed packages are shared
+        self.assertEqual(os.stat(os.path.join(dst, 'lib/python2.7/site-packages/pkg.py')).st_ino,
+            os.stat(os.path.join(site, 'pkg.py')).st_ino)
+        # Paths in text files point at the new release
+        self.assertEqual(read('lib/python2.7/site-packages/easy.pth'), '%s/src/egg\n' % dst)
+        self.assertEqual(read('bin/activate'), 'VIRTUAL_ENV="%s"\n' % dst)
+        self.assertEqual(os.stat(os.path.join(dst, 'bin/activate')).st_nlink, 1)
+        # Binaries are copied as they are
+        self.assertEqual(read('bin/python'), files['bin/python'])
+        self.assertEqual(os.stat(os.path.join(dst, 'bin/python')).st_mode & 0777, 0755)
+        self.assertEqual(os.readlink(os.path.join(dst, 'bin/python2')), 'python')
+        self.assertEqual(os.readlink(os.path.join(dst, 'site')),
+            os.path.join(dst, 'lib', 'python2.7', 'site-packages'))
+    
+    def test_create(self):
+        from cannula.git import Git
+        from cannula import releases
+        repo = Git(os.path.dirname(self.project.repo_dir))
+        os.makedirs(repo.directory)
+        repo.init()
+        repo._exec('config', 'user.name', 'Cannula Test')
+        repo._exec('config', 'user.email', 'test@cannula.com')
+        with open(os.path.join(repo.directory, 'app.yaml'), 'w') as f:
+            f.write('domain: localhost\n')
+        rev = repo.snapshot("First").newrev
+        
+        previous = self.release('old', 1000)
+        os.makedirs(os.path.join(previous.virtualenv, 'bin'))
+        with open(os.path.join(previous.virtualenv, 'bin', 'activate'), 'w') as f:
+            f.write(previous.virtualenv)
+        release = releases.Release(self.project, rev)
+        # Left over from a failed build
+        os.makedirs(os.path.join(release.path, 'junk'))
+        release.create(previous)
+        self.assertTrue(release.exists())
+        self.assertFalse(os.path.exists(os.path.join(release.path, 'junk')))
+        self.assertEqual(open(release.appconfig).read(), 'domain: localhost\n')
+        with open(os.path.join(release.virtualenv, 'bin', 'activate')) as f:
+            self.assertEqual(f.read(), release.virtualenv)
+        
+        missing = releases.Release(self.project, '0' * 40)
+        self.assertRaises(Exception, missing.create)
+        self.assertFalse(os.path.exists(missing.path))
+
+
+class RegenerateTestCase(TestCase):
+    
+    def setUp(self):
+        from cannula.models import ProjectGroup, Project
+        from cannula.apis.v2.deploy import DeployAPI
+        from cannula.apis.v2.proxy import Proxy
+        from cannula.apis.v2.proc import Supervisord
+        group = ProjectGroup.objects.create(name='grp')
+        self.projects = {}
+        for name in ('alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta'):
+            self.projects[name] = Project.objects.create(name=name, group=group)
+        self.calls = []
+        self.failing = set()
+        self.originals = [
+            (DeployAPI, '_render_configs', DeployAPI.__dict__['_render_configs']),
+            (Proxy, 'reload', Proxy.__dict__['reload']),
+            (Supervisord, 'update', Supervisord.__dict__['update']),
+            (Supervisord, 'restart', Supervisord.__dict__['restart']),
+        ]
+        def record(action):
+            def method(api, *args, **kwargs):
+                self.calls.append((action, args, kwargs))
+                if action in self.failing:
+                    raise Exception("%s failed" % action)
+            return method
+        DeployAPI._render_configs = lambda api, project: self.render(project)
+        Proxy.reload = record('reload')
+        Supervisord.update = record('update')
+        Supervisord.restart = record('restart')
+    
+    def tearDown(self):
+        for klass, name, original in self.originals:
+            setattr(klass, name, original)
+        for project in self.projects.values():
+            for directory in (project.conf_dir, project.lock_dir):
+                if os.path.isdir(directory):
+                    shutil.rmtree(directory)
+    
+    def render(self, project):
+        restart = {'mode': 'all', 'batch': 1, 'timeout': 30, 'path': project.supervisor_conf}
+        result = {'group': project.name, 'restart': restart,
+            'vhost': False, 'supervisor': False, 'scripts': False}
+        if project.name == 'alpha':
+            result.update(vhost=True, supervisor=True)
+        elif project.name == 'beta':
+            restart['mode'] = 'rolling'
+            result.update(scripts=True)
+        elif project.name == 'gamma':
+            return 'skipped'
+        elif project.name == 'delta':
+            raise Exception("bad app.yaml")
+        return result
+    
+    def regenerate(self, projects=None):
+        from cannula.apis.v2.deploy import deploy_lock
+        from cannula.api import api
+        os.makedirs(self.projects['delta'].conf_dir)
+        # A deploy of epsilon is running
+        with deploy_lock(self.projects['epsilon']) as locked:
+            self.assertTrue(locked)
+            return api.deploy.regenerate(projects, concurrency=3)
+    
+    def test_regenerate(self):
+        results = self.regenerate()
+        self.assertEqual(results, {'alpha': 'changed', 'beta': 'changed',
+            'gamma': 'skipped', 'delta': 'error: bad app.yaml',
+            'epsilon': 'locked', 'zeta': 'unchanged'})
+        # One reload and one update for every project
+        beta = self.projects['beta']
+        self.assertEqual(self.calls, [
+            ('reload', (), {}),
+            ('update', (['alpha'],), {}),
+            ('restart', ('beta',), {'mode': 'rolling', 'batch': 1, 'timeout': 30,
+                'path': beta.supervisor_conf}),
+        ])
+    
+    def test_failures(self):
+        self.failing = set(['reload', 'restart'])
+        results = self.regenerate(['alpha', 'beta', 'zeta'])
+        # Everything is applied, the failures are reported per project
+        self.assertEqual([action for action, _, _ in self.calls], ['reload', 'update', 'restart'])
+        self.assertEqual(results, {'alpha': 'error: proxy reload: reload failed',
+            'beta': 'error: restart: restart failed', 'zeta': 'unchanged'})
+    
+    def test_skipped(self):
+        from cannula.api import api
+        project = self.projects['alpha']
+        render = self.originals[0][2]
+        os.makedirs(project.conf_dir)
+        self.assertEqual(render(api.deploy, project), 'skipped')
+        # Just the empty file of the initial commit
+        open(project.deployconfig, 'w').close()
+        self.assertEqual(render(api.deploy, project), 'skipped')
+        # A bluegreen project that never went live
+        with open(project.deployconfig, 'w') as f:
+            f.write('restart: bluegreen\n')
+        self.assertEqual(render(api.deploy, project), 'skipped')
+
+
+class MaintenanceTestCase(TestCase):
+    
+    class Project(object):
+        def __init__(self, lock_dir):
+            self.lock_dir = lock_dir
+    
+    def setUp(self):
+        from cannula.git import Git
+        self.directory = tempfile.mkdtemp(prefix="cannula_test_")
+        self.project = self.Project(os.path.join(self.directory, 'locks'))
+        # A conf repo with a few commits and a bare repo pushed to
+        self.conf_dir = os.path.join(self.directory, 'config')
+        os.makedirs(self.conf_dir)
+        git = Git(self.conf_dir)
+        git.init()
+        git._exec('config', 'user.name', 'Cannula Test')
+        git._exec('config', 'user.email', 'test@cannula.com')
+        for i in range(3):
+            with open(os.path.join(self.conf_dir, 'vhost.conf'), 'w') as f:
+                f.write('server %d;\n' % i)
+            git.snapshot("Configuration %d" % i)
+        self.repo_dir = os.path.join(self.directory, 'repo.git')
+        git._exec('init', '--bare', self.repo_dir)
+        git._exec('push', '--quiet', self.repo_dir, 'HEAD:refs/heads/master')
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def repos(self):
+        from cannula.maintenance import Repo
+        return [Repo(self.repo_dir, self.project, bare=True),
+            Repo(self.conf_dir, self.project)]
+    
+    def loose(self, git_dir):
+        objects = os.path.join(git_dir, 'objects')
+        return [name for name in os.listdir(objects) if len(name) == 2]
+    
+    def test_maintain(self):
+        from cannula.maintenance import maintain, objects_size
+        self.assertTrue(self.loose(os.path.join(self.conf_dir, '.git')))
+        before = objects_size(os.path.join(self.conf_dir, '.git'))
+        repos = maintain(self.repos(), concurrency=2)
+        self.assertEqual([repo.status for repo in repos], ['ok', 'ok'])
+        for repo in repos:
+            self.assertEqual(self.loose(repo.git_dir), [])
+            pack = os.listdir(os.path.join(repo.git_dir, 'objects', 'pack'))
+            self.assertTrue([name for name in pack if name.endswith('.bitmap')])
+            self.assertTrue(os.path.isfile(os.path.join(repo.git_dir,
+                'objects', 'info', 'commit-graph')))
+        self.assertEqual(repos[1].before, before)
+        self.assertEqual(repos[1].reclaimed, before - repos[1].after)
+        # Still the same history
+        from cannula.git import Git
+        self.assertEqual(Git(self.conf_dir)._exec('log', '--format=%s')[1].split('\n')[:3],
+            ['Configuration 2', 'Configuration 1', 'Configuration 0'])
+    
+    def test_locked(self):
+        from cannula.apis.v2.deploy import deploy_lock
+        from cannula.maintenance import maintain, Repo
+        missing = Repo(os.path.join(self.directory, 'missing.git'), bare=True)
+        with deploy_lock(self.project) as locked:
+            self.assertTrue(locked)
+            repos = maintain(self.repos() + [missing])
+        # A project that is being deployed is done on the next run
+        self.assertEqual([repo.status for repo in repos[:2]], ['locked', 'locked'])
+        self.assertTrue(self.loose(os.path.join(self.conf_dir, '.git')))
+        self.assertTrue(self.loose(self.repo_dir))
+        self.assertTrue(repos[2].status.startswith('failed: '))
+        # Once the deploy is done
+        self.assertEqual([repo.status for repo in maintain(self.repos())], ['ok', 'ok'])
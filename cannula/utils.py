@@ -4,12 +4,18 @@ Cannula Utilities
 
 Various helper scripts for the cannula framework.
 """
+import os
 import sys
+import math
+import stat
+import shutil
+import hashlib
+import tempfile
 import posixpath
 from logging import getLogger
-from subprocess import Popen, PIPE, STDOUT
 
-from django.template.loader import render_to_string
+from cannula.process import run, run_all
+from cannula.render import render
 
 try:
     from importlib import import_module
@@ -51,17 +57,16 @@ except ImportError:  # Compatibility for Python <= 2.6
 
 log = getLogger(__name__)
 
-def shell(command, cwd=None, env=None):
+def shell(command, cwd=None, env=None, timeout=None):
     """Simple shell command processing, """
     log.debug('SHELL: %s' % command)
-    process = Popen(command.strip(), stdout=PIPE, stderr=PIPE, shell=True, cwd=cwd, env=env)
-    stdout, stderr = process.communicate()
-    status = process.returncode
+    result = run(command, cwd=cwd, env=env, timeout=timeout)
+    status = result.status
     if status == 0:
-        return status, stdout + stderr
+        return status, result.stdout + result.stderr
     else:
         log.info('Shell returned a non-zero exit code: %s', status)
-        return status, stderr + stdout
+        return status, result.stderr + result.stdout
 
 
 def shell_escape(text):
@@ -97,6 +102,17 @@ def import_object(dotted_path):
     obj = getattr(mod, parts[1])
     return obj
 
+def percentile(values, percent):
+    """
+    Return the `percent` percentile of a list of numbers using the
+    nearest rank method, None for an empty list.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
 def add_blank_choice(choices, force=False):
     """
     Prepend a blank choice to the passed choices list if it contains more than
@@ -106,68 +122,129 @@ def add_blank_choice(choices, force=False):
         choices = [("", "---------")] + choices
     return choices
 
-#def render_to_string(template, context):
-#    temp = env.get_template(template)
-#    return temp.render(**context)
+def write_content(file_name, content, perm='644'):
+    """
+    Atomically write `content` to `file_name` and return True if the
+    file changed.
+
+    The content goes to a temp file in the same directory which is
+    synced and renamed over the old file, so nginx or supervisor never
+    read half a config. If the file already has the same content (and
+    permissions) it is not touched at all, the mtime and git status
+    stay the same and the caller can skip the reload.
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    mode = int(perm, 8) if isinstance(perm, basestring) else perm
+    digest = hashlib.sha1(content).hexdigest()
+    try:
+        with open(file_name, 'rb') as f:
+            current = hashlib.sha1(f.read()).hexdigest()
+        unchanged = current == digest and \
+            stat.S_IMODE(os.stat(file_name).st_mode) == mode
+    except (IOError, OSError):
+        unchanged = False
+    if unchanged:
+        log.debug("Unchanged file: %s", file_name)
+        return False
+    
+    log.info("Writing file: %s", file_name)
+    directory, name = os.path.split(os.path.abspath(file_name))
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % name, dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        os.rename(tmp, file_name)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return True
+
+def _file_digest(file_name):
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(65536), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_chunks(file_name, chunks, perm='644', backup=False):
+    """
+    Same as `write_content` for content that is too big to build in
+    memory, the `chunks` are written to the temp file as they come.
+    With `backup` the old file is copied to `file_name`.bak before it
+    is replaced. Returns True if the file changed.
+    """
+    mode = int(perm, 8) if isinstance(perm, basestring) else perm
+    directory, name = os.path.split(os.path.abspath(file_name))
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % name, dir=directory)
+    try:
+        digest = hashlib.sha1()
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf-8')
+                digest.update(chunk)
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            unchanged = _file_digest(file_name) == digest.hexdigest() and \
+                stat.S_IMODE(os.stat(file_name).st_mode) == mode
+        except (IOError, OSError):
+            unchanged = False
+        if unchanged:
+            log.debug("Unchanged file: %s", file_name)
+            os.remove(tmp)
+            return False
+        log.info("Writing file: %s", file_name)
+        if backup and os.path.isfile(file_name):
+            shutil.copy2(file_name, '%s.bak' % file_name)
+        os.chmod(tmp, mode)
+        os.rename(tmp, file_name)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return True
 
 def write_file(file_name, template, context=None, perm='644'):
+    """
+    Render `template` to `file_name`, see `write_content`. Returns
+    True if the file changed.
+    """
     if context is None:
         context = {}
-    
-    log.info("Writing file: %s", file_name)
-    with open(file_name, 'w') as f:
-        temp = render_to_string(template, context)
-        f.write(temp)
-        f.close()
-    
-    shell('chmod %s %s' % (perm, file_name))
+    return write_content(file_name, render(template, context), perm)
 
-def call_subprocess(cmd, cwd=None, env=None):
+def call_subprocess(cmd, cwd=None, env=None, timeout=None):
     """Call subprocess and print out stderr/stdout during processing."""
     
     log.debug("Running command %s" % cmd)
 
     try:
-        proc = Popen(cmd.strip(), stderr=STDOUT, stdout=PIPE, shell=True, cwd=cwd, env=env)
+        result = run(cmd, cwd=cwd, env=env, timeout=timeout, stream=sys.stderr)
     except:
         log.exception("Error while executing command %s" % cmd)
         raise
+    return result.status
+
+def multi_process(cmds, cwd=None, env=None, concurrency=4, timeout=None,
+        names=None, out=None):
+    """
+    Run multiple processes in parallel, at most `concurrency` at a time,
+    and return a Result for each command in the same order.
     
-    while True:
-        line = proc.stdout.readline()
-        if not line:
-            break
-        line = line.strip()
-        sys.stderr.write(line+'\n')
-        sys.stderr.flush()
-
-    proc.wait()
-    return proc.returncode
-
-def multi_process(cmds, cwd=None, env=None):
-    """
-    Run multiple processes in parallel and report status when finished.
-    You might want to make sure these commands don't hang otherwise I will never
-    return ;)
+    Output is streamed to `out` (stderr) line by line as it arrives,
+    prefixed with the name of the command (`names` or its position).
+    Commands still running after `timeout` seconds are killed.
     
     This is usefull to run a command on multple remote hosts (git push remote ...)
     """
-    import time
-    
     if not isinstance(cmds, (list, tuple)):
         cmds = [cmds]
-    running_procs = []
-    finished_procs = []
-    for cmd in cmds:
-        p = Popen(cmd.strip(), stderr=STDOUT, stdout=PIPE, shell=True, cwd=cwd, env=env)
-        running_procs.append(p)
-    
-    while len(running_procs):
-        for proc in running_procs:
-            proc.poll()
-            if proc.returncode is not None:
-                finished_procs.append((proc.returncode, proc.stdout.read()))
-                running_procs.remove(proc)
-            time.sleep(.05)
-    
-    return finished_procs
\ No newline at end of file
+    return run_all(cmds, concurrency=concurrency, names=names, cwd=cwd,
+        env=env, timeout=timeout, stream=out or sys.stderr)
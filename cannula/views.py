@@ -23,6 +23,8 @@ from cannula.forms import ProjectForm, ProjectGroupForm, SSHKeyForm,\
     SettingsForm
 from cannula.api import api
 from cannula.conf import conf_dict, write_config
+from cannula import status
+from cannula.apis.v2.permissions import PERMS
 
 
 logger = getLogger('cannula.views')
@@ -170,8 +172,13 @@ def group_api(request, group=None):
     
     if request.method == 'GET':
         groups = api.groups.list(user=request.user)
-        d = {'objects': [group.to_dict() for group in groups]}
-        return respond_json(d)
+        perms = api.permissions.bulk_has_perm(request.user, PERMS, groups)
+        objects = []
+        for group in groups:
+            obj = group.to_dict()
+            obj['perms'] = perms[group]
+            objects.append(obj)
+        return respond_json({'objects': objects})
     
     elif request.method == "POST":
         form = ProjectGroupForm(request.POST)
@@ -203,8 +210,13 @@ def project_api(request, project=None):
     if request.method == "GET":
         group = request.GET.get('group')
         projects = api.projects.list(group=group)
-        d = {'objects': [p.to_dict() for p in projects]}
-        return respond_json(d)
+        perms = api.permissions.bulk_has_perm(request.user, PERMS, projects)
+        objects = []
+        for p in projects:
+            obj = p.to_dict()
+            obj['perms'] = perms[p]
+            objects.append(obj)
+        return respond_json({'objects': objects})
     
     elif request.method == "POST":
         form = ProjectForm(request.POST)
@@ -259,13 +271,19 @@ def group_details(request, group):
     if not request.user.has_perm('read', obj=group):
         raise HttpResponseForbidden("You do not have access to this page.")
     
+    # Never ask supervisord directly, use the poller snapshot
+    snapshot = status.read()
     return render_to_response('cannula/projectgroup_detail.html', 
         RequestContext(request, {
             'title': unicode(group),
             'group': group,
+            'object_perms': api.permissions.bulk_has_perm(request.user, PERMS, [group]),
             'form': ProjectForm(),
             'now': datetime.datetime.now(),
-            'logs': api.log.list(group=group)
+            'logs': api.log.list(group=group),
+            'processes': status.processes(group.projects, snapshot),
+            'status': snapshot,
+            'status_stale': status.is_stale(snapshot),
         })
     )
 
@@ -276,12 +294,18 @@ def project_details(request, group, project):
     if not request.user.has_perm('read', obj=group):
         raise HttpResponseForbidden("You do not have access to this page.")
     
+    # Never ask supervisord directly, use the poller snapshot
+    snapshot = status.read()
     return render_to_response('cannula/project_detail.html', 
         RequestContext(request, {
             'title': unicode(project),
             'project': project,
             'now': datetime.datetime.now(),
-            'logs': api.log.list(project=project)
+            'logs': api.log.list(project=project),
+            'deploy_stats': api.deploy.phase_stats(project),
+            'processes': status.processes([project], snapshot),
+            'status': snapshot,
+            'status_stale': status.is_stale(snapshot),
         })
     )
 
@@ -0,0 +1,219 @@
+"""
+Cannula Wheelhouse
+==================
+
+Node wide cache of built python wheels shared by every project. Wheels
+are stored once by the sha256 of their content and hard linked into a
+flat directory that pip can use with `--find-links`::
+
+    CANNULA_BASE/wheelhouse/
+        objects/ab/ab12...ef   # the actual wheel content
+        wheels/Django-1.4.2-py2-none-any.whl -> objects/ab/ab12...ef
+        index.json             # filename -> sha256, size, last_used
+
+The wheelhouse is bounded in size, the least recently used wheels are
+removed first when it grows past `wheelhouse_max_size` (in MB). pip
+installs most wheels straight from the `--find-links` directory, so
+after an install the wheels of every installed distribution are marked
+as used with `touch`, not only the ones that were just built.
+"""
+
+import os
+import re
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+from logging import getLogger
+
+from cannula import conf
+
+log = getLogger('cannula.wheelhouse')
+
+
+def distribution(filename):
+    """
+    The normalized (name, version) of a wheel filename like
+    ``Django_Foo-1.4.2-py2-none-any.whl``.
+    """
+    name, version = filename.split('-')[:2]
+    return canonical(name), version
+
+
+def canonical(name):
+    """Lowercase project name with runs of '-', '_' and '.' as '_'."""
+    return re.sub(r'[-_.]+', '_', name).lower()
+
+
+class Wheelhouse(object):
+
+    def __init__(self, base=None, max_size=None):
+        self.base = base or os.path.join(conf.CANNULA_BASE, 'wheelhouse')
+        if max_size is None:
+            max_size = conf.CANNULA_WHEELHOUSE_MAX_SIZE
+        # Stored in bytes, configured in megabytes.
+        self.max_size = max_size * 1024 * 1024
+        self.objects_dir = os.path.join(self.base, 'objects')
+        self.wheel_dir = os.path.join(self.base, 'wheels')
+        self.index_file = os.path.join(self.base, 'index.json')
+        self.lock_file = os.path.join(self.base, '.lock')
+
+    def initialize(self):
+        for directory in (self.objects_dir, self.wheel_dir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def _lock(self):
+        self.initialize()
+        lock = open(self.lock_file, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _read_index(self):
+        if not os.path.isfile(self.index_file):
+            return {}
+        try:
+            with open(self.index_file) as index:
+                return json.load(index)
+        except ValueError:
+            log.warning("Corrupt wheelhouse index, starting over")
+            return {}
+
+    def _write_index(self, entries):
+        tmp = '%s.tmp' % self.index_file
+        with open(tmp, 'w') as index:
+            json.dump(entries, index)
+        os.rename(tmp, self.index_file)
+
+    def _object_path(self, sha):
+        return os.path.join(self.objects_dir, sha[:2], sha)
+
+    @staticmethod
+    def _hash(path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as wheel:
+            for chunk in iter(lambda: wheel.read(65536), ''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def entries(self):
+        """Return a list of (filename, info) sorted by least recently used."""
+        entries = self._read_index().items()
+        return sorted(entries, key=lambda entry: entry[1]['last_used'])
+
+    def size(self):
+        """Total bytes used, each object is counted once."""
+        objects = {}
+        for _, info in self.entries():
+            objects[info['sha256']] = info['size']
+        return sum(objects.values())
+
+    def _add(self, path, entries, now):
+        filename = os.path.basename(path)
+        sha = self._hash(path)
+        obj = self._object_path(sha)
+        if not os.path.isfile(obj):
+            if not os.path.isdir(os.path.dirname(obj)):
+                os.makedirs(os.path.dirname(obj))
+            tmp = '%s.tmp' % obj
+            shutil.copyfile(path, tmp)
+            os.rename(tmp, obj)
+            log.info("Stored wheel: %s", filename)
+
+        link = os.path.join(self.wheel_dir, filename)
+        current = entries.get(filename)
+        if current is None or current['sha256'] != sha or not os.path.exists(link):
+            tmp = '%s.tmp' % link
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            os.link(obj, tmp)
+            os.rename(tmp, link)
+        entries[filename] = {
+            'sha256': sha,
+            'size': os.path.getsize(obj),
+            'last_used': now,
+        }
+
+    def add(self, paths):
+        """Store the wheels at `paths` and mark them as used."""
+        lock = self._lock()
+        try:
+            entries = self._read_index()
+            now = time.time()
+            for path in paths:
+                self._add(path, entries, now)
+            self._write_index(entries)
+        finally:
+            lock.close()
+
+    def add_dir(self, directory):
+        """Store every wheel in `directory`."""
+        wheels = [os.path.join(directory, name) for name in os.listdir(directory)
+            if name.endswith('.whl')]
+        self.add(wheels)
+        return wheels
+
+    def find(self, distributions):
+        """
+        Filenames of the wheels of the (name, version) pairs in
+        `distributions`, a version of None matches every version.
+        """
+        wanted = dict([((canonical(n), v), True) for n, v in distributions])
+        found = []
+        for filename in self._read_index():
+            name, version = distribution(filename)
+            if (name, version) in wanted or (name, None) in wanted:
+                found.append(filename)
+        return found
+
+    def touch(self, filenames):
+        """Mark the wheels `filenames` as used, others are ignored."""
+        if not filenames:
+            return
+        lock = self._lock()
+        try:
+            entries = self._read_index()
+            now = time.time()
+            for filename in filenames:
+                if filename in entries:
+                    entries[filename]['last_used'] = now
+            self._write_index(entries)
+        finally:
+            lock.close()
+
+    def _remove(self, filename, entries):
+        info = entries.pop(filename)
+        link = os.path.join(self.wheel_dir, filename)
+        if os.path.exists(link):
+            os.remove(link)
+        shared = [i for i in entries.values() if i['sha256'] == info['sha256']]
+        obj = self._object_path(info['sha256'])
+        if not shared and os.path.exists(obj):
+            os.remove(obj)
+        log.info("Evicted wheel: %s", filename)
+
+    def prune(self, max_size=None):
+        """
+        Evict the least recently used wheels until the wheelhouse is
+        smaller than `max_size` (bytes). Returns the removed filenames.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        lock = self._lock()
+        removed = []
+        try:
+            entries = self._read_index()
+            total = sum(dict([(i['sha256'], i['size']) for i in entries.values()]).values())
+            lru = sorted(entries.items(), key=lambda entry: entry[1]['last_used'])
+            for filename, info in lru:
+                if total <= max_size:
+                    break
+                self._remove(filename, entries)
+                if not [i for i in entries.values() if i['sha256'] == info['sha256']]:
+                    total -= info['size']
+                removed.append(filename)
+            self._write_index(entries)
+        finally:
+            lock.close()
+        return removed
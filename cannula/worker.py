@@ -3,6 +3,10 @@ import os
 from cannula.conf import CANNULA_BASE
 from cannula.utils import write_file
 
+def socket_path(name):
+    """Unix socket the worker `name` listens on, the proxy connects to it."""
+    return os.path.join(CANNULA_BASE, 'config', 'sockets', '%s.socket' % name)
+
 class Worker(object):
     """
     Worker Class
@@ -28,12 +32,16 @@ class Worker(object):
     def script_name(self):
         return self.name
     
+    @property
+    def socket(self):
+        return socket_path(self.name)
+    
     def write_startup_script(self):
-        """Write out startup script for worker type."""
+        """Write out startup script for worker type, True if it changed."""
         file_name = os.path.join(CANNULA_BASE, 'config', self.project.name, 
             self.script_name())
         
-        write_file(file_name, self.template, self.defaults)
+        return write_file(file_name, self.template, self.defaults)
     
 class gunicorn_django(Worker):
     """
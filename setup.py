@@ -14,6 +14,7 @@ setup(
         'console_scripts': [
             'cannula-admin = cannula.bin.admin:main',
             'cannulactl = cannula.bin.control:main',
+            'cannula-client = cannula.bin.client:main',
         ]
     },
     url = 'http://bitbucket.org/rmyers/cannula/',